@@ -1,104 +1,155 @@
 import csv
 import json
 import os
-import requests
 import logging
-from requests.auth import HTTPBasicAuth
-from config import cloud, on_prem
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import client
+from config import cloud, on_prem, workers
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+cloud_fields = ['uuid', 'slug', 'name', 'scm', 'https', 'ssh']
+server_fields = ['id', 'slug', 'name', 'scmId', 'project_key', 'https', 'ssh', 'origin']
+merged_fields = ['name', 'project', 'match', 'source', 'target', 'network']
+
+def cloud_repo_rows(data):
+    """The CSV rows of one page of Bitbucket Cloud repositories."""
+    rows = []
+    for repo in data.get('values', []):
+        clone_https = repo['links']['clone'][0]['href']
+        clone_ssh = repo['links']['clone'][1]['href']
+        rows.append([repo['uuid'], repo['slug'], repo['name'], repo['scm'], clone_https, clone_ssh])
+    return rows
+
+def write_cloud_repos(writer, data):
+    writer.writerows(cloud_repo_rows(data))
+
 def get_bitbucket_cloud_repos(workspace, username, token, output_file):
+    """
+    Lists every Bitbucket Cloud repository of the workspace into output_file.
+
+    The first page is requested with the largest page length and its 'size' tells how many pages
+    there are, so the remaining pages are fetched in parallel and written in page order. When the
+    response has no 'size' the 'next' links are followed one after another instead.
+    """
     logging.info("Starting to fetch Bitbucket Cloud repositories.")
-    url = f"https://api.bitbucket.org/2.0/repositories/{workspace}"
-    auth = HTTPBasicAuth(username, token)
+    url = f"{client.cloud_api}/2.0/repositories/{workspace}"
     headers = {"Accept": "application/json"}
 
     try:
         with open(output_file, 'w', newline='', encoding='utf-8') as file:
             writer = csv.writer(file)
-            writer.writerow(['uuid', 'slug', 'name', 'scm', 'https', 'ssh'])
-
-            while url:
-                response = requests.get(url, auth=auth, headers=headers)
-                if response.status_code == 200:
-                    data = response.json()
-                    for repo in data.get('values', []):
-                        clone_https = repo['links']['clone'][0]['href']
-                        clone_ssh = repo['links']['clone'][1]['href']
-                        writer.writerow([repo['uuid'], repo['slug'], repo['name'], repo['scm'], clone_https, clone_ssh])
-                    url = data.get('next', None)
-                else:
-                    logging.error(f"Failed to fetch repositories: {response.text}")
-                    break
+            writer.writerow(cloud_fields)
+
+            for data in client.iter_cloud_pages(url, pagelen=100, workers=workers['cloud_pages'], headers=headers):
+                write_cloud_repos(writer, data)
         logging.info("Successfully fetched and saved Bitbucket Cloud repositories.")
     except Exception as e:
         logging.error(f"Error fetching Bitbucket Cloud repositories: {e}")
 
+def iter_server_projects(base_url, headers, project_limit):
+    """Yield every Bitbucket Server project, one page at a time."""
+    projects_start = 0
+    projects_is_last_page = False
+
+    while not projects_is_last_page:
+        projects_url = f"{base_url}/rest/api/1.0/projects?start={projects_start}&limit={project_limit}"
+        projects_response = client.get(projects_url, headers=headers)
+        if projects_response.status_code != 200:
+            logging.error(f"Failed to fetch projects. Status code: {projects_response.status_code}")
+            return
+        projects_data = projects_response.json()
+        yield from projects_data.get('values', [])
+        projects_is_last_page = projects_data.get('isLastPage', True)
+        projects_start = projects_data.get('nextPageStart', projects_start + project_limit)
+
+def get_server_project_repos(base_url, project_key, headers, repo_limit):
+    """Page through all repositories of a project and return them as CSV rows."""
+    rows = []
+    repos_start = 0
+    repos_is_last_page = False
+
+    while not repos_is_last_page:
+        repos_url = f"{base_url}/rest/api/1.0/projects/{project_key}/repos?start={repos_start}&limit={repo_limit}"
+        repos_response = client.get(repos_url, headers=headers)
+        if repos_response.status_code != 200:
+            logging.error(f"Failed to fetch repositories for project {project_key}. Status code: {repos_response.status_code}")
+            break
+        repos_data = repos_response.json()
+        repos_is_last_page = repos_data.get('isLastPage', True)
+        repos_start = repos_data.get('nextPageStart', repos_start + repo_limit)
+
+        for repo in repos_data.get('values', []):
+            clone_https = None
+            clone_ssh = None
+            for clone_link in repo['links']['clone']:
+                if clone_link['name'] == 'http':
+                    clone_https = clone_link['href']
+                elif clone_link['name'] == 'ssh':
+                    clone_ssh = clone_link['href']
+            # Forks carry their parent, recorded as PROJECT/slug to group fork networks later
+            origin = repo.get('origin')
+            origin_ref = f"{origin['project']['key']}/{origin['slug']}" if origin else ''
+            if clone_https or clone_ssh:
+                rows.append([repo['id'], repo['slug'], repo['name'], repo['scmId'], project_key, clone_https, clone_ssh, origin_ref])
+    return rows
+
 def get_bitbucket_server_repos(base_url, username, password, output_file):
+    """
+    Lists every Bitbucket Server repository into output_file.
+
+    Project pages are read while a pool of workers pages each project's repositories in parallel.
+    Rows are written as soon as they are available, always in project listing order, so the
+    output is the same no matter which worker finishes first.
+    """
     logging.info("Starting to fetch Bitbucket Server repositories.")
-    auth = HTTPBasicAuth(username, password)  # Authentication setup
     headers = {"Accept": "application/json"}  # Request headers
     project_limit = 100  # Define the project limit
     repo_limit = 1000  # Define the repository limit
+    max_pending = workers['list_repos'] * 4  # Projects allowed in flight before waiting on the oldest
+
+    def write_project(writer, project_key, future):
+        rows = future.result()
+        writer.writerows(rows)
+        logging.info(f"Added {len(rows)} repositories of project {project_key} to CSV.")
 
     try:
-        with open(output_file, 'w', newline='', encoding='utf-8') as file:
+        with open(output_file, 'w', newline='', encoding='utf-8') as file, \
+                ThreadPoolExecutor(max_workers=workers['list_repos']) as executor:
             writer = csv.writer(file)
-            writer.writerow(['id', 'slug', 'name', 'scmId', 'project_key', 'https', 'ssh'])  # Header row for CSV
-
-            # Pagination setup for projects
-            projects_start = 0
-            projects_is_last_page = False
-
-            while not projects_is_last_page:
-                projects_url = f"{base_url}/rest/api/1.0/projects?start={projects_start}&limit={project_limit}"
-                projects_response = requests.get(projects_url, auth=auth, headers=headers)
-                if projects_response.status_code == 200:
-                    projects_data = projects_response.json()
-                    projects = projects_data.get('values', [])
-                    projects_is_last_page = projects_data.get('isLastPage', True)
-
-                    for project in projects:
-                        # Logging each project being processed
-                        logging.info(f"Processing project: {project['key']}")
-                        repos_start = 0
-                        repos_is_last_page = False
-
-                        while not repos_is_last_page:
-                            repos_url = f"{base_url}/rest/api/1.0/projects/{project['key']}/repos?start={repos_start}&limit={repo_limit}"
-                            repos_response = requests.get(repos_url, auth=auth, headers=headers)
-                            if repos_response.status_code == 200:
-                                repos_data = repos_response.json()
-                                repos = repos_data.get('values', [])
-                                repos_is_last_page = repos_data.get('isLastPage', True)
-
-                                for repo in repos:
-                                    clone_https = None
-                                    clone_ssh = None
-                                    for clone_link in repo['links']['clone']:
-                                        if clone_link['name'] == 'http':
-                                            clone_https = clone_link['href']
-                                        elif clone_link['name'] == 'ssh':
-                                            clone_ssh = clone_link['href']
-                                    if clone_https or clone_ssh:
-                                        writer.writerow([repo['id'], repo['slug'], repo['name'], repo['scmId'], project['key'], clone_https, clone_ssh])
-                                        logging.info(f"Added repository '{repo['name']}' to CSV.")
-                            else:
-                                logging.error(f"Failed to fetch repositories for project {project['key']}. Status code: {repos_response.status_code}")
-                                break
-
-                        if not projects_is_last_page:
-                            projects_start += project_limit
-                else:
-                    logging.error(f"Failed to fetch projects. Status code: {projects_response.status_code}")
-                    break
+            writer.writerow(server_fields)  # Header row for CSV
+
+            pending = deque()
+            for project in iter_server_projects(base_url, headers, project_limit):
+                logging.info(f"Processing project: {project['key']}")
+                pending.append((project['key'], executor.submit(get_server_project_repos, base_url, project['key'], headers, repo_limit)))
+
+                # Flush finished projects in order, waiting on the oldest one when too many are in flight
+                while pending and (pending[0][1].done() or len(pending) >= max_pending):
+                    write_project(writer, *pending.popleft())
+
+            while pending:
+                write_project(writer, *pending.popleft())
             logging.info("Successfully fetched and saved Bitbucket Server repositories.")
     except Exception as e:
         logging.error(f"Error while fetching Bitbucket Server repositories: {e}")
 
 
+def fork_network(server_repo, repos_by_ref):
+    """Returns the PROJECT/slug of the repository at the top of a fork chain (the repository itself if it is no fork)."""
+    ref = f"{server_repo['project_key']}/{server_repo['slug']}"
+    seen = {ref}
+    while repos_by_ref.get(ref, {}).get('origin') and repos_by_ref[ref]['origin'] not in seen:
+        ref = repos_by_ref[ref]['origin']
+        seen.add(ref)
+    return ref
+
+def merge_repo(server_repo, cloud_repo, repos_by_ref):
+    """The merged row of a server repository and the Cloud repository of the same name."""
+    return [server_repo['name'], server_repo['project_key'], "yes", server_repo['https'], cloud_repo['https'], fork_network(server_repo, repos_by_ref)]
+
 def merge_repos_to_csv(server_csv, cloud_csv, output_csv):
     """Merges data from Bitbucket Server and Cloud CSV files into a single CSV file."""
     try:
@@ -107,10 +158,12 @@ def merge_repos_to_csv(server_csv, cloud_csv, output_csv):
         cloud_csv_path = os.path.join(script_dir, cloud_csv)
         
         server_repos = {}
+        repos_by_ref = {}
         with open(server_csv_path, 'r', encoding='utf-8') as file:
             reader = csv.DictReader(file)
             for row in reader:
                 server_repos[row['name']] = row
+                repos_by_ref[f"{row['project_key']}/{row['slug']}"] = row
 
         cloud_repos = {}
         with open(cloud_csv_path, 'r', encoding='utf-8') as file:
@@ -120,21 +173,18 @@ def merge_repos_to_csv(server_csv, cloud_csv, output_csv):
 
         with open(output_csv, 'w', newline='', encoding='utf-8') as file:
             writer = csv.writer(file)
-            writer.writerow(['name', 'project', 'match', 'source', 'target'])
+            writer.writerow(merged_fields)
 
             for name, server_repo in server_repos.items():
                 if name in cloud_repos:
-                    cloud_repo = cloud_repos[name]
-                    project = server_repo['project_key']
-                    match = "yes"
-                    source = server_repo['https']
-                    target = cloud_repo['https']
-                    writer.writerow([name, project, match, source, target])
+                    writer.writerow(merge_repo(server_repo, cloud_repos[name], repos_by_ref))
         logging.info("Successfully merged repositories into a single CSV.")
     except Exception as e:
         logging.error(f"Error merging repositories: {e}")
 
 # Fetch and merge repositories
-get_bitbucket_cloud_repos(cloud['workspace'], cloud['username'], cloud['token'], cloud['bitbucket_cloud_repositories'])
-get_bitbucket_server_repos(on_prem['base_url'], on_prem['username'], on_prem['password'], on_prem['bitbucket_server_repositories'])
-merge_repos_to_csv(on_prem['bitbucket_server_repositories'], cloud['bitbucket_cloud_repositories'], 'merged_repositories.csv')
+if __name__ == "__main__":
+    get_bitbucket_cloud_repos(cloud['workspace'], cloud['username'], cloud['token'], cloud['bitbucket_cloud_repositories'])
+    get_bitbucket_server_repos(on_prem['base_url'], on_prem['username'], on_prem['password'], on_prem['bitbucket_server_repositories'])
+    merge_repos_to_csv(on_prem['bitbucket_server_repositories'], cloud['bitbucket_cloud_repositories'], 'merged_repositories.csv')
+    client.log_stats()
@@ -1,12 +1,14 @@
 import csv
-import requests
 import json
 import os
 import subprocess
 import urllib.parse
 import logging
-from requests.auth import HTTPBasicAuth
-from config import cloud, on_prem, project_key, repository_folder
+import client
+import git_mirror
+import lfs_manifest
+import user_directory
+from config import cloud, on_prem, project_key, repository_folder, use_mirrors
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
 
@@ -21,21 +23,17 @@ def run_command(command, cwd=None):
     except subprocess.CalledProcessError as e:
         logging.error(f"Command failed with error: {e.stderr}")
 
-def get_uuid_from_display_name(display_name):
-    """Retrieve UUID for a given display name from a CSV file."""
-    filepath = os.path.join(os.path.dirname(__file__), 'bitbucket_users_match.csv')
-    with open(filepath, mode='r') as csvfile:
-        for row in csv.DictReader(csvfile):
-            if row['server_displayName'] == display_name:
-                return row['cloud_uuid']
-    return None
+def get_uuid_from_owner(owner):
+    """Retrieve the Cloud UUID of a personal project owner from the user directory, by slug and then by display name."""
+    users = user_directory.load()
+    return users.cloud_uuid(server_slug=owner.get('slug'), server_display_name=owner.get('displayName'))
 
 def set_admin_permission(repo_slug, uuid):
     """Sets admin permission for the provided UUID on the created repository."""
     logging.info(f"Setting admin permission for {uuid} on repository {repo_slug}...")
-    url = f"https://api.bitbucket.org/2.0/workspaces/{cloud['workspace']}/projects/{project_key}/permissions-config/users/{uuid}"
+    url = f"{client.cloud_api}/2.0/workspaces/{cloud['workspace']}/projects/{project_key}/permissions-config/users/{uuid}"
     payload = {"permission": "admin"}
-    response = requests.put(url, auth=HTTPBasicAuth(cloud['username'], cloud['token']), headers={"Content-Type": "application/json"}, json=payload)
+    response = client.put(url, headers={"Content-Type": "application/json"}, json=payload)
     
     if response.ok:
         logging.info(f"Admin permission successfully set for {uuid} on repository {repo_slug}.")
@@ -46,16 +44,22 @@ def create_cloud_repo(source_url, repo_name, uuid, username):
     """Creates a repository on Bitbucket Cloud using the user's UUID, sets the admin and clone and sync the repo"""
     logging.info(f"Creating repository '{repo_name}' on Bitbucket Cloud...")
     new_repo_name = f"{username}-{repo_name}"
-    url = f"https://api.bitbucket.org/2.0/repositories/{cloud['workspace']}/{new_repo_name}"
+    url = f"{client.cloud_api}/2.0/repositories/{cloud['workspace']}/{new_repo_name}"
     payload = {"scm": "git", "is_private": True, "project": {"key": project_key}, "owner": {"type": uuid}}
     
-    response = requests.post(url, auth=HTTPBasicAuth(cloud['username'], cloud['token']), headers={"Content-Type": "application/json"}, json=payload)
+    response = client.post(url, headers={"Content-Type": "application/json"}, json=payload)
     if response.ok:
         logging.info(f"Repository '{repo_name}' successfully created on Bitbucket Cloud.")
-        set_admin_permission(new_repo_name, uuid)
-        clone_and_sync_repos(source_url, response.json()['links']['clone'][0]['href'], new_repo_name)
     else:
-        logging.error(f"Error creating repository '{repo_name}': {response.text}")
+        # On a rerun the repository already exists: read it back and sync it incrementally
+        existing = client.get(url)
+        if not existing.ok:
+            logging.error(f"Error creating repository '{repo_name}': {response.text}")
+            return
+        logging.info(f"Repository '{new_repo_name}' already exists on Bitbucket Cloud, syncing it.")
+        response = existing
+    set_admin_permission(new_repo_name, uuid)
+    clone_and_sync_repos(source_url, response.json()['links']['clone'][0]['href'], new_repo_name)
 
 def clone_and_sync_repos(source_url, target_url, new_repo_name):
     """Clones and syncs repositories, including LFS files if enabled."""
@@ -63,7 +67,18 @@ def clone_and_sync_repos(source_url, target_url, new_repo_name):
     credentials = f"{on_prem['username']}:{urllib.parse.quote_plus(on_prem['password'])}"
     source_url_with_credentials = source_url.replace('https://', f"https://{credentials}@").replace('http://', f"http://{credentials}@")
     repo_folder = os.path.join(repository_folder, new_repo_name)
-    
+
+    if use_mirrors:
+        # Bare mirror: clone once, then fetch only what changed and push all branches and tags in one push
+        repo_folder = git_mirror.mirror_path(repository_folder, new_repo_name)
+        if git_mirror.fetch_mirror(source_url_with_credentials, repo_folder) != 0:
+            return
+        git_mirror.set_cloud_remote(repo_folder, target_url)
+        if should_sync_lfs:
+            sync_lfs(repo_folder)
+        git_mirror.push_mirror(repo_folder)
+        return
+
     if not os.path.exists(repo_folder):
         run_command(f"git clone {source_url_with_credentials} \"{repo_folder}\"")
         run_command(f"git remote add cloud {target_url}", cwd=repo_folder)
@@ -72,8 +87,16 @@ def clone_and_sync_repos(source_url, target_url, new_repo_name):
         logging.info("Repository already exists, skipping clone.")
     
     if should_sync_lfs:
-        run_command("git lfs fetch --all", cwd=repo_folder)
-        run_command("git lfs push --all cloud", cwd=repo_folder)
+        sync_lfs(repo_folder)
+
+def sync_lfs(repo_folder):
+    """Fetches and pushes only the LFS objects the repository's manifest does not already record."""
+    try:
+        manifest = lfs_manifest.LfsManifest(repo_folder)
+        if manifest.fetch() == 0:
+            manifest.push()
+    except subprocess.CalledProcessError as e:
+        logging.error(f"LFS sync failed for {repo_folder}: {e.stderr}")
 
 def process_repos():
     """Processes repositories from CSV, creating them on Bitbucket Cloud with admin permissions."""
@@ -84,13 +107,13 @@ def process_repos():
             logging.info(f"Processing repository for user: {row['User']}")
             username, repo_slug = row['User'], row['Repository Slug']
             server_url = f"{on_prem['base_url']}/rest/api/1.0/projects/{username}/repos/{repo_slug}"
-            response = requests.get(server_url, auth=HTTPBasicAuth(on_prem['username'], on_prem['password']))
+            response = client.get(server_url)
             
             if response.ok:
                 repo_details = response.json()
                 display_name = repo_details['project']['owner']['displayName']
                 source_clone = repo_details['links']['clone'][0]['href']
-                uuid = get_uuid_from_display_name(display_name)
+                uuid = get_uuid_from_owner(repo_details['project']['owner'])
                 if uuid:
                     create_cloud_repo(source_clone, repo_slug, uuid, username.strip("~"))
                 else:
@@ -100,3 +123,5 @@ def process_repos():
 
 if __name__ == "__main__":
     process_repos()
+    user_directory.load().log_stats()
+    client.log_stats()
@@ -1,9 +1,17 @@
 import csv
 import os
 import subprocess
+import threading
+import time
 import urllib.parse
 import logging
-from config import on_prem, repository_folder
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import git_mirror
+import ledger
+import lfs_manifest
+import object_store
+from collections import defaultdict
+from config import dedupe_objects, on_prem, repository_folder, use_mirrors, workers
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -15,62 +23,239 @@ save_folder = os.path.join(script_location, repository_folder)
 # Ensure the 'repositories' subfolder exists
 os.makedirs(save_folder, exist_ok=True)
 
+# Shared object and LFS storage for fork networks (dedupe mode)
+shared_root = os.path.join(save_folder, '.shared')
+
 # Predefined configuration variables
 input_csv = os.path.join(script_location, "merged_repositories.csv")  # Adjusted for script location
+results_csv = os.path.join(script_location, "clone_results.csv")  # One outcome record per repository
 should_clone = True  # Set to True to clone repositories
 should_sync_lfs = True  # Set to True to sync LFS files
 
+# Limits on the network heavy steps, shared by all repository workers
+clone_slots = threading.BoundedSemaphore(workers['clone_slots'])
+lfs_push_slots = threading.BoundedSemaphore(workers['lfs_push_slots'])
+
+results_fields = ['name', 'network', 'status', 'exit_code', 'failed_step', 'duration', 'clone_duration', 'fetch_duration', 'lfs_fetch_duration', 'lfs_push_duration', 'push_duration', 'bytes',
+                  'lfs_pushed_objects', 'lfs_pushed_bytes', 'lfs_fetch_skipped_objects', 'lfs_fetch_skipped_bytes', 'lfs_push_skipped_objects', 'lfs_push_skipped_bytes',
+                  'transfer_saved_bytes']
+
 def run_command(command, cwd=None):
-    """Execute a system command with optional working directory."""
-    logging.info(f"Executing: {command}")
+    """Execute a system command with optional working directory and return its exit code."""
+    logging.debug(f"Executing: {command}")
     try:
         result = subprocess.run(command, shell=True, cwd=cwd, capture_output=True, text=True)
         if result.stdout:
             logging.debug(result.stdout)
-        if result.stderr:
+        if result.returncode != 0 and result.stderr:
             logging.error(result.stderr)
+        return result.returncode
     except Exception as e:
         logging.exception("Failed to execute command")
+        return -1
+
+def folder_size(path):
+    """Total size in bytes of the files under path."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def source_state(source_url, target_url):
+    """Hash of the source's refs and of what is done with them, or None if the source cannot be listed."""
+    listing = subprocess.run(["git", "ls-remote", source_url], capture_output=True, text=True)
+    if listing.returncode != 0:
+        return None
+    return ledger.content_hash(listing.stdout, target_url, use_mirrors, should_clone, should_sync_lfs)
+
+def clone_and_sync_repo(row, registry=None):
+    """Clone and sync a single repository, returning its outcome record."""
+    started = time.monotonic()
+    outcome = {'name': row['name'], 'status': 'ok', 'exit_code': 0, 'failed_step': ''}
+
+    store = None
+    if registry:
+        outcome['network'] = registry.network_of(row['name'], row.get('network') or row['name'])
+        store = object_store.store_path(shared_root, outcome['network'])
+    reference = f" --reference-if-able \"{store}\"" if store else ""
+
+    def step(name, command, cwd=None, slots=None):
+        """Run one step (a shell command or a callable returning an exit code), timing it; returns False if it failed."""
+        run = command if callable(command) else lambda: run_command(command, cwd=cwd)
+        step_started = time.monotonic()
+        if slots:
+            with slots:
+                exit_code = run()
+        else:
+            exit_code = run()
+        outcome[f"{name}_duration"] = round(time.monotonic() - step_started, 3)
+        if exit_code != 0:
+            outcome.update({'status': 'failed', 'exit_code': exit_code, 'failed_step': name})
+            return False
+        return True
+
+    # Construct source and target URLs with credentials
+    credentials = f"{on_prem['username']}:{urllib.parse.quote_plus(on_prem['password'])}"
+    source_url = row['source']
+
+    # Check if the URL starts with http:// or https://
+    new_url = source_url
+    if source_url.startswith('http://'):
+        new_url = source_url.replace('http://', f"http://{credentials}@")
+    elif source_url.startswith('https://'):
+        new_url = source_url.replace('https://', f"https://{credentials}@")
+
+    source_url = new_url
+    target_url = row['target']
+    repo_folder = os.path.join(save_folder, row['name'])
+
+    ok = True
+    if use_mirrors:
+        repo_folder = git_mirror.mirror_path(save_folder, row['name'])
+    fresh_clone = not os.path.exists(repo_folder)
+
+    # Skip the repository when the ledger has its units completed for the refs the source has now
+    units = ledger.load()
+    state = source_state(source_url, target_url) if units.enabled else None
+    repo_units = ['clone'] + (['lfs_push'] if should_sync_lfs else [])
+    if state and not fresh_clone and all(units.is_done(unit, row['name'], state) for unit in repo_units):
+        for unit in repo_units:
+            units.skip(unit)
+        logging.info(f"{row['name']} has not changed since its last completed run, skipping it")
+        outcome.update({'status': 'skipped', 'duration': round(time.monotonic() - started, 3), 'folder': repo_folder})
+        return outcome
+    if state:
+        for unit in repo_units:
+            units.start(unit, row['name'], state)
+
+    if use_mirrors:
+        # Bare mirror: clone once, then fetch only what changed and push all refs in one go
+        step_name = 'clone' if fresh_clone else 'fetch'
+        ok = step(step_name, lambda: git_mirror.fetch_mirror(source_url, repo_folder, reference=store), slots=clone_slots)
+        if ok:
+            ok = step('cloud_remote', lambda: git_mirror.set_cloud_remote(repo_folder, target_url))
+    elif should_clone:
+        # Clone repository if it does not exist
+        if fresh_clone:
+            ok = step('clone', f"git clone{reference} {source_url} \"{repo_folder}\"", slots=clone_slots)
+        if ok:
+            # Add cloud remote (fails harmlessly when it already exists)
+            run_command(f"git remote add cloud {target_url}", cwd=repo_folder)
+
+    if ok and store:
+        # Move the repository's objects into its network's shared store
+        if fresh_clone:
+            outcome['transfer_saved_bytes'] = max(object_store.reachable_object_bytes(repo_folder) - object_store.local_object_bytes(repo_folder), 0)
+        network = registry.register(row['name'], outcome['network'], object_store.root_commits(repo_folder))
+        if network != outcome['network']:
+            logging.info(f"{row['name']} shares its root commit with network {network}, joining it")
+            outcome['network'] = network
+            store = object_store.store_path(shared_root, network)
+        lfs_storage = object_store.lfs_storage_path(shared_root, network)
+        ok = step('dedupe', lambda: object_store.absorb(repo_folder, row['source'], store, lfs_storage))
+
+    if ok and should_sync_lfs:
+        # Fetch and push LFS files, skipping what the manifest already records as fetched or on Cloud
+        manifest = lfs_manifest.LfsManifest(repo_folder)
+        ok = step('lfs_fetch', manifest.fetch)
+        if ok:
+            ok = step('lfs_push', manifest.push, slots=lfs_push_slots)
+        outcome.update({
+            'lfs_pushed_objects': manifest.objects_pushed,
+            'lfs_pushed_bytes': manifest.bytes_pushed,
+            'lfs_fetch_skipped_objects': manifest.fetch_skipped,
+            'lfs_fetch_skipped_bytes': manifest.fetch_skipped_bytes,
+            'lfs_push_skipped_objects': manifest.push_skipped,
+            'lfs_push_skipped_bytes': manifest.push_skipped_bytes,
+        })
+
+    if ok and use_mirrors:
+        step('push', lambda: git_mirror.push_mirror(repo_folder))
+
+    if state:
+        units.finish('clone', row['name'], state, outcome['status'] == 'ok', outcome['failed_step'] or None)
+        if should_sync_lfs:
+            # The LFS push is its own unit, completed even when the mirror push after it fails
+            lfs_pushed = outcome['status'] == 'ok' or outcome['failed_step'] == 'push'
+            units.finish('lfs_push', row['name'], state, lfs_pushed, None if lfs_pushed else outcome['failed_step'])
+
+    outcome['duration'] = round(time.monotonic() - started, 3)
+    outcome['bytes'] = folder_size(repo_folder)
+    outcome['folder'] = repo_folder
+    return outcome
+
+def clone_and_sync_network(rows, registry):
+    """Process the repositories of one fork network one after another, so each reuses what the others already downloaded."""
+    return [clone_and_sync_repo(row, registry) for row in rows]
+
+def log_dedupe_savings(outcomes):
+    """Log the disk and transfer the shared storage saved, per network and in total."""
+    members = defaultdict(list)
+    for outcome in outcomes:
+        if outcome.get('network') and outcome.get('folder') and os.path.exists(outcome['folder']):
+            members[outcome['network']].append(outcome['folder'])
+
+    total_disk = total_lfs = 0
+    for network, folders in sorted(members.items()):
+        disk_saved = object_store.network_savings(shared_root, network, folders)
+        lfs_referenced = 0
+        for folder in folders:
+            try:
+                lfs_referenced += sum(lfs_manifest.LfsManifest(folder).fetched.values())
+            except subprocess.CalledProcessError:
+                pass
+        lfs_saved = max(lfs_referenced - object_store.folder_size(object_store.lfs_storage_path(shared_root, network)), 0)
+        total_disk += disk_saved
+        total_lfs += lfs_saved
+        if len(folders) > 1:
+            logging.info(f"Network {network}: {len(folders)} repositories, {disk_saved} bytes of git objects and {lfs_saved} bytes of LFS objects saved on disk")
+
+    transfer_saved = sum(outcome.get('transfer_saved_bytes', 0) for outcome in outcomes)
+    logging.info(f"Dedupe saved {total_disk} bytes of git objects and {total_lfs} bytes of LFS objects on disk, and about {transfer_saved} bytes of git transfer")
 
 def clone_and_sync_repos():
-    """Clone and sync repositories from a CSV file."""
+    """Clone and sync repositories from a CSV file with a pool of workers."""
     with open(input_csv, newline='') as csvfile:
-        reader = csv.DictReader(csvfile, delimiter=',')
-        for row in reader:
-            # Construct source and target URLs with credentials
-            credentials = f"{on_prem['username']}:{urllib.parse.quote_plus(on_prem['password'])}"
-            source_url = row['source']
-
-            # Check if the URL starts with http:// or https://
-            if source_url.startswith('http://'):
-                new_url = source_url.replace('http://', f"http://{credentials}@")
-            elif source_url.startswith('https://'):
-                new_url = source_url.replace('https://', f"https://{credentials}@")
-            
-            source_url = new_url
-            target_url = row['target']
-            repo_folder = os.path.join(save_folder, row['name'])
-
-            logging.info(f"Processing [{row['name']}] repository...")
-
-            if should_clone:
-                # Clone repository if it does not exist
-                if not os.path.exists(repo_folder):
-                    clone_command = f"git clone {source_url} \"{repo_folder}\""
-                    run_command(clone_command)
-                else:
-                    logging.info("Repository already exists, skipping clone.")
-
-                # Add cloud remote
-                remote_add_command = f"git remote add cloud {target_url}"
-                run_command(remote_add_command, cwd=repo_folder)
-
-            if should_sync_lfs:
-                # Fetch and push LFS files
-                logging.info("Fetching LFS files...")
-                run_command("git lfs fetch --all", cwd=repo_folder)
-                logging.info("Pushing LFS files...")
-                run_command("git lfs push --all cloud", cwd=repo_folder)
+        rows = list(csv.DictReader(csvfile, delimiter=','))
+
+    # In dedupe mode each fork network is one unit of work, otherwise each repository is
+    if dedupe_objects:
+        registry = object_store.NetworkRegistry(shared_root)
+        networks = defaultdict(list)
+        for row in rows:
+            networks[registry.network_of(row['name'], row.get('network') or row['name'])].append(row)
+        units = [(network, lambda members=members: clone_and_sync_network(members, registry)) for network, members in networks.items()]
+    else:
+        units = [(row['name'], lambda row=row: [clone_and_sync_repo(row)]) for row in rows]
+
+    failed = 0
+    outcomes = []
+    with open(results_csv, 'w', newline='', encoding='utf-8') as results_file, \
+            ThreadPoolExecutor(max_workers=workers['sync_repos']) as executor:
+        writer = csv.DictWriter(results_file, fieldnames=results_fields, extrasaction='ignore')
+        writer.writeheader()
+        futures = {executor.submit(unit): name for name, unit in units}
+        for future in as_completed(futures):
+            try:
+                unit_outcomes = future.result()
+            except Exception as e:
+                logging.exception(f"Error processing [{futures[future]}]")
+                unit_outcomes = [{'name': futures[future], 'status': 'failed', 'exit_code': -1, 'failed_step': str(e)}]
+            for outcome in unit_outcomes:
+                if outcome['status'] not in ('ok', 'skipped'):
+                    failed += 1
+                writer.writerow(outcome)
+            outcomes.extend(unit_outcomes)
+            results_file.flush()
+
+    logging.info(f"Processed {len(rows)} repositories, {failed} failed. Outcomes written to {results_csv}")
+    ledger.load().log_stats()
+    if dedupe_objects:
+        log_dedupe_savings(outcomes)
 
 # Main execution
 if __name__ == "__main__":
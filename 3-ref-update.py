@@ -1,9 +1,15 @@
+import argparse
 import csv
+import fnmatch
 import os
 import re
 import subprocess
+import time
 import logging
-from config import cloud, on_prem, repository_folder
+import git_mirror
+import ledger
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from config import cloud, on_prem, repository_folder, use_mirrors
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -11,9 +17,15 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Configuration Variables - Customize these as needed
 script_location = os.path.dirname(os.path.abspath(__file__))
 input_csv = os.path.join(script_location, "merged_repositories.csv")  # Adjusted for script location
-folder = os.getcwd()  # Folder containing the repositories
+folder = script_location  # Folder containing the repository folder, where 2-clone-repos-with-lfs.py clones the repositories
+results_csv = os.path.join(script_location, "ref_update_results.csv")  # One result record per repository
 
 should_push = True  # Whether to push changes to the remote repository
+max_file_size = 1024 * 1024  # Files larger than this (in bytes) are not scanned
+rewrite_history = False  # Rewrite the tip of every selected branch in the object database instead of the checked-out tree (always on for mirrors)
+history_branches = ['*']  # Branch name patterns rewritten in history mode
+history_ref_prefix = 'refs/ref-update/'  # Where history mode keeps its rewritten commits before pushing them
+commit_message = "Update domain references"
 
 def run_command(command, cwd=None):
     """Execute a system command with optional working directory."""
@@ -23,65 +35,347 @@ def run_command(command, cwd=None):
     except subprocess.CalledProcessError as e:
         logging.error(f"Error executing command: {' '.join(command)}\n{e.stdout.decode()}")
 
-def replace_references_in_file(filepath, patterns):
-    """Replace patterns in a file based on provided mappings."""
+def list_tracked_text_files(repo_folder):
+    """List the tracked files of the repository from the git index, leaving out the ones git sees as binary."""
+    output = subprocess.run(["git", "ls-files", "-z", "--eol"], cwd=repo_folder, check=True, capture_output=True).stdout
+    for entry in output.split(b"\0"):
+        if not entry:
+            continue
+        info, _, path = entry.partition(b"\t")
+        if info.startswith(b"i/-text"):
+            continue
+        filepath = os.path.join(repo_folder, os.fsdecode(path))
+        if not os.path.islink(filepath):
+            yield filepath
+
+def replace_references_in_file(filepath, patterns, literal):
+    """
+    Replace patterns in a file based on provided mappings.
+
+    Files without the literal (the on-prem domain) are skipped before any regex runs, and the
+    file is only rewritten when a substitution changed it. Returns the number of bytes written.
+    """
     if not os.path.exists(filepath):
         logging.warning(f"File not found: {filepath}")
-        return
+        return 0
 
     try:
-        with open(filepath, "r", encoding="utf-8") as file:
-            data = file.read()
-        if data: 
-            for pattern, subst in patterns.items():
-                data = re.sub(pattern, subst, data, 0, re.MULTILINE)
-
-            with open(filepath, "w") as file:
-                file.write(data)
-            logging.info(f"Updated references in file: {filepath}")
+        if os.path.getsize(filepath) > max_file_size:
+            return 0
+        with open(filepath, "rb") as file:
+            raw = file.read()
+        if literal not in raw or b"\0" in raw:
+            return 0
+
+        data = raw.decode("utf-8")
+        for pattern, subst in patterns:
+            data = pattern.sub(subst, data)
+
+        updated = data.encode("utf-8")
+        if updated == raw:
+            return 0
+        with open(filepath, "wb") as file:
+            file.write(updated)
+        logging.info(f"Updated references in file: {filepath}")
+        return len(updated)
+    except UnicodeDecodeError:
+        return 0
     except Exception as e:
         logging.exception(f"Error processing file: {filepath}")
+        return 0
 
 def commit_and_push_changes(repo_folder, branch="master"):
-    """Commit changes in the repository and push them to the cloud."""
+    """Commit changes in the repository and push them to the cloud. Returns the push status."""
     try:
         # Check for uncommitted changes
         status_output = subprocess.check_output(["git", "status", "--porcelain"], cwd=repo_folder).decode().strip()
         if status_output:
-            # Stage all changes
-            subprocess.run(["git", "add", "."], cwd=repo_folder, check=True)
+            # Stage the rewritten tracked files
+            subprocess.run(["git", "add", "-u"], cwd=repo_folder, check=True)
             # Commit changes
             subprocess.run(["git", "commit", "-m", "Update domain references"], cwd=repo_folder, check=True)
             # Push changes
             subprocess.run(["git", "push", "cloud", branch], cwd=repo_folder, check=True)
             logging.info(f"Changes pushed for {os.path.basename(repo_folder)}.")
-        else:
-            logging.info(f"No changes to commit for {os.path.basename(repo_folder)}.")
+            return 'ok'
+        logging.info(f"No changes to commit for {os.path.basename(repo_folder)}.")
+        return 'skipped'
     except subprocess.CalledProcessError as e:
         logging.error(f"Error processing {os.path.basename(repo_folder)}: {e}")
+        return 'failed'
 
 def process_repository(repo_folder, patterns):
-    """Process files in a repository folder to replace references and commit changes."""
-    for root, _, files in os.walk(repo_folder):
-        for name in files:
-            filepath = os.path.join(root, name)
-            replace_references_in_file(filepath, patterns)
+    """Process the tracked files of a repository to replace references and commit changes."""
+    literal = on_prem['domain'].encode("utf-8")
+    stats = {'files_scanned': 0, 'files_changed': 0, 'bytes_rewritten': 0, 'push_status': 'skipped'}
+    try:
+        for filepath in list_tracked_text_files(repo_folder):
+            stats['files_scanned'] += 1
+            written = replace_references_in_file(filepath, patterns, literal)
+            if written:
+                stats['files_changed'] += 1
+                stats['bytes_rewritten'] += written
+    except (subprocess.CalledProcessError, OSError) as e:
+        logging.error(f"Unable to list files of {repo_folder}: {e}")
+        return stats
 
+    logging.info(f"Scanned {stats['files_scanned']} files in {os.path.basename(repo_folder)}, {stats['files_changed']} changed.")
     if should_push:
-        commit_and_push_changes(repo_folder)
+        stats['push_status'] = commit_and_push_changes(repo_folder)
+    return stats
 
-def main():
+def selected_branches(repo_folder):
+    """
+    Branch name -> tip commit of the branches to rewrite. A bare mirror has the server branches
+    under refs/heads, a working clone has them under refs/remotes/origin.
+    """
+    is_bare = subprocess.run(["git", "rev-parse", "--is-bare-repository"], cwd=repo_folder, check=True, capture_output=True, text=True).stdout.strip() == "true"
+    namespace = "refs/heads/" if is_bare else "refs/remotes/origin/"
+    output = subprocess.run(["git", "for-each-ref", "--format=%(objectname) %(refname)", namespace], cwd=repo_folder, check=True, capture_output=True, text=True).stdout
+    branches = {}
+    for line in output.splitlines():
+        tip, ref = line.split(" ", 1)
+        name = ref[len(namespace):]
+        if name != "HEAD" and any(fnmatch.fnmatch(name, pattern) for pattern in history_branches):
+            branches[name] = tip
+    return branches
+
+class BlobReader:
+    """Streams blob contents out of the object database through a single `git cat-file --batch`."""
+
+    def __init__(self, repo_folder):
+        self.process = subprocess.Popen(["git", "cat-file", "--batch"], cwd=repo_folder, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, blob):
+        self.process.stdin.write(f"{blob}\n".encode())
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) < 3 or header[1] != b"blob":
+            return None
+        data = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1)  # Trailing newline
+        return data
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+def previous_rewrites(repo_folder):
+    """Branch ref -> the rewrite commit an earlier run left under history_ref_prefix."""
+    output = subprocess.run(["git", "for-each-ref", "--format=%(objectname) %(refname)", history_ref_prefix], cwd=repo_folder, check=True, capture_output=True, text=True).stdout
+    rewrites = {}
+    for line in output.splitlines():
+        commit, ref = line.split(" ", 1)
+        rewrites[f"refs/heads/{ref[len(history_ref_prefix):]}"] = commit
+    return rewrites
+
+def rewrite_leases(repo_folder, previous, refs):
+    """
+    --force-with-lease options for the branches whose Cloud tip is still the rewrite commit of an
+    earlier run. The new rewrite commit sits on the current server tip instead of on that commit, so
+    it replaces it; a branch someone else pushed to since is left to fail as non-fast-forward.
+    """
+    refs = [ref for ref in refs if ref in previous]
+    if not refs:
+        return []
+    listing = subprocess.run(["git", "ls-remote", "cloud", *refs], cwd=repo_folder, capture_output=True, text=True)
+    if listing.returncode != 0:
+        return []
+    cloud_tips = {ref: commit for commit, ref in (line.split("\t", 1) for line in listing.stdout.splitlines() if line)}
+    return [f"--force-with-lease={ref}:{previous[ref]}" for ref in refs if cloud_tips.get(ref) == previous[ref]]
+
+def rewrite_branch_tips(repo_folder, patterns):
+    """
+    Rewrite the server references on the tip of every selected branch without checking anything out.
+
+    One `git grep` over all branch tips finds the candidate files, their blobs are streamed through
+    `git cat-file --batch` and rewritten once per distinct blob, and a single `git fast-import` run
+    writes the new blobs plus one commit per changed branch under history_ref_prefix. All updated
+    branches then go to Cloud in one push.
+    """
+    literal = on_prem['domain']
+    stats = {'files_scanned': 0, 'files_changed': 0, 'bytes_rewritten': 0, 'branches_changed': 0, 'push_status': 'skipped'}
+    try:
+        branches = selected_branches(repo_folder)
+        tips = sorted(set(branches.values()))
+        if not tips:
+            return stats
+
+        # Candidate files per tip: tracked text files containing the domain
+        grep = subprocess.run(["git", "grep", "-z", "-l", "-I", "-F", "-e", literal, *tips], cwd=repo_folder, capture_output=True)
+        if grep.returncode not in (0, 1):
+            logging.error(f"git grep failed in {repo_folder}: {grep.stderr.decode(errors='replace')}")
+            return stats
+        candidates = {}
+        for entry in grep.stdout.split(b"\0"):
+            if entry:
+                candidates.setdefault(entry[:40].decode(), []).append(entry[41:])
+
+        # Rewrite each distinct blob once, whichever branches share it
+        reader = BlobReader(repo_folder)
+        rewritten = {}  # blob -> new content, or None when unchanged
+        changes = {}  # tip -> [(mode, blob, path)]
+        try:
+            for tip, paths in candidates.items():
+                listing = b""
+                for start in range(0, len(paths), 500):
+                    batch = [os.fsdecode(path) for path in paths[start:start + 500]]
+                    listing += subprocess.run(["git", "--literal-pathspecs", "ls-tree", "-r", "-z", "--long", tip, "--", *batch], cwd=repo_folder, check=True, capture_output=True).stdout
+                for entry in listing.split(b"\0"):
+                    if not entry:
+                        continue
+                    info, _, path = entry.partition(b"\t")
+                    mode, kind, blob, size = info.decode().split()
+                    if kind != "blob" or mode == "120000" or int(size) > max_file_size:
+                        continue
+                    stats['files_scanned'] += 1
+                    if blob not in rewritten:
+                        rewritten[blob] = None
+                        raw = reader.read(blob)
+                        try:
+                            data = raw.decode("utf-8")
+                        except (AttributeError, UnicodeDecodeError):
+                            continue
+                        for pattern, subst in patterns:
+                            data = pattern.sub(subst, data)
+                        updated = data.encode("utf-8")
+                        if updated != raw:
+                            rewritten[blob] = updated
+                    if rewritten[blob] is not None:
+                        changes.setdefault(tip, []).append((mode, blob, path))
+                        stats['files_changed'] += 1
+        finally:
+            reader.close()
+
+        if not changes:
+            logging.info(f"No references to update on {len(branches)} branches of {os.path.basename(repo_folder)}.")
+            return stats
+
+        # One fast-import stream: every rewritten blob once, then one commit per changed branch
+        committer = subprocess.run(["git", "var", "GIT_COMMITTER_IDENT"], cwd=repo_folder, capture_output=True, text=True).stdout.strip()
+        if not committer:
+            committer = f"Bitbucket Migration <migration@localhost> {int(time.time())} +0000"
+        stream = bytearray()
+        marks = {}
+        for blob, updated in rewritten.items():
+            if updated is not None:
+                marks[blob] = len(marks) + 1
+                stream += f"blob\nmark :{marks[blob]}\ndata {len(updated)}\n".encode() + updated + b"\n"
+                stats['bytes_rewritten'] += len(updated)
+        refspecs = []
+        message = commit_message.encode()
+        for name, tip in sorted(branches.items()):
+            if tip not in changes:
+                continue
+            ref = f"{history_ref_prefix}{name}"
+            stream += f"commit {ref}\ncommitter {committer}\ndata {len(message)}\n".encode() + message + f"\nfrom {tip}\n".encode()
+            for mode, blob, path in changes[tip]:
+                stream += f"M {mode} :{marks[blob]} ".encode() + path + b"\n"
+            stream += b"\n"
+            refspecs.append(f"{ref}:refs/heads/{name}")
+        stats['branches_changed'] = len(refspecs)
+
+        previous = previous_rewrites(repo_folder)
+        subprocess.run(["git", "fast-import", "--quiet", "--force"], cwd=repo_folder, input=bytes(stream), check=True, capture_output=True)
+        logging.info(f"Rewrote {stats['files_changed']} files on {len(refspecs)} of {len(branches)} branches of {os.path.basename(repo_folder)}.")
+
+        if should_push:
+            leases = rewrite_leases(repo_folder, previous, [refspec.split(":", 1)[1] for refspec in refspecs])
+            push = subprocess.run(["git", "push", *leases, "cloud", *refspecs], cwd=repo_folder, capture_output=True, text=True)
+            stats['push_status'] = 'ok' if push.returncode == 0 else 'failed'
+            if push.returncode != 0:
+                logging.error(f"Error pushing {os.path.basename(repo_folder)}: {push.stderr}")
+            else:
+                logging.info(f"Changes pushed for {os.path.basename(repo_folder)} ({len(refspecs)} branches).")
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error processing {os.path.basename(repo_folder)}: {e.stderr.decode(errors='replace') if isinstance(e.stderr, bytes) else e.stderr}")
+        stats['push_status'] = 'failed'
+    except OSError as e:
+        # A missing repository folder (git cannot be started in it) fails the repository, not the run
+        logging.error(f"Error processing {os.path.basename(repo_folder)}: {e}")
+        stats['push_status'] = 'failed'
+    return stats
+
+def build_patterns():
     patterns = {
         rf"(ssh://git@{on_prem['domain']}/)(?:.*)/(?P<repository>.*\.git)": f"git@bitbucket.org:{cloud['workspace']}/\\g<repository>",
         rf"(http?://{on_prem['domain']})(?:.*)/(?P<repository>.*\.git)": f"https://bitbucket.org/{cloud['workspace']}/\\g<repository>"
     }
+    return [(re.compile(pattern, re.MULTILINE), subst) for pattern, subst in patterns.items()]
+
+def refs_state(repo_folder, patterns):
+    """Hash of the repository's refs and of the rewrite applied to them, or None if they cannot be read."""
+    refs = subprocess.run(["git", "for-each-ref", "--format=%(objectname) %(refname)"], cwd=repo_folder, capture_output=True, text=True)
+    head = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_folder, capture_output=True, text=True)
+    if refs.returncode != 0:
+        return None
+    return ledger.content_hash(refs.stdout, head.stdout, [(pattern.pattern, subst) for pattern, subst in patterns],
+                               use_mirrors, rewrite_history, history_branches, should_push)
+
+def update_repository(name):
+    """Update the references of one repository; runs in a worker process and returns its result record."""
+    logging.info(f"Processing repository: {name}")
+    patterns = build_patterns()
+    if use_mirrors:
+        repo_folder = git_mirror.mirror_path(os.path.join(folder, repository_folder), name)
+    else:
+        repo_folder = os.path.join(folder, repository_folder, name)
+
+    # The refs a completed update leaves behind are recorded, so an unchanged repository is skipped on a rerun
+    units = ledger.load()
+    state = refs_state(repo_folder, patterns) if units.enabled and os.path.isdir(repo_folder) else None
+    if state and units.is_done('ref_update', name, state):
+        units.skip('ref_update')
+        logging.info(f"{name} has not changed since its last completed update, skipping it")
+        return {'name': name, 'files_scanned': 0, 'files_changed': 0, 'bytes_rewritten': 0, 'push_status': 'unchanged'}
+    if state:
+        units.start('ref_update', name, state)
+
+    if use_mirrors or rewrite_history:
+        stats = rewrite_branch_tips(repo_folder, patterns)
+    else:
+        stats = process_repository(repo_folder, patterns)
+
+    if state:
+        ok = stats['push_status'] != 'failed'
+        units.finish('ref_update', name, refs_state(repo_folder, patterns) if ok else state, ok, None if ok else 'push failed')
+    return {'name': name, **stats}
+
+def main():
+    parser = argparse.ArgumentParser(description="Update Bitbucket Server references to Bitbucket Cloud in the cloned repositories.")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Repositories processed in parallel (default: number of cores)")
+    args = parser.parse_args()
 
     with open(input_csv, newline='') as csvfile:
-        reader = csv.DictReader(csvfile, delimiter=',')
-        for row in reader:
-            repo_folder = os.path.join(folder, repository_folder, row['name'])
-            logging.info(f"Processing repository: {row['name']}")
-            process_repository(repo_folder, patterns)
+        names = [row['name'] for row in csv.DictReader(csvfile, delimiter=',')]
+
+    fields = ['name', 'files_scanned', 'files_changed', 'bytes_rewritten', 'branches_changed', 'push_status']
+    totals = {'files_scanned': 0, 'files_changed': 0, 'bytes_rewritten': 0}
+    failed = unchanged = 0
+    with open(results_csv, 'w', newline='', encoding='utf-8') as results_file, \
+            ProcessPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        writer = csv.DictWriter(results_file, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        futures = {executor.submit(update_repository, name): name for name in names}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception:
+                logging.exception(f"Error processing [{futures[future]}]")
+                result = {'name': futures[future], 'files_scanned': 0, 'files_changed': 0, 'bytes_rewritten': 0, 'push_status': 'failed'}
+            writer.writerow(result)
+            for key in totals:
+                totals[key] += result[key]
+            if result['push_status'] == 'failed':
+                failed += 1
+            elif result['push_status'] == 'unchanged':
+                unchanged += 1
+
+    logging.info(
+        f"Processed {len(names)} repositories with {args.jobs} jobs: {totals['files_scanned']} files scanned, "
+        f"{totals['files_changed']} changed, {totals['bytes_rewritten']} bytes rewritten, {failed} pushes failed, {unchanged} unchanged since their last update. "
+        f"Results written to {results_csv}"
+    )
 
 if __name__ == "__main__":
     main()
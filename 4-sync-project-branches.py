@@ -1,15 +1,18 @@
     
 import csv
-import requests
-from requests.auth import HTTPBasicAuth
 import logging
 import json
 import os
-from config import cloud, on_prem  # Import authorization configurations
+from concurrent.futures import ThreadPoolExecutor
+import client
+from config import cloud, on_prem, workers  # Import authorization configurations
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
 
+reconcile = True  # Compare with each repository's current settings and only send the calls that change something
+prune_restrictions = False  # In reconcile mode, also delete restrictions that are not part of the desired policy
+
 def extract_repo_slug(target_url):
     # Convert the target URL into a repository slug
     if target_url.endswith('.git'):
@@ -21,33 +24,162 @@ def extract_repo_slug(target_url):
 
 def update_branch_model(repo_slug, branch_model_settings):
     """ Update the branch model settings for a repository. """
-    url = f"https://api.bitbucket.org/2.0/repositories/{cloud['workspace']}/{repo_slug}/branching-model/settings"
-    response = requests.put(
+    url = f"{client.cloud_api}/2.0/repositories/{cloud['workspace']}/{repo_slug}/branching-model/settings"
+    response = client.put(
         url,
         json=branch_model_settings,
-        auth=HTTPBasicAuth(cloud['username'], cloud['token']),
         headers={"Accept": "application/json"}
     )
     if response.status_code == 200:
         logging.info(f"Branch model updated successfully for {repo_slug}")
     else:
         logging.error(f"Failed to update branch model for {repo_slug}: {response.status_code} {response.text}")
+    return response.status_code == 200
 
 def update_branch_restrictions(repo_slug, branch_restrictions_payload):
     """ Update the branch restrictions for a repository. """
-    url = f"https://api.bitbucket.org/2.0/repositories/{cloud['workspace']}/{repo_slug}/branch-restrictions"
-    response = requests.post(
+    url = f"{client.cloud_api}/2.0/repositories/{cloud['workspace']}/{repo_slug}/branch-restrictions"
+    response = client.post(
         url,
         json=branch_restrictions_payload,
-        auth=HTTPBasicAuth(cloud['username'], cloud['token']),
         headers={"Accept": "application/json"}
     )
     if response.status_code in [200, 201]:
         logging.info(f"Branch restrictions updated successfully for {repo_slug}")
     else:
         logging.error(f"Failed to update branch restrictions for {repo_slug}: {response.status_code} {response.text}")
+    return response.status_code in [200, 201]
 
-def main():
+def replace_branch_restriction(repo_slug, restriction_id, branch_restrictions_payload):
+    """ Update an existing branch restriction of a repository. """
+    url = f"{client.cloud_api}/2.0/repositories/{cloud['workspace']}/{repo_slug}/branch-restrictions/{restriction_id}"
+    response = client.put(url, json=branch_restrictions_payload, headers={"Accept": "application/json"})
+    if response.status_code == 200:
+        logging.info(f"Branch restriction {restriction_id} updated for {repo_slug}")
+    else:
+        logging.error(f"Failed to update branch restriction {restriction_id} for {repo_slug}: {response.status_code} {response.text}")
+    return response.status_code == 200
+
+def delete_branch_restriction(repo_slug, restriction_id):
+    """ Delete a branch restriction of a repository. """
+    url = f"{client.cloud_api}/2.0/repositories/{cloud['workspace']}/{repo_slug}/branch-restrictions/{restriction_id}"
+    response = client.delete(url)
+    if response.status_code == 204:
+        logging.info(f"Branch restriction {restriction_id} deleted for {repo_slug}")
+    else:
+        logging.error(f"Failed to delete branch restriction {restriction_id} for {repo_slug}: {response.status_code} {response.text}")
+    return response.status_code == 204
+
+def get_branch_model(repo_slug):
+    """ Fetch the current branch model settings of a repository, or None if they cannot be read. """
+    url = f"{client.cloud_api}/2.0/repositories/{cloud['workspace']}/{repo_slug}/branching-model/settings"
+    response = client.get(url, headers={"Accept": "application/json"})
+    if response.status_code == 200:
+        return response.json()
+    logging.error(f"Failed to fetch branch model for {repo_slug}: {response.status_code} {response.text}")
+    return None
+
+def get_branch_restrictions(repo_slug):
+    """ Fetch every branch restriction of a repository, or None if they cannot be read. """
+    url = f"{client.cloud_api}/2.0/repositories/{cloud['workspace']}/{repo_slug}/branch-restrictions?pagelen=100"
+    restrictions = []
+    while url:
+        response = client.get(url, headers={"Accept": "application/json"})
+        if response.status_code != 200:
+            logging.error(f"Failed to fetch branch restrictions for {repo_slug}: {response.status_code} {response.text}")
+            return None
+        data = response.json()
+        restrictions.extend(data.get('values', []))
+        url = data.get('next')
+    return restrictions
+
+def settings_match(current, desired):
+    """ True when every value in desired is already set in current. Lists of dicts are matched by their 'kind'. """
+    if isinstance(desired, dict):
+        return isinstance(current, dict) and all(settings_match(current.get(key), value) for key, value in desired.items())
+    if isinstance(desired, list) and all(isinstance(item, dict) and 'kind' in item for item in desired):
+        current_by_kind = {item.get('kind'): item for item in current or [] if isinstance(item, dict)}
+        return all(settings_match(current_by_kind.get(item['kind']), item) for item in desired)
+    return current == desired
+
+def restriction_key(restriction):
+    """ A restriction is identified by its kind and the branches it applies to. """
+    return (
+        restriction.get('kind'),
+        restriction.get('branch_match_kind', 'glob'),
+        restriction.get('pattern') if restriction.get('branch_match_kind', 'glob') == 'glob' else restriction.get('branch_type'),
+    )
+
+def plan_branch_restrictions(current, desired):
+    """
+    Diff the current restrictions against the desired ones.
+    Returns (creates, updates, deletes): payloads to POST, (id, payload) pairs to PUT and ids to DELETE.
+    """
+    current_by_key = {}
+    for restriction in current:
+        current_by_key.setdefault(restriction_key(restriction), []).append(restriction)
+
+    creates, updates, deletes = [], [], []
+    desired_keys = set()
+    for payload in desired:
+        key = restriction_key(payload)
+        desired_keys.add(key)
+        existing = current_by_key.get(key, [])
+        if not existing:
+            creates.append(payload)
+            continue
+        keep = next((restriction for restriction in existing if settings_match(restriction, payload)), None)
+        if keep is None:
+            keep = existing[0]
+            updates.append((keep['id'], payload))
+        # Duplicates left behind by earlier blind runs
+        deletes.extend(restriction['id'] for restriction in existing if restriction is not keep)
+
+    if prune_restrictions:
+        for key, existing in current_by_key.items():
+            if key not in desired_keys:
+                deletes.extend(restriction['id'] for restriction in existing)
+    return creates, updates, deletes
+
+def reconcile_repository(repo_slug, branch_model_settings, branch_restrictions):
+    """ Bring a repository to the desired branch model and restrictions with as few calls as possible. """
+    try:
+        return reconcile_repository_settings(repo_slug, branch_model_settings, branch_restrictions)
+    except Exception as e:
+        logging.exception(f"Error reconciling branch settings for {repo_slug}")
+        return {'reads': 0, 'writes': 0, 'failed': 1}
+
+def reconcile_repository_settings(repo_slug, branch_model_settings, branch_restrictions):
+    calls = {'reads': 0, 'writes': 0, 'failed': 0}
+
+    current_model = get_branch_model(repo_slug)
+    current_restrictions = get_branch_restrictions(repo_slug)
+    calls['reads'] += 2
+    if current_model is None or current_restrictions is None:
+        calls['failed'] += 1
+        return calls
+
+    if not settings_match(current_model, branch_model_settings):
+        calls['writes'] += 1
+        calls['failed'] += not update_branch_model(repo_slug, branch_model_settings)
+
+    creates, updates, deletes = plan_branch_restrictions(current_restrictions, branch_restrictions)
+    for payload in creates:
+        calls['writes'] += 1
+        calls['failed'] += not update_branch_restrictions(repo_slug, payload)
+    for restriction_id, payload in updates:
+        calls['writes'] += 1
+        calls['failed'] += not replace_branch_restriction(repo_slug, restriction_id, payload)
+    for restriction_id in deletes:
+        calls['writes'] += 1
+        calls['failed'] += not delete_branch_restriction(repo_slug, restriction_id)
+
+    if not calls['writes']:
+        logging.info(f"Branch model and restrictions already up to date for {repo_slug}")
+    return calls
+
+def branch_policy():
+    """ The branch model settings and branch restrictions every repository is brought to. """
     # Load branch model settings from a file or define them here
     branch_model_settings = {
         "development": {
@@ -114,16 +246,44 @@ def main():
     }
     
 
+    branch_restrictions = [branch_restriction_1, branch_restriction_2]
+    return branch_model_settings, branch_restrictions
+
+def main():
+    branch_model_settings, branch_restrictions = branch_policy()
     merged_repositories_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'merged_repositories.csv')
 
+    repo_slugs = []
     with open(merged_repositories_path, mode='r', newline='') as file:
         csv_reader = csv.DictReader(file)
         for row in csv_reader:
             if row['match'].lower() == 'yes':
                 repo_slug = extract_repo_slug(row['target'])
                 if repo_slug:
-                    update_branch_model(repo_slug, branch_model_settings)
-                    update_branch_restrictions(repo_slug, branch_restriction_1)
-                    update_branch_restrictions(repo_slug, branch_restriction_2)
+                    repo_slugs.append(repo_slug)
+
+    if not reconcile:
+        for repo_slug in repo_slugs:
+            update_branch_model(repo_slug, branch_model_settings)
+            for branch_restriction in branch_restrictions:
+                update_branch_restrictions(repo_slug, branch_restriction)
+        client.log_stats()
+        return
+
+    totals = {'reads': 0, 'writes': 0, 'failed': 0}
+    with ThreadPoolExecutor(max_workers=workers['branch_sync']) as executor:
+        for calls in executor.map(lambda repo_slug: reconcile_repository(repo_slug, branch_model_settings, branch_restrictions), repo_slugs):
+            for key in totals:
+                totals[key] += calls[key]
+
+    # A blind run sends one model PUT plus one POST per restriction for every repository
+    blind_writes = len(repo_slugs) * (1 + len(branch_restrictions))
+    logging.info(
+        f"Reconciled {len(repo_slugs)} repositories: {totals['writes']} writes sent, "
+        f"{max(blind_writes - totals['writes'], 0)} of {blind_writes} blind writes avoided, "
+        f"{totals['reads']} reads, {totals['failed']} failures"
+    )
+    client.log_stats()
+
 if __name__ == "__main__":
     main()
@@ -1,10 +1,12 @@
-from requests.auth import HTTPBasicAuth
+import asyncio
 import csv
 import json
 import os
-import requests
 import logging
-from config import cloud, on_prem
+import async_client
+import client
+import user_directory
+from config import cloud, on_prem, workers
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
@@ -15,11 +17,10 @@ user_file = os.path.join(script_location, "bitbucket_users_match.csv")
 input_file = on_prem['bitbucket_server_repositories']
 
 # Function to get server reviewer
-def get_server_reviewer(project_key, repo_slug):
+async def get_server_reviewer(engine, project_key, repo_slug):
     try:
-        response = requests.get(
+        response = await engine.get(
             f"{on_prem['base_url']}/rest/default-reviewers/latest/projects/{project_key}/repos/{repo_slug}/conditions",
-            auth=HTTPBasicAuth(on_prem['username'], on_prem['password']),  # Authentication setup
             headers={"Accept": "application/json"}  # Request headers
         )
         if response.status_code == 200:
@@ -32,12 +33,10 @@ def get_server_reviewer(project_key, repo_slug):
         return []
 
 # Function to add cloud reviewer
-def add_cloud_reviewer(workspace, repo_slug, username):
+async def add_cloud_reviewer(engine, workspace, repo_slug, username):
     try:
-        response = requests.request(
-            "PUT",
-            f"https://api.bitbucket.org/2.0/repositories/{workspace}/{repo_slug}/default-reviewers/{username}",
-            auth=HTTPBasicAuth(cloud['username'], cloud['token']),  # Authentication setup
+        response = await engine.put(
+            f"{client.cloud_api}/2.0/repositories/{workspace}/{repo_slug}/default-reviewers/{username}",
             headers={"Accept": "application/json"}  # Request headers
         )
         return response
@@ -45,41 +44,94 @@ def add_cloud_reviewer(workspace, repo_slug, username):
         logging.exception(f"Error adding cloud reviewer for {repo_slug}")
         return None
 
+# Function to get the default reviewers already set on cloud, as a set of UUIDs (None if they cannot be read)
+async def get_cloud_reviewers(engine, workspace, repo_slug):
+    try:
+        values = await engine.cloud_values(f"{client.cloud_api}/2.0/repositories/{workspace}/{repo_slug}/default-reviewers?pagelen=100")
+        if values is None:
+            return None
+        return {normalize_uuid(user['uuid']) for user in values if user.get('uuid')}
+    except Exception as e:
+        logging.exception(f"Error fetching cloud reviewers for {repo_slug}")
+        return None
+
+def normalize_uuid(uuid):
+    return uuid.strip('{}').lower()
+
 # Main function to copy server reviewers to cloud
-def copy_server_reviewers_to_cloud(project_key, repository_slug, workspace, user_map):
-    reviewer_config_list = get_server_reviewer(project_key, repository_slug)
+async def copy_server_reviewers_to_cloud(engine, project_key, repository_slug, workspace, users):
+    """ Add the server's default reviewers of a repository to cloud, each once and only when missing there. """
+    counts = {'reviewers': 0, 'added': 0, 'skipped': 0, 'failed': 0}
+    reviewer_config_list = await get_server_reviewer(engine, project_key, repository_slug)
+
+    # The same reviewer often appears in several conditions, keep each one once
+    wanted = {}
     for config in reviewer_config_list:
         for reviewer in config['reviewers']:
-            key = str(reviewer['id'])
-            if key not in user_map:
+            counts['reviewers'] += 1
+            user_data = users.by_server_id(reviewer['id'])
+            if user_data is None:
                 logging.warning(f"Unable to add {reviewer['displayName']} to {repository_slug}, missing user on server.")
                 continue
 
-            user_data = user_map.get(key)
-            if 'cloud_uuid' not in user_data:
+            if not user_data.cloud_uuid:
                 logging.warning(f"Unable to add {reviewer['displayName']} to {repository_slug}, missing user on cloud.")
                 continue
 
-            response = add_cloud_reviewer(workspace, repository_slug, user_data['cloud_uuid'])
-            if response and response.ok:
-                logging.info(f"{reviewer['displayName']} added to {repository_slug} ({response.status_code})")
-            else:
-                logging.error(f"Failed to add {reviewer['displayName']} to {repository_slug}. Error: {response.text if response else 'No response'}")
-
-# Loading the user map from the CSV file
-def load_user_map(user_file):
-    user_map = {}
-    with open(user_file) as f:
-        reader = csv.DictReader(f, delimiter=",")
-        for row in reader:
-            user_map[row['server_id']] = row
-    return user_map
-
-# Load user map and process each repository from the input CSV
+            wanted.setdefault(normalize_uuid(user_data.cloud_uuid), (user_data.cloud_uuid, reviewer['displayName']))
+
+    if not wanted:
+        counts['skipped'] = counts['reviewers']
+        return counts
+
+    existing = await get_cloud_reviewers(engine, workspace, repository_slug)
+    if existing is None:
+        logging.warning(f"Adding every reviewer to {repository_slug}, the cloud reviewers could not be read.")
+        existing = set()
+
+    missing = [(cloud_uuid, display_name) for key, (cloud_uuid, display_name) in wanted.items() if key not in existing]
+    responses = await asyncio.gather(*(add_cloud_reviewer(engine, workspace, repository_slug, cloud_uuid) for cloud_uuid, _ in missing))
+    for (cloud_uuid, display_name), response in zip(missing, responses):
+        if response and response.ok:
+            counts['added'] += 1
+            logging.info(f"{display_name} added to {repository_slug} ({response.status_code})")
+        else:
+            counts['failed'] += 1
+            logging.error(f"Failed to add {display_name} to {repository_slug}. Error: {response.text if response else 'No response'}")
+
+    counts['skipped'] = counts['reviewers'] - counts['added'] - counts['failed']
+    if not counts['added'] and not counts['failed']:
+        logging.info(f"Default reviewers already up to date for {repository_slug}")
+    return counts
+
+async def sync_repository(engine, row, users):
+    logging.info(f"Copying server reviewers to cloud for project {row['project_key']} and repository {row['slug']}")
+    try:
+        return await copy_server_reviewers_to_cloud(engine, row['project_key'], row['slug'], cloud['workspace'], users)
+    except Exception as e:
+        logging.exception(f"Error copying reviewers for {row['slug']}")
+        return {'reviewers': 0, 'added': 0, 'skipped': 0, 'failed': 1}
+
+async def sync_repositories(engine, rows, users):
+    results = await engine.for_each(rows, lambda row: sync_repository(engine, row, users), concurrency=workers['reviewer_sync'])
+    engine.log_stats()
+    return results
+
+# Load user map and process the repositories from the input CSV on the asyncio engine
 if __name__ == "__main__":
-    user_map = load_user_map(user_file)
+    users = user_directory.load(user_file)
     with open(input_file) as f:
-        reader = csv.DictReader(f, delimiter=",")
-        for row in reader:
-            logging.info(f"Copying server reviewers to cloud for project {row['project_key']} and repository {row['slug']}")
-            copy_server_reviewers_to_cloud(row['project_key'], row['slug'], cloud['workspace'], user_map)
+        rows = list(csv.DictReader(f, delimiter=","))
+
+    totals = {'reviewers': 0, 'added': 0, 'skipped': 0, 'failed': 0}
+    for counts in async_client.run(lambda engine: sync_repositories(engine, rows, users)):
+        for key in totals:
+            totals[key] += counts[key]
+
+    logging.info(
+        f"Synced default reviewers of {len(rows)} repositories: {totals['added']} added, "
+        f"{totals['skipped']} of {totals['reviewers']} reviewer entries skipped (duplicates, unmatched or already on cloud), "
+        f"{totals['failed']} failures"
+    )
+    users.log_stats()
+    client.log_stats()
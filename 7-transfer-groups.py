@@ -1,9 +1,9 @@
 import csv
 import os
-import requests
 import logging
-from requests.auth import HTTPBasicAuth
-from config import cloud
+import client
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import cloud, workers
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
@@ -17,9 +17,8 @@ workspace_id = cloud['workspace']
 # Function to create group in Bitbucket Cloud
 def create_group(workspace_id, group_name):
     try:
-        response = requests.post(
-            f"https://api.bitbucket.org/1.0/groups/{workspace_id}",
-            auth=HTTPBasicAuth(cloud['username'], cloud['token']),  # Authentication setup
+        response = client.post(
+            f"{client.cloud_api}/1.0/groups/{workspace_id}",
             data={"name": group_name}  # Data payload
         )
         return response
@@ -27,6 +26,17 @@ def create_group(workspace_id, group_name):
         logging.exception(f"Failed to create group: {group_name}")
         return None
 
+# Function to get the names of the groups that already exist in the workspace, or None if they cannot be read
+def get_existing_groups(workspace_id):
+    try:
+        response = client.get(f"{client.cloud_api}/1.0/groups/{workspace_id}/")
+        if response.ok:
+            return {group['name'].lower() for group in response.json()}
+        logging.error(f"Failed to fetch existing groups for workspace: {workspace_id}. Response: {response.text}")
+    except Exception as e:
+        logging.exception(f"Failed to fetch existing groups for workspace: {workspace_id}")
+    return None
+
 # Function to load group names from CSV and return a set of unique group names
 def load_unique_groups(file_path):
     unique_groups = set()
@@ -39,17 +49,46 @@ def load_unique_groups(file_path):
         logging.exception("Failed to load unique groups from CSV")
     return unique_groups
 
-# Main function to create groups in Bitbucket Cloud
+# Function to create one group, returning 'created', 'skipped' or 'failed'
+def create_missing_group(workspace_id, group_name):
+    response = create_group(workspace_id, group_name)
+    if response and response.ok:
+        logging.info(f"Successfully created group: {group_name}")
+        return 'created'
+    if response is not None and response.status_code in (400, 409) and 'already exists' in response.text.lower():
+        logging.info(f"Group already exists: {group_name}")
+        return 'skipped'
+    if response is not None:
+        logging.error(f"Failed to create group: {group_name}, Reason: {response.text}")
+    else:
+        logging.error(f"Failed to create group: {group_name}, no response object.")
+    return 'failed'
+
+# Main function to create the groups missing in Bitbucket Cloud
 def create_groups_from_csv(workspace_id, membership_csv):
     unique_groups = load_unique_groups(membership_csv)
-    for group_name in unique_groups:
-        response = create_group(workspace_id, group_name)
-        if response and response.ok:
-            logging.info(f"Successfully created group: {group_name}")
-        elif response:
-            logging.error(f"Failed to create group: {group_name}, Reason: {response.text}")
-        else:
-            logging.error(f"Failed to create group: {group_name}, no response object.")
+    summary = {'created': 0, 'skipped': 0, 'failed': 0}
+
+    # Groups already in the workspace are skipped without a call; if they cannot be read every group is tried
+    existing = get_existing_groups(workspace_id)
+    if existing is None:
+        existing = set()
+    missing = sorted(group_name for group_name in unique_groups if group_name.lower() not in existing)
+    summary['skipped'] = len(unique_groups) - len(missing)
+
+    with ThreadPoolExecutor(max_workers=workers['group_sync']) as executor:
+        futures = {executor.submit(create_missing_group, workspace_id, group_name): group_name for group_name in missing}
+        for future in as_completed(futures):
+            try:
+                summary[future.result()] += 1
+            except Exception as e:
+                logging.exception(f"Failed to create group: {futures[future]}")
+                summary['failed'] += 1
+
+    logging.info(f"Groups: {summary['created']} created, {summary['skipped']} skipped (already in the workspace), {summary['failed']} failed")
+    return summary
 
 # Create groups from CSV file
-create_groups_from_csv(workspace_id, membership_csv)
+if __name__ == "__main__":
+    create_groups_from_csv(workspace_id, membership_csv)
+    client.log_stats()
@@ -1,9 +1,12 @@
 import csv
-import requests
 import os
 import logging
-from requests.auth import HTTPBasicAuth
-from config import cloud
+import client
+import ledger
+import user_directory
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from config import cloud, workers
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -13,74 +16,152 @@ script_location = os.path.dirname(os.path.abspath(__file__))
 users_file = os.path.join(script_location, "bitbucket_users_match.csv")
 membership_csv = os.path.join(script_location, "group-membership.csv")
 
-# Read the 'bitbucket_users_match.csv' and create a mapping from display_name to cloud_uuid
-def create_displayname_to_uuid_map(users_file):
-    displayname_to_uuid_map = {}
-    try:
-        with open(users_file, encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                display_name = row['cloud_display_name']
-                cloud_uuid = row['cloud_uuid']
-                displayname_to_uuid_map[display_name] = cloud_uuid
-    except Exception as e:
-        logging.error(f"Error reading users file {users_file}: {e}")
-    return displayname_to_uuid_map
+remove_members = False  # Set to True to also remove members of the CSV's groups that the CSV does not list
 
-# Get group slugs from Bitbucket API
+# Get group slugs from Bitbucket API, following 'next' links when the listing is paged
 def get_group_slugs(workspace_id):
-    url = f"https://api.bitbucket.org/1.0/groups/{workspace_id}/"
-    auth = HTTPBasicAuth(cloud['username'], cloud['token'])
+    url = f"{client.cloud_api}/1.0/groups/{workspace_id}/"
+    group_slugs = {}
     try:
-        response = requests.get(url, auth=auth)
-        group_slugs = {}
-        if response.ok:
-            for group in response.json():
+        while url:
+            response = client.get(url)
+            if not response.ok:
+                logging.error(f"Failed to fetch group slugs. Response: {response.text}")
+                break
+            data = response.json()
+            groups = data.get('values', []) if isinstance(data, dict) else data
+            for group in groups:
                 group_slugs[group['name']] = group['slug']
-            logging.info(f"Retrieved group slugs for workspace: {workspace_id}")
-        else:
-            logging.error(f"Failed to fetch group slugs. Response: {response.text}")
+            url = data.get('next') if isinstance(data, dict) else None
+        logging.info(f"Retrieved {len(group_slugs)} group slugs for workspace: {workspace_id}")
     except Exception as e:
         logging.error(f"Exception occurred while fetching group slugs: {e}")
     return group_slugs
 
+def normalize_uuid(uuid):
+    return uuid.strip('{}').lower()
+
+# Get the current members of a group as normalized UUID -> UUID, or None if they cannot be read
+def get_group_members(workspace_id, group_slug):
+    try:
+        response = client.get(f"{client.cloud_api}/1.0/groups/{workspace_id}/{group_slug}/members/")
+        if response.ok:
+            return {normalize_uuid(member['uuid']): member['uuid'] for member in response.json() if member.get('uuid')}
+        logging.error(f"Failed to fetch members of group {group_slug}. Response: {response.text}")
+    except Exception as e:
+        logging.error(f"Exception occurred while fetching members of group {group_slug}: {e}")
+    return None
+
 # Function to add a user to a group in Bitbucket Cloud
 def add_user_to_group(workspace_id, group_slug, user_uuid):
     try:
-        response = requests.put(
-            f"https://api.bitbucket.org/1.0/groups/{workspace_id}/{group_slug}/members/{user_uuid}/",
-            auth=HTTPBasicAuth(cloud['username'], cloud['token']),  # Authentication setup
+        response = client.put(
+            f"{client.cloud_api}/1.0/groups/{workspace_id}/{group_slug}/members/{user_uuid}/",
             data='{}'  # Empty data payload as per the API requirement
         )
         if response.ok:
             logging.info(f"Successfully added user {user_uuid} to group {group_slug}")
-        else:
-            logging.warning(f"Failed to add user {user_uuid} to group {group_slug}. Response: {response.text}")
+            return True
+        logging.warning(f"Failed to add user {user_uuid} to group {group_slug}. Response: {response.text}")
     except Exception as e:
         logging.error(f"Exception occurred while adding user to group: {e}")
+    return False
+
+# Function to remove a user from a group in Bitbucket Cloud
+def remove_user_from_group(workspace_id, group_slug, user_uuid):
+    try:
+        response = client.delete(f"{client.cloud_api}/1.0/groups/{workspace_id}/{group_slug}/members/{user_uuid}/")
+        if response.ok:
+            logging.info(f"Successfully removed user {user_uuid} from group {group_slug}")
+            return True
+        logging.warning(f"Failed to remove user {user_uuid} from group {group_slug}. Response: {response.text}")
+    except Exception as e:
+        logging.error(f"Exception occurred while removing user from group: {e}")
+    return False
+
+# Read the membership CSV into group slug -> {normalized UUID: UUID}
+def load_desired_members(membership_csv, users, group_slugs):
+    desired = defaultdict(dict)
+    unresolved = 0
+    with open(membership_csv, encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            display_name = row['display_name']
+            group_name = row['group_name']
+            group_slug = group_slugs.get(group_name)
+            user_uuid = users.cloud_uuid(cloud_display_name=display_name)
+
+            if group_slug and user_uuid:
+                desired[group_slug].setdefault(normalize_uuid(user_uuid), user_uuid)
+            else:
+                unresolved += 1
+                logging.warning(f"Missing group slug or user UUID for {display_name} in group {group_name}.")
+    return desired, unresolved
 
-# Main function to add users to groups based on the CSV files
+# Main function to bring the groups of the CSV to the memberships it lists, sending only the differences
 def add_users_to_groups(workspace_id, users_file, membership_csv, group_slugs):
-    # Create the mapping from display names to UUIDs
-    displayname_to_uuid_map = create_displayname_to_uuid_map(users_file)
-    
+    summary = {'added': 0, 'removed': 0, 'unchanged': 0, 'unresolved': 0, 'failed': 0}
+    try:
+        # Loaded once, every lookup below is a dict access
+        users = user_directory.load(users_file)
+    except Exception as e:
+        logging.error(f"Error reading users file {users_file}: {e}")
+        return summary
+
     try:
-        with open(membership_csv, encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                display_name = row['display_name']
-                group_name = row['group_name']
-                group_slug = group_slugs.get(group_name)
-                user_uuid = displayname_to_uuid_map.get(display_name)
-                
-                if group_slug and user_uuid:
-                    add_user_to_group(workspace_id, group_slug, user_uuid)
-                    logging.info(f"{display_name} added to group {group_slug}")
-                else:
-                    logging.warning(f"Missing group slug or user UUID for {display_name} in group {group_name}.")
+        desired, summary['unresolved'] = load_desired_members(membership_csv, users, group_slugs)
     except Exception as e:
         logging.error(f"Error processing membership CSV: {e}")
+        return summary
+
+    # Groups whose every membership the ledger has as added are neither read nor changed again
+    units = ledger.load()
+    membership_hash = ledger.content_hash(workspace_id)
+    if not remove_members:
+        for group_slug in sorted(desired):
+            if all(units.is_done('membership_add', f"{group_slug}/{key}", membership_hash) for key in desired[group_slug]):
+                units.skip('membership_add', len(desired[group_slug]))
+                summary['unchanged'] += len(desired.pop(group_slug))
+
+    group_list = sorted(desired)
+    with ThreadPoolExecutor(max_workers=workers['membership_sync']) as executor:
+        # Current members of every target group, fetched concurrently
+        current_members = dict(zip(group_list, executor.map(lambda group_slug: get_group_members(workspace_id, group_slug), group_list)))
+
+        changes = []
+        for group_slug in group_list:
+            current = current_members[group_slug]
+            if current is None:
+                # Members unknown: add everyone, as a blind run would, and remove no one
+                current = {}
+            wanted = desired[group_slug]
+            summary['unchanged'] += len(wanted.keys() & current.keys())
+            for key in wanted.keys() & current.keys():
+                units.finish('membership_add', f"{group_slug}/{key}", membership_hash, True, 'already a member')
+            changes.extend((add_user_to_group, group_slug, wanted[key]) for key in wanted.keys() - current.keys())
+            if remove_members and current_members[group_slug] is not None:
+                changes.extend((remove_user_from_group, group_slug, current[key]) for key in current.keys() - wanted.keys())
+
+        for (apply, group_slug, user_uuid), ok in zip(changes, executor.map(lambda change: change[0](workspace_id, change[1], change[2]), changes)):
+            if apply is add_user_to_group:
+                units.finish('membership_add', f"{group_slug}/{normalize_uuid(user_uuid)}", membership_hash, ok)
+            if not ok:
+                summary['failed'] += 1
+            elif apply is add_user_to_group:
+                summary['added'] += 1
+            else:
+                summary['removed'] += 1
+
+    logging.info(
+        f"Memberships of {len(group_list)} groups: {summary['added']} added, {summary['removed']} removed, "
+        f"{summary['unchanged']} already in place, {summary['unresolved']} rows unresolved, {summary['failed']} failed"
+    )
+    users.log_stats()
+    units.log_stats()
+    return summary
 
-workspace_id = cloud['workspace'] 
-group_slugs = get_group_slugs(workspace_id)
-add_users_to_groups(workspace_id, users_file, membership_csv, group_slugs)
+if __name__ == "__main__":
+    workspace_id = cloud['workspace']
+    group_slugs = get_group_slugs(workspace_id)
+    add_users_to_groups(workspace_id, users_file, membership_csv, group_slugs)
+    client.log_stats()
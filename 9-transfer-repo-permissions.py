@@ -1,20 +1,35 @@
+import asyncio
 import csv
+import itertools
 import requests
 import os
 import logging
-from requests.auth import HTTPBasicAuth
-from config import cloud, on_prem
+import async_client
+import client
+import db_extract
+import ledger
+import user_directory
+from collections import defaultdict
+from config import cloud, on_prem, on_prem_db, workers
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+should_extract = True  # Set to True to read the server permissions into the snapshot
+should_apply = True  # Set to True to send the permissions of the snapshot to Cloud
+skip_inherited = True  # Skip repository grants that do not raise access above the project's grant for the same user or group
+skip_existing = True  # Read the current Cloud permissions and skip grants that already match
+
+# Cloud permissions from the lowest to the highest access
+permission_rank = {"read": 1, "write": 2, "admin": 3}
+
 def which_project_permission(permission):
     return {
         "PROJECT_WRITE": "write",
         "PROJECT_READ": "read",
         "PROJECT_ADMIN": "admin",
     }.get(permission, "")
-    
+
 def which_repo_permission(permission):
     return {
         "REPO_WRITE": "write",
@@ -23,10 +38,9 @@ def which_repo_permission(permission):
     }.get(permission, "")
 
 def get_group_slugs(workspace_id):
-    url = f"https://api.bitbucket.org/1.0/groups/{workspace_id}/"
-    auth = HTTPBasicAuth(cloud['username'], cloud['token'])
+    url = f"{client.cloud_api}/1.0/groups/{workspace_id}/"
     try:
-        response = requests.get(url, auth=auth)
+        response = client.get(url)
         group_slugs = {}
         if response.ok:
             for group in response.json():
@@ -40,128 +54,334 @@ def get_group_slugs(workspace_id):
         return {}
 
 script_location = os.path.dirname(os.path.abspath(__file__))
-bitbucket_server_repositories = os.path.join(script_location, on_prem["bitbucket_server_repositories"]) 
-
-logging.info("Fetching group slugs from Bitbucket API...")
-group_slugs = get_group_slugs(cloud['workspace'])
-
-def get_uuid_from_user(displayName):
-    users_file = os.path.join(script_location, "bitbucket_users_match.csv")  
-    with open(users_file, mode='r') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        for row in csv_reader:
-            if row['cloud_display_name'] == displayName:
-                return row['cloud_uuid'] 
-    return None 
-
-project_keys_set = set()
-with open(bitbucket_server_repositories, mode='r') as csv_file:
-    csv_reader = csv.DictReader(csv_file)
-    for row in csv_reader:
-        project_keys_set.add(row['project_key'])
-
-logging.info("Processing project permissions...")
-for project_key in project_keys_set:
-
-    users_response = requests.get(
-        f"{on_prem['base_url']}/rest/api/1.0/projects/{project_key}/permissions/users",
-        auth = HTTPBasicAuth(on_prem['username'], on_prem['password']), 
-        headers = {"Accept": "application/json"}  # Request headers
-    ).json()
-    
-    for user in users_response['values']:
-        mapped_permission = which_project_permission(user['permission'])
-        if mapped_permission:
-            
-            user_uuid = get_uuid_from_user(user['user']['displayName'])
-            
-            if user_uuid != '': 
-            
-                response = requests.request(
-                    'PUT',
-                    f"https://api.bitbucket.org/2.0/workspaces/{cloud['workspace']}/projects/{project_key}/permissions-config/users/{user_uuid}",
-                    auth = HTTPBasicAuth(cloud['username'], cloud['token']), 
-                    headers = {"Accept": "application/json"},
-                    json={"permission": mapped_permission}
-                )
-            
-    groups_response = requests.get(
-        f"{on_prem['base_url']}/rest/api/1.0/projects/{project_key}/permissions/groups",
-        auth = HTTPBasicAuth(on_prem['username'], on_prem['password']), 
-        headers = {"Accept": "application/json"}
-    ).json()
-
-    for group in groups_response['values']:
-        mapped_permission = which_project_permission(group['permission'])
-        if mapped_permission:
-            
-            group_slug = group_slugs.get(group['group']['name'])
-            
-            if group_slug != '': 
-            
-                response = requests.request(
-                    'PUT',
-                    f"https://api.bitbucket.org/2.0/workspaces/{cloud['workspace']}/projects/{project_key}/permissions-config/groups/{group_slug}",
-                    auth = HTTPBasicAuth(cloud['username'], cloud['token']), 
-                    headers = {"Accept": "application/json"},
-                    data={"permission": mapped_permission}
-                )
-                
-    logging.info(f"Processed permissions for project: {project_key}")    
-    
-#repo level     
-logging.info("Processing repository permissions...")           
-with open(bitbucket_server_repositories, mode='r') as csv_file:
-    csv_reader = csv.DictReader(csv_file)
-    for row in csv_reader:
-        
+bitbucket_server_repositories = os.path.join(script_location, on_prem["bitbucket_server_repositories"])
+users_file = os.path.join(script_location, "bitbucket_users_match.csv")
+permissions_snapshot = os.path.join(script_location, "permissions_snapshot.csv")  # Server permissions read by the extract phase
+
+snapshot_fields = ledger.snapshot_fields
+
+def normalize_uuid(uuid):
+    return uuid.strip('{}').lower()
+
+async def in_executor(function, *args):
+    """ Run a blocking call (a ledger query or write) in the default executor, so the event loop keeps serving the requests in flight. """
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+async def extract_resource(engine, project_key, repo_slug=''):
+    """
+    Read every page of the user and group permissions of a server project (or repository when
+    repo_slug is given). Returns the snapshot rows and whether both listings were read to the end.
+    """
+    resource_path = f"projects/{project_key}" + (f"/repos/{repo_slug}" if repo_slug else "")
+    listings = await asyncio.gather(*(
+        engine.server_values(f"{on_prem['base_url']}/rest/api/1.0/{resource_path}/permissions/{kind}", limit=1000)
+        for kind in ('users', 'groups')))
+
+    rows = []
+    for kind, values in zip(('users', 'groups'), listings):
+        for entry in values or []:
+            if kind == 'users':
+                name, display_name = entry['user'].get('slug', ''), entry['user'].get('displayName', '')
+            else:
+                name, display_name = entry['group']['name'], ''
+            rows.append({'project_key': project_key, 'repo_slug': repo_slug, 'kind': kind, 'name': name,
+                         'display_name': display_name, 'permission': entry['permission']})
+    return rows, all(values is not None for values in listings)
+
+async def extract_permissions(engine, repositories):
+    """ Read the permissions of every project and repository concurrently, streaming them to the snapshot as they arrive. """
+    resources = [(project_key, '') for project_key in sorted({row['project_key'] for row in repositories})]
+    resources += [(row['project_key'], row['slug']) for row in repositories]
+
+    units = ledger.load()
+    counts = {'written': 0, 'incomplete': 0}
+    tmp_path = f"{permissions_snapshot}.tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as snapshot_file:
+        writer = csv.DictWriter(snapshot_file, fieldnames=snapshot_fields)
+        writer.writeheader()
+
+        async def extract(resource):
+            project_key, repo_slug = resource
+            try:
+                rows, complete = await extract_resource(engine, project_key, repo_slug)
+            except Exception:
+                logging.exception(f"Error reading permissions of {project_key}/{repo_slug}")
+                rows, complete = [], False
+            if not complete:
+                # Partial rows are left out of the snapshot, so the apply phase never takes them as the
+                # resource's permissions. The ledger drops the rows of earlier runs too: with or without
+                # it, nothing is sent for the resource until a later extract reads it completely
+                counts['incomplete'] += 1
+                logging.error(f"Permissions of {project_key}/{repo_slug} could not be read completely, leaving them out of the snapshot")
+                if units.enabled:
+                    await in_executor(units.replace_snapshot, project_key, repo_slug, [])
+                return
+            if units.enabled:
+                await in_executor(units.replace_snapshot, project_key, repo_slug, rows)
+            writer.writerows(rows)
+            counts['written'] += len(rows)
+
+        await engine.for_each(resources, extract, concurrency=workers['permission_extract'])
+    os.replace(tmp_path, permissions_snapshot)
+    logging.info(f"Extracted {counts['written']} permissions of {len(resources)} projects and repositories to {permissions_snapshot}, {counts['incomplete']} incomplete")
+
+def extract_permissions_from_db(repositories):
+    """ Read the permissions of every listed project and repository from the server database in one streaming query. """
+    resources = {(row['project_key'], '') for row in repositories} | {(row['project_key'], row['slug']) for row in repositories}
+
+    units = ledger.load()
+    written = 0
+    seen = set()
+    tmp_path = f"{permissions_snapshot}.tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as snapshot_file:
+        writer = csv.DictWriter(snapshot_file, fieldnames=snapshot_fields)
+        writer.writeheader()
+        for resource, rows in itertools.groupby(db_extract.iter_permissions(), key=lambda row: (row['project_key'], row['repo_slug'])):
+            if resource not in resources:
+                continue
+            rows = list(rows)
+            seen.add(resource)
+            if units.enabled:
+                units.replace_snapshot(*resource, rows)
+            writer.writerows(rows)
+            written += len(rows)
+    if units.enabled:
+        # Resources left without explicit permissions drop what an earlier run recorded for them
+        for resource in resources - seen:
+            units.replace_snapshot(*resource, [])
+    os.replace(tmp_path, permissions_snapshot)
+    logging.info(f"Extracted {written} permissions of {len(resources)} projects and repositories from the database to {permissions_snapshot}")
+
+def load_snapshot():
+    """
+    Snapshot rows grouped by (project key, repository slug), the project's own rows under an empty slug.
+    Returns None when the ledger holds the snapshot, which is then queried per resource.
+    """
+    units = ledger.load()
+    if units.enabled and units.snapshot_size():
+        return None
+    resources = defaultdict(list)
+    with open(permissions_snapshot, newline='', encoding='utf-8') as snapshot_file:
+        for row in csv.DictReader(snapshot_file):
+            resources[(row['project_key'], row['repo_slug'])].append(row)
+    return resources
+
+def snapshot_rows(snapshot, project_key, repo_slug=''):
+    if snapshot is None:
+        return ledger.load().snapshot_rows(project_key, repo_slug)
+    return snapshot.get((project_key, repo_slug), [])
+
+def get_server_grants(rows, which_permission, users, group_slugs):
+    """
+    Map the snapshot rows of a server project or repository to Cloud.
+
+    Parameters:
+    - rows: The snapshot rows of the project or repository.
+    - which_permission: which_project_permission or which_repo_permission.
+    - users: The user directory.
+    - group_slugs: Cloud group name -> slug.
+
+    Returns {principal: permission}, where a principal is ('users', <normalized uuid>) or
+    ('groups', <group slug>), and {principal: UUID or slug used in the Cloud URL}.
+    """
+    grants, targets = {}, {}
+    for row in rows:
+        mapped_permission = which_permission(row['permission'])
+        if not mapped_permission:
+            continue
+        if row['kind'] == 'users':
+            target = users.cloud_uuid(server_slug=row['name'], cloud_display_name=row['display_name'])
+            principal = ('users', normalize_uuid(target)) if target else None
+        else:
+            target = group_slugs.get(row['name'])
+            principal = ('groups', target) if target else None
+        if principal:
+            grants[principal] = mapped_permission
+            targets[principal] = target
+    return grants, targets
+
+async def get_cloud_grants(engine, config_url, totals):
+    """ Current explicit user and group permissions of a Cloud project or repository as {principal: permission}, or None if they cannot be read. """
+    grants = {}
+    for kind, field, key in (('users', 'user', 'uuid'), ('groups', 'group', 'slug')):
+        url = f"{config_url}/{kind}?pagelen=100"
+        while url:
+            response = await engine.get(url, headers={"Accept": "application/json"})
+            totals['reads'] += 1
+            if response.status_code != 200:
+                logging.error(f"Failed to fetch {kind} permissions from {config_url}: {response.status_code} {response.text}")
+                return None
+            data = response.json()
+            for entry in data.get('values', []):
+                name = entry.get(field, {}).get(key)
+                if name:
+                    grants[(kind, normalize_uuid(name) if kind == 'users' else name)] = entry.get('permission')
+            url = data.get('next')
+    return grants
+
+def plan_grants(desired, inherited, current):
+    """
+    Pick the grants that have to be sent.
+
+    Parameters:
+    - desired: {principal: permission} granted on the server.
+    - inherited: {principal: permission} the principal already gets from the project ({} for projects).
+    - current: {principal: permission} already set on Cloud.
+
+    Returns the grants to send and the number skipped because they are inherited or already set.
+    """
+    planned, skipped_inherited, skipped_existing = {}, 0, 0
+    for principal, permission in desired.items():
+        if skip_inherited and permission_rank[permission] <= permission_rank.get(inherited.get(principal), 0):
+            skipped_inherited += 1
+        elif skip_existing and current.get(principal) == permission:
+            skipped_existing += 1
+        else:
+            planned[principal] = permission
+    return planned, skipped_inherited, skipped_existing
+
+def grant_unit(config_url, principal):
+    """ The ledger key of a grant. """
+    return f"{config_url}/{principal[0]}/{principal[1]}"
+
+async def apply_grant(engine, config_url, principal, target, permission):
+    kind = principal[0]
+    try:
+        response = await engine.put(
+            f"{config_url}/{kind}/{target}",
+            headers = {"Accept": "application/json"},
+            json={"permission": permission}
+        )
+    except Exception as e:
+        # A deadline or an open circuit breaker fails this grant only, not the others of its scope
+        logging.error(f"Failed to set {permission} for {kind} {target} on {config_url}: {e.__class__.__name__} {e}")
+        await in_executor(ledger.load().finish, 'permission_grant', grant_unit(config_url, principal), ledger.content_hash(permission), False, e.__class__.__name__)
+        return False
+    if not response.ok:
+        logging.error(f"Failed to set {permission} for {kind} {target} on {config_url}: {response.status_code} {response.text}")
+    await in_executor(ledger.load().finish, 'permission_grant', grant_unit(config_url, principal), ledger.content_hash(permission), response.ok, None if response.ok else str(response.status_code))
+    return response.ok
+
+async def apply_grants(engine, config_url, planned, targets):
+    """ PUT every planned grant concurrently, returning the principals whose grant was set. """
+    results = await asyncio.gather(*(
+        apply_grant(engine, config_url, principal, targets[principal], permission)
+        for principal, permission in planned.items()))
+    return {principal for principal, ok in zip(planned, results) if ok}
+
+async def transfer_scope(engine, config_url, desired, targets, inherited, totals):
+    """
+    Send the desired grants of a project or repository that are not inherited, recorded or already set.
+    Returns the desired grants in effect on Cloud: all of them but the ones whose PUT failed.
+    """
+    units = ledger.load()
+    # Grants the ledger has as set with the same permission are neither read back nor sent again
+    planned, _, _ = plan_grants(desired, inherited, {})
+    recorded = await in_executor(lambda: {principal for principal, permission in planned.items() if units.is_done('permission_grant', grant_unit(config_url, principal), ledger.content_hash(permission))})
+    remaining = {principal: permission for principal, permission in desired.items() if principal not in recorded}
+    units.skip('permission_grant', len(recorded))
+
+    # Cloud is only read when some grant is left after the inheritance check
+    current = {}
+    if skip_existing and planned.keys() - recorded:
+        current = await get_cloud_grants(engine, config_url, totals) or {}
+    planned, skipped_inherited, skipped_existing = plan_grants(remaining, inherited, current)
+    already_set = {principal: permission for principal, permission in remaining.items() if principal not in planned and current.get(principal) == permission}
+    if already_set:
+        await in_executor(lambda: [units.finish('permission_grant', grant_unit(config_url, principal), ledger.content_hash(permission), True, 'already set on Cloud')
+                                   for principal, permission in already_set.items()])
+    totals['grants'] += len(desired)
+    totals['recorded'] += len(recorded)
+    totals['inherited'] += skipped_inherited
+    totals['existing'] += skipped_existing
+    totals['sent'] += len(planned)
+    applied = await apply_grants(engine, config_url, planned, targets)
+    totals['failed'] += len(planned) - len(applied)
+    return {principal: permission for principal, permission in desired.items() if principal not in planned or principal in applied}
+
+def permissions_config_url(project_key, repo_slug=''):
+    if repo_slug:
+        return f"{client.cloud_api}/2.0/repositories/{cloud['workspace']}/{repo_slug}/permissions-config"
+    return f"{client.cloud_api}/2.0/workspaces/{cloud['workspace']}/projects/{project_key}/permissions-config"
+
+async def transfer_resource(engine, project_key, repo_slug, users, group_slugs, inherited, totals, rows=None):
+    """
+    Read the permissions of one server project (or repository when repo_slug is given) and send them
+    to Cloud without going through the snapshot, as the pipeline does. Rows already read (from the
+    database) are used as they are. Returns the grants in effect on Cloud (see transfer_scope), or None
+    when the server permissions could not be read completely: nothing is sent for the resource and it
+    counts as failed.
+    """
+    if rows is None:
+        rows, complete = await extract_resource(engine, project_key, repo_slug)
+        if not complete:
+            logging.error(f"Permissions of {project_key}/{repo_slug} could not be read completely, skipping it")
+            totals['failed'] += 1
+            return None
+    which_permission = which_repo_permission if repo_slug else which_project_permission
+    desired, targets = get_server_grants(rows, which_permission, users, group_slugs)
+    return await transfer_scope(engine, permissions_config_url(project_key, repo_slug), desired, targets, inherited, totals)
+
+def log_totals(totals):
+    logging.info(
+        f"Permissions processing complete: {totals['sent']} of {totals['grants']} grants sent, "
+        f"{totals['inherited']} skipped as inherited from the project, {totals['existing']} skipped as already set on Cloud, "
+        f"{totals['recorded']} skipped as recorded in the ledger "
+        f"({totals['grants'] - totals['sent']} calls eliminated for {totals['reads']} reads), {totals['failed']} failed"
+    )
+
+async def apply_permissions(engine, repositories):
+    """ Send the permissions of the snapshot to Cloud, projects first. """
+    totals = {'grants': 0, 'recorded': 0, 'inherited': 0, 'existing': 0, 'sent': 0, 'failed': 0, 'reads': 0}
+
+    logging.info("Fetching group slugs from Bitbucket API...")
+    group_slugs = get_group_slugs(cloud['workspace'])
+    users = user_directory.load(users_file)
+    snapshot = await in_executor(load_snapshot)
+
+    logging.info("Processing project permissions...")
+    project_grants = {}
+
+    async def transfer_project(project_key):
+        desired, targets = get_server_grants(await in_executor(snapshot_rows, snapshot, project_key), which_project_permission, users, group_slugs)
+        # Only the grants set on Cloud are inherited: a repository still gets its own grant where the project's failed
+        project_grants[project_key] = await transfer_scope(engine, permissions_config_url(project_key), desired, targets, {}, totals)
+        logging.info(f"Processed permissions for project: {project_key}")
+
+    await engine.for_each(sorted({row['project_key'] for row in repositories}), transfer_project, concurrency=workers['permission_apply'])
+
+    #repo level
+    logging.info("Processing repository permissions...")
+
+    async def transfer_repository(row):
         repo_slug = row['slug']
         project_key = row['project_key']
+        desired, targets = get_server_grants(await in_executor(snapshot_rows, snapshot, project_key, repo_slug), which_repo_permission, users, group_slugs)
+        # A repository grant only matters where it raises access above what the project grants
+        await transfer_scope(engine, permissions_config_url(project_key, repo_slug), desired, targets, project_grants.get(project_key, {}), totals)
+        logging.info(f"Processed permissions for repository: {repo_slug}")
+
+    await engine.for_each(repositories, transfer_repository, concurrency=workers['permission_apply'])
+
+    log_totals(totals)
+    users.log_stats()
+    ledger.load().log_stats()
+
+async def run_phases(engine, repositories):
+    if should_extract and on_prem_db['enabled']:
+        await in_executor(extract_permissions_from_db, repositories)
+    elif should_extract:
+        await extract_permissions(engine, repositories)
+    if should_apply:
+        await apply_permissions(engine, repositories)
+    engine.log_stats()
+
+def main():
+    with open(bitbucket_server_repositories, mode='r') as csv_file:
+        repositories = list(csv.DictReader(csv_file))
+
+    async_client.run(lambda engine: run_phases(engine, repositories))
+    client.log_stats()
 
-        users_response = requests.get(
-            f"{on_prem['base_url']}/rest/api/1.0/projects/{project_key}/repos/{repo_slug}/permissions/users",
-            auth = HTTPBasicAuth(on_prem['username'], on_prem['password']), 
-            headers = {"Accept": "application/json"}  # Request headers
-        ).json()
-        
-        for user in users_response['values']:
-            mapped_permission = which_project_permission(user['permission'])
-            if mapped_permission:
-                
-                user_uuid = get_uuid_from_user(user['user']['displayName'])
-                
-                if user_uuid != '': 
-                
-                    response = requests.request(
-                        'PUT',
-                        f"https://api.bitbucket.org/2.0/repositories/{cloud['workspace']}/{repo_slug}/permissions-config/users/{user_uuid}",
-                        auth = HTTPBasicAuth(cloud['username'], cloud['token']), 
-                        headers = {"Accept": "application/json"},
-                        json={"permission": mapped_permission}
-                    )
-                
-        groups_response = requests.get(
-            f"{on_prem['base_url']}/rest/api/1.0/projects/{project_key}/repos/{repo_slug}/permissions/groups",
-            auth = HTTPBasicAuth(on_prem['username'], on_prem['password']), 
-            headers = {"Accept": "application/json"}
-        ).json()
-
-        for group in groups_response['values']:
-            mapped_permission = which_project_permission(group['permission'])
-            if mapped_permission:
-                
-                group_slug = group_slugs.get(group['group']['name'])
-                
-                if group_slug != '': 
-                
-                    response = requests.request(
-                        'PUT',
-                        f"https://api.bitbucket.org/2.0/repositories/{cloud['workspace']}/{repo_slug}/permissions-config/groups/{group_slug}",
-                        auth = HTTPBasicAuth(cloud['username'], cloud['token']), 
-                        headers = {"Accept": "application/json"},
-                        data={"permission": mapped_permission}
-                    )
-                    
-    logging.info(f"Processed permissions for repository: {repo_slug}")    
-                    
-logging.info("Permissions processing complete.")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+asyncio engine for the stages that are almost only REST calls (6-sync-reviewers.py and
+9-transfer-repo-permissions.py).
+
+    import async_client
+
+    async def sync(engine):
+        async def one(repo_slug):
+            response = await engine.get(f"{client.cloud_api}/2.0/repositories/{workspace}/{repo_slug}")
+            return response.ok
+        return await engine.for_each(repo_slugs, one)
+
+    results = async_client.run(sync)
+
+With aiohttp installed, thousands of calls can be in flight over at most http['pool_size']
+keep-alive connections per host. They go through the same rate limiter (rate_limit.py), retry
+policy, deadline and circuit breakers (resilience.py) as client.py. The rate limiter's state file
+is only locked and written from threads: the loop spends tokens leased from it in memory.
+
+Without aiohttp, the engine runs the calls of client.py on a thread pool of http['pool_size']
+threads per engine, so the stages work either way and only lose the extra concurrency.
+
+for_each pulls items from its iterable only as workers free up, so at most http['max_in_flight']
+items are being processed and the input is never read ahead.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import client
+import rate_limit
+import resilience
+from config import cloud, on_prem, http, rate_limits
+
+
+class Response:
+    """The parts of a response the stages use, read fully so the connection goes back to the pool."""
+
+    def __init__(self, status_code, headers, text):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _auth_for(host):
+    if host == client.host_of(on_prem['base_url']):
+        return aiohttp.BasicAuth(on_prem['username'], on_prem['password'])
+    if host == client.cloud_api:
+        return aiohttp.BasicAuth(cloud['username'], cloud['token'])
+    return None
+
+
+class Engine:
+    def __init__(self, max_in_flight=None):
+        self.max_in_flight = max_in_flight or http['max_in_flight']
+        self.session = None
+        self.executor = None
+        self.requests_sent = 0
+        self.handshakes = 0
+        if aiohttp:
+            trace = aiohttp.TraceConfig()
+            trace.on_request_end.append(self._count_request)
+            trace.on_connection_create_end.append(self._count_handshake)
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=http['pool_size'])
+            self.session = aiohttp.ClientSession(connector=connector, headers={"Accept": "application/json"}, trace_configs=[trace])
+        else:
+            logging.info("aiohttp is not installed, running the calls on a thread pool")
+            self.executor = ThreadPoolExecutor(max_workers=http['pool_size'])
+
+    async def _count_request(self, session, context, params):
+        self.requests_sent += 1
+
+    async def _count_handshake(self, session, context, params):
+        self.handshakes += 1
+
+    def log_stats(self):
+        """Log the requests sent and connections opened by the engine (client.log_stats covers the thread pool fallback)."""
+        if self.session:
+            logging.info(
+                f"Async engine: {self.requests_sent} requests, {self.handshakes} handshakes, "
+                f"{max(self.requests_sent - self.handshakes, 0)} reused connections"
+            )
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+        if self.executor:
+            self.executor.shutdown()
+
+    async def request(self, method, url, idempotent=None, deadline=None, **kwargs):
+        """Send a request with the same rate limiting, retries, deadline and circuit breaker as client.request."""
+        if not self.session:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, lambda: client.request(method, url, idempotent=idempotent, deadline=deadline, **kwargs))
+
+        if idempotent is None:
+            idempotent = method.upper() in resilience.idempotent_methods
+        deadline_at = time.monotonic() + (deadline or http['deadline'])
+        breaker = resilience.breaker_for(client.host_of(url))
+        auth = _auth_for(client.host_of(url))
+        attempt = throttled = 0
+        while True:
+            resilience.check_deadline(deadline_at, url)
+            await self._take_token(url, deadline_at)
+            await self._wait(breaker.try_enter, deadline_at, url)
+            timeout = aiohttp.ClientTimeout(
+                total=max(resilience.remaining(deadline_at), 0.1),
+                sock_connect=http['connect_timeout'],
+                sock_read=http['read_timeout'])
+            try:
+                async with self.session.request(method, url, auth=auth, timeout=timeout, **kwargs) as raw:
+                    response = Response(raw.status, raw.headers, await raw.text())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                breaker.record_failure()
+                if not idempotent or attempt >= http['retries'] or resilience.remaining(deadline_at) <= 0:
+                    raise
+                attempt += 1
+                logging.warning(f"{method} {url} failed ({e.__class__.__name__}), retry {attempt} of {http['retries']}")
+                await self._backoff(attempt, deadline_at)
+                continue
+            except Exception:
+                breaker.abandon()
+                raise
+
+            # record() updates the shared rate limiter state file, so it runs on a thread
+            await asyncio.get_running_loop().run_in_executor(None, rate_limit.record, url, response)
+            if rate_limit.is_throttled(response):
+                breaker.abandon()
+                if throttled < rate_limits['max_throttle_retries'] and resilience.remaining(deadline_at) > 0:
+                    throttled += 1
+                    continue
+                return response
+
+            if response.status_code in resilience.retry_statuses:
+                breaker.record_failure()
+                if idempotent and attempt < http['retries'] and resilience.remaining(deadline_at) > 0:
+                    attempt += 1
+                    logging.warning(f"{method} {url} answered {response.status_code}, retry {attempt} of {http['retries']}")
+                    await self._backoff(attempt, deadline_at)
+                    continue
+                return response
+
+            breaker.record_success()
+            return response
+
+    async def _take_token(self, url, deadline_at):
+        """Take a rate limiter token from this process's lease, refilling the lease from the shared state on a thread."""
+        while True:
+            wait = rate_limit.take_leased(url)
+            if wait is None:
+                await asyncio.get_running_loop().run_in_executor(None, rate_limit.lease, url)
+                continue
+            if not wait:
+                return
+            if resilience.remaining(deadline_at) <= 0:
+                raise asyncio.TimeoutError(f"Deadline of {http['deadline']}s exceeded for {url}")
+            await asyncio.sleep(min(wait, max(resilience.remaining(deadline_at), 0)))
+
+    async def _wait(self, reserve, deadline_at, url):
+        """Poll a non-blocking gate (the circuit breaker) until it lets the call through."""
+        while True:
+            wait = reserve()
+            if not wait:
+                return
+            if resilience.remaining(deadline_at) <= 0:
+                raise asyncio.TimeoutError(f"Deadline of {http['deadline']}s exceeded for {url}")
+            await asyncio.sleep(min(wait, max(resilience.remaining(deadline_at), 0)))
+
+    async def _backoff(self, attempt, deadline_at):
+        await asyncio.sleep(resilience.backoff_delay(attempt, deadline_at))
+        resilience.count('retries')
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request('PUT', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request('DELETE', url, **kwargs)
+
+    async def cloud_values(self, url):
+        """Every value of a Bitbucket Cloud listing, following its 'next' links, or None if a page fails."""
+        values = []
+        while url:
+            response = await self.get(url, headers={"Accept": "application/json"})
+            if response.status_code != 200:
+                logging.error(f"Failed to fetch {url}: {response.status_code} {response.text}")
+                return None
+            data = response.json()
+            values.extend(data.get('values', []))
+            url = data.get('next')
+        return values
+
+    async def server_values(self, url, limit=1000):
+        """Every value of a Bitbucket Server listing, following nextPageStart, or None if a page fails."""
+        values, start = [], 0
+        while True:
+            response = await self.get(client.with_params(url, start=start, limit=limit), headers={"Accept": "application/json"})
+            if response.status_code != 200:
+                logging.error(f"Failed to fetch {url}: {response.status_code} {response.text}")
+                return None
+            data = response.json()
+            values.extend(data.get('values', []))
+            if data.get('isLastPage', True):
+                return values
+            start = data.get('nextPageStart', start + len(data.get('values', [])))
+
+    async def for_each(self, items, handle, concurrency=None):
+        """
+        Run `await handle(item)` for every item with at most `concurrency` (default max_in_flight)
+        running at once, and return the results in the order of the items. An exception raised by
+        handle is logged and its result is None.
+        """
+        items = iter(enumerate(items))
+        results = {}
+
+        async def worker():
+            for index, item in items:
+                try:
+                    results[index] = await handle(item)
+                except Exception:
+                    logging.exception(f"Error processing {item}")
+                    results[index] = None
+
+        await asyncio.gather(*(worker() for _ in range(concurrency or self.max_in_flight)))
+        return [results[index] for index in range(len(results))]
+
+
+class BackgroundEngine:
+    """
+    An Engine on an event loop of its own thread, for code that runs on threads (pipeline.py):
+    call() sends a coroutine to the loop and blocks until it is done, so any number of threads
+    share one engine and its connections.
+    """
+
+    def __init__(self, max_in_flight=None):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='async-engine', daemon=True)
+        self.thread.start()
+
+        async def create():
+            return Engine(max_in_flight)
+        self.engine = asyncio.run_coroutine_threadsafe(create(), self.loop).result()
+
+    def call(self, make_coroutine):
+        """Run `await make_coroutine(engine)` on the engine's loop and return its result."""
+        return asyncio.run_coroutine_threadsafe(make_coroutine(self.engine), self.loop).result()
+
+    def close(self):
+        self.call(lambda engine: engine.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def run(main, max_in_flight=None):
+    """Run `await main(engine)` on a new event loop with a fresh engine and return its result."""
+    async def runner():
+        engine = Engine(max_in_flight)
+        try:
+            return await main(engine)
+        finally:
+            await engine.close()
+    return asyncio.run(runner())
@@ -0,0 +1,329 @@
+"""
+Shared HTTP client for every Bitbucket Server and Cloud call.
+
+One requests.Session (and so one keep-alive connection pool) is kept per host,
+with the credentials from config.py attached, so repeated calls reuse open
+TCP/TLS connections instead of paying a new handshake each time.
+
+    import client
+    response = client.get(f"{client.cloud_api}/2.0/repositories/{cloud['workspace']}")
+    client.log_stats()
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlencode, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import rate_limit
+import resilience
+from config import cloud, on_prem, http, rate_limits, workers
+
+cloud_api = "https://api.bitbucket.org"
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+# With hedging on, every GET runs here: room for each worker of the largest stage and for its hedge
+_hedge_pool = ThreadPoolExecutor(max_workers=max(http['pool_size'], *workers.values()) * 2, thread_name_prefix='hedge')
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter that counts the requests it sends and the connections (handshakes) it has to open."""
+
+    def __init__(self, **kwargs):
+        self.requests_sent = 0
+        self.handshakes = 0
+        self._counter_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def _count(self, field):
+        with self._counter_lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+
+        class CountingHTTPConnection(HTTPConnection):
+            def connect(self):
+                super().connect()
+                adapter._count('handshakes')
+
+        class CountingHTTPSConnection(HTTPSConnection):
+            def connect(self):
+                super().connect()
+                adapter._count('handshakes')
+
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = CountingHTTPConnection
+
+        class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = CountingHTTPSConnection
+
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        self._count('requests_sent')
+        return response
+
+
+def host_of(url):
+    """Return the scheme://host[:port] part of a URL, used as the pool key."""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _auth_for(host):
+    """Pick the configured credentials for a host, if it is one we know."""
+    if host == host_of(on_prem['base_url']):
+        return HTTPBasicAuth(on_prem['username'], on_prem['password'])
+    if host == cloud_api:
+        return HTTPBasicAuth(cloud['username'], cloud['token'])
+    return None
+
+
+def get_session(url):
+    """Return the shared session for the host of the given URL, creating it on first use."""
+    host = host_of(url)
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = PooledAdapter(pool_connections=1, pool_maxsize=http['pool_size'], pool_block=True)
+            session.mount(host, adapter)
+            session.auth = _auth_for(host)
+            session.headers.update({"Accept": "application/json"})
+            _sessions[host] = session
+            logging.debug(f"Opened connection pool for {host} (size {http['pool_size']})")
+        return session
+
+
+def _send(session, method, url, kwargs):
+    """
+    Send one attempt. A GET still unanswered after http['hedge_after'] seconds is sent a second
+    time and whichever answer comes first is used.
+    """
+    if method.upper() != 'GET' or not http['hedge_after']:
+        return session.request(method, url, **kwargs)
+
+    first = _hedge_pool.submit(session.request, method, url, **kwargs)
+    done, _ = wait([first], timeout=http['hedge_after'])
+    if done:
+        return first.result()
+    rate_limit.acquire(url)
+    resilience.count('hedges')
+    second = _hedge_pool.submit(session.request, method, url, **kwargs)
+    pending = {first, second}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None or not pending:
+                if future is second:
+                    resilience.count('hedges_won')
+                for other in pending:
+                    # The slower answer is dropped once it arrives, releasing its connection
+                    other.add_done_callback(lambda late: late.exception() is None and late.result().close())
+                return future.result()
+
+
+def request(method, url, idempotent=None, deadline=None, **kwargs):
+    """
+    Send a request through the pooled session of the URL's host, applying the default timeouts.
+
+    Every request first takes a token from the rate limiter of its endpoint family. A 429 or 503
+    answer slows the family down and the request is sent again once the limiter allows it (up to
+    rate_limits['max_throttle_retries'] times), so throttled writes are not lost.
+
+    The whole call, retries and waits included, must finish within `deadline` seconds
+    (http['deadline'] by default). Idempotent calls (GET, HEAD, OPTIONS, PUT, DELETE, or
+    idempotent=True) are retried with a jittered backoff on connection errors, timeouts and
+    500/502/504 answers, and calls to a host whose circuit breaker is open wait until it
+    recovers. See resilience.py.
+    """
+    connect_timeout, read_timeout = kwargs.pop('timeout', (http['connect_timeout'], http['read_timeout']))
+    if idempotent is None:
+        idempotent = method.upper() in resilience.idempotent_methods
+    deadline_at = time.monotonic() + (deadline or http['deadline'])
+    session = get_session(url)
+    breaker = resilience.breaker_for(host_of(url))
+    attempt = throttled = 0
+    while True:
+        resilience.check_deadline(deadline_at, url)
+        breaker.wait(deadline_at)
+        rate_limit.acquire(url)
+        kwargs['timeout'] = (connect_timeout, max(min(read_timeout, resilience.remaining(deadline_at)), 0.1))
+        try:
+            response = _send(session, method, url, kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            breaker.record_failure()
+            if not idempotent or attempt >= http['retries'] or resilience.remaining(deadline_at) <= 0:
+                raise
+            attempt += 1
+            logging.warning(f"{method} {url} failed ({e.__class__.__name__}), retry {attempt} of {http['retries']}")
+            resilience.backoff(attempt, deadline_at)
+            continue
+        except Exception:
+            breaker.abandon()
+            raise
+
+        rate_limit.record(url, response)
+        if rate_limit.is_throttled(response):
+            breaker.abandon()
+            if throttled < rate_limits['max_throttle_retries'] and resilience.remaining(deadline_at) > 0:
+                throttled += 1
+                continue
+            return response
+
+        if response.status_code in resilience.retry_statuses:
+            breaker.record_failure()
+            if idempotent and attempt < http['retries'] and resilience.remaining(deadline_at) > 0:
+                attempt += 1
+                logging.warning(f"{method} {url} answered {response.status_code}, retry {attempt} of {http['retries']}")
+                response.close()
+                resilience.backoff(attempt, deadline_at)
+                continue
+            return response
+
+        breaker.record_success()
+        return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
+
+
+def with_params(url, **params):
+    """Append query parameters to a URL that may already have some."""
+    return f"{url}{'&' if '?' in url else '?'}{urlencode(params)}"
+
+
+def _fetch_page(url, headers):
+    response = get(url, headers=headers)
+    if response.status_code == 200:
+        return response.json()
+    logging.error(f"Failed to fetch {url}: {response.status_code} {response.text}")
+    return None
+
+
+def iter_cloud_pages(url, pagelen=100, workers=1, headers=None):
+    """
+    Yield the pages of a Bitbucket Cloud listing, in order.
+
+    The first page tells the total 'size', so the remaining pages are fetched by number on a pool
+    of workers. Listings without 'size' are walked through their 'next' links one at a time.
+    Stops at the first page that cannot be fetched.
+    """
+    url = with_params(url, pagelen=pagelen)
+    data = _fetch_page(url, headers)
+    if data is None:
+        return
+    yield data
+
+    if 'size' in data and workers > 1:
+        page_count = -(-data['size'] // data.get('pagelen', pagelen))
+        page_urls = [with_params(url, page=page) for page in range(2, page_count + 1)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for page_data in executor.map(lambda page_url: _fetch_page(page_url, headers), page_urls):
+                if page_data is None:
+                    return
+                yield page_data
+    else:
+        while data.get('next'):
+            data = _fetch_page(data['next'], headers)
+            if data is None:
+                return
+            yield data
+
+
+def iter_server_pages(url, limit=1000, workers=1, headers=None):
+    """
+    Yield the pages of a Bitbucket Server listing, in order.
+
+    Server listings do not report their size and may cap the requested limit, so the first page
+    gives the page size actually used, then pages are requested a window of `workers` pages at a
+    time until one is flagged isLastPage. If a page does not continue where the window expected,
+    the walk resumes from its nextPageStart. Stops at the first page that cannot be fetched.
+    """
+    data = _fetch_page(with_params(url, start=0, limit=limit), headers)
+    if data is None:
+        return
+    yield data
+    if data.get('isLastPage', True):
+        return
+
+    page_size = data.get('limit') or len(data.get('values', [])) or limit
+    start = data.get('nextPageStart', page_size)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        while True:
+            starts = [start + index * page_size for index in range(max(workers, 1))]
+            pages = executor.map(lambda page_start: _fetch_page(with_params(url, start=page_start, limit=page_size), headers), starts)
+            for page_start, data in zip(starts, pages):
+                if data is None:
+                    return
+                yield data
+                if data.get('isLastPage', True):
+                    return
+                start = data.get('nextPageStart', page_start + page_size)
+                if start != page_start + page_size:
+                    break
+
+
+def stats():
+    """
+    Return connection reuse counters per host.
+
+    - requests: requests sent through the pool
+    - handshakes: new connections opened (pool misses, each a TCP and, for https, TLS handshake)
+    - reused: requests served on an already open connection (pool hits)
+    """
+    result = {}
+    with _sessions_lock:
+        sessions = dict(_sessions)
+    for host, session in sessions.items():
+        adapter = session.get_adapter(host)
+        result[host] = {
+            'requests': adapter.requests_sent,
+            'handshakes': adapter.handshakes,
+            'reused': max(adapter.requests_sent - adapter.handshakes, 0),
+        }
+    return result
+
+
+def log_stats():
+    """Log the connection reuse counters gathered so far."""
+    for host, counters in stats().items():
+        logging.info(
+            f"HTTP pool {host}: {counters['requests']} requests, "
+            f"{counters['handshakes']} handshakes, {counters['reused']} reused connections"
+        )
+    calls = resilience.stats()
+    if any(calls.values()):
+        logging.info(
+            f"Resilience: {calls['retries']} retries, {calls['hedges']} hedged requests ({calls['hedges_won']} won), "
+            f"{calls['breaker_opens']} circuit breaker openings"
+        )
+    limiter = rate_limit.stats()
+    if limiter['throttled'] or limiter['waited']:
+        logging.info(f"Rate limiter: {limiter['throttled']} throttled answers, {limiter['waited']:.1f}s of worker time spent waiting for tokens")
@@ -16,12 +16,84 @@ on_prem = {
     'bitbucket_server_repositories' : 'bitbucket_server_repositories.csv'  # Output CSV file for Server repositories
 }
 
+# Read-only access to the Bitbucket Server database, used instead of REST for users, groups, memberships,
+# personal repositories and permissions when enabled (db_extract.py). A read-only database user is enough.
+on_prem_db = {
+    'enabled': False,  # Set to True to extract from the database
+    'driver': 'postgresql',  # 'postgresql' (needs psycopg2) or 'sqlite' (a SQLite file with the same tables)
+    'host': 'localhost',
+    'port': 5432,
+    'database': 'bitbucket',
+    'username': '',
+    'password': '',
+    'path': '',  # The database file for the 'sqlite' driver
+    'batch_size': 10000  # Rows fetched per round trip
+}
+
 repository_folder = 'repositories' #the directory which the script will download the repositories (for 2-close-repos-with-lfs.py)
+dedupe_objects = False  # Share git objects and LFS storage between forks and copies of the same repository (2-clone-repos-with-lfs.py)
+use_mirrors = False  # Keep bare mirrors (<name>.git) that are fetched incrementally and pushed with all refs (2-clone-repos-with-lfs.py, 10-transfer-personal-repos.py)
+use_ledger = True  # Record every unit of work in a SQLite ledger and skip the units already completed for the same content on a rerun (ledger.py)
+ledger_file = 'migration_ledger.db'  # The ledger database, next to the scripts
 project_key = "PERSONAL"
 
+# Shared HTTP client settings (client.py)
+http = {
+    'pool_size': 10,  # Keep-alive connections kept open per host
+    'connect_timeout': 10,  # Seconds to wait for a connection to be established
+    'read_timeout': 60,  # Seconds to wait for a response
+    'max_in_flight': 500,  # Calls the asyncio engine (async_client.py) keeps in flight at once
+    'deadline': 300,  # Seconds a call may take in total, retries and waits included
+    'retries': 4,  # Retries of an idempotent call after a connection error, timeout or 500/502/504
+    'backoff': 0.5,  # Seconds of the first retry backoff, doubled on each retry (with jitter)
+    'max_backoff': 30,  # Upper bound of a retry backoff in seconds
+    'hedge_after': None,  # Seconds after which a slow GET is sent a second time (None: no hedging)
+    'breaker_threshold': 5,  # Consecutive failures that open a host's circuit breaker
+    'breaker_cooldown': 30  # Seconds calls to a host wait while its circuit breaker is open
+}
+
+# Rate limits per endpoint family (rate_limit.py). A request is charged to the first family whose host
+# ('' for any host) and path prefix match its URL; None means no limit on that window.
+# Bitbucket Cloud counts its hourly limits per resource: https://support.atlassian.com/bitbucket-cloud/docs/api-request-limits/
+rate_limits = {
+    'shared': True,  # Share the budget with every script running on this machine (needs fcntl, so not on Windows)
+    'max_throttle_retries': 5,  # Times a request answered 429 or 503 is sent again
+    'families': [
+        {'host': 'api.bitbucket.org', 'path': '/2.0/repositories', 'per_second': 10, 'per_hour': 1000},
+        {'host': 'api.bitbucket.org', 'path': '/2.0/workspaces', 'per_second': 10, 'per_hour': None},
+        {'host': 'api.bitbucket.org', 'path': '/1.0/groups', 'per_second': 10, 'per_hour': None},
+        {'host': 'api.bitbucket.org', 'path': '', 'per_second': 10, 'per_hour': None},
+        {'host': '', 'path': '', 'per_second': 50, 'per_hour': None},  # Bitbucket Server
+    ]
+}
+
+# Streaming pipeline settings (migrate.py, pipeline.py)
+pipeline = {
+    'queue_size': 100,  # Repositories waiting between two stages before the faster stage waits for the slower one
+    'write_csvs': True,  # Also write the CSV files of the numbered scripts, so each can be rerun on its own
+    'api_workers': 50  # Repositories of the reviewers and permissions stages handled at the same time on the asyncio engine
+}
+
+# Worker pool sizes for the concurrent stages
+workers = {
+    'list_repos': 8,  # 1-list-repos.py: projects whose repositories are paged in parallel
+    'cloud_pages': 8,  # 1-list-repos.py: Bitbucket Cloud repository pages fetched in parallel
+    'sync_repos': 8,  # 2-clone-repos-with-lfs.py: repositories processed at the same time
+    'clone_slots': 4,  # 2-clone-repos-with-lfs.py: concurrent git clones from the server
+    'lfs_push_slots': 2,  # 2-clone-repos-with-lfs.py: concurrent git lfs pushes to Cloud
+    'branch_sync': 8,  # 4-sync-project-branches.py: repositories reconciled in parallel
+    'user_pages': 8,  # 5-user-export.py: user pages fetched in parallel from Server and Cloud
+    'reviewer_sync': 200,  # 6-sync-reviewers.py: repositories whose default reviewers are synced at the same time on the asyncio engine
+    'group_sync': 8,  # 7-transfer-groups.py: groups created in parallel
+    'membership_sync': 8,  # 8-add-group-membership.py: group member reads and membership changes in parallel
+    'permission_extract': 200,  # 9-transfer-repo-permissions.py: projects and repositories whose permissions are read at the same time on the asyncio engine
+    'permission_apply': 200  # 9-transfer-repo-permissions.py: projects and repositories whose permissions are applied at the same time on the asyncio engine
+}
+
 """
 
 Query the database to get the group-membership.csv
+(db_extract.py runs this query and the next one when on_prem_db is set: python db_extract.py)
 
 SELECT u.user_name,
 	   u.display_name,
@@ -0,0 +1,175 @@
+"""
+Read-only extraction of Bitbucket Data Center metadata straight from its database, used instead of
+the REST listings when on_prem_db['enabled'] is set in config.py.
+
+Each reader is one streaming query (a server-side cursor on PostgreSQL, fetched on_prem_db['batch_size']
+rows at a time) and yields the same data as the REST path it replaces:
+
+- iter_users(): the user dicts of /rest/api/latest/users (5-user-export.py)
+- iter_permissions(): the snapshot rows of 9-transfer-repo-permissions.py, ordered by project and repository
+- export_group_membership() and export_personal_repos(): group-membership.csv and personal-repos.csv,
+  the files the queries documented at the end of config.py used to be run by hand for
+
+    python db_extract.py
+
+writes those two CSV files. The 'sqlite' driver opens a SQLite file with the same tables, which is
+how the queries can be tried against a copy or a fixture: `python db_extract_check.py` runs them
+against db_fixture.sql. PostgreSQL needs psycopg2; the other databases Bitbucket supports are not
+handled yet.
+"""
+
+import csv
+import logging
+import os
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+import sqlite3
+
+from config import on_prem_db
+
+script_location = os.path.dirname(os.path.abspath(__file__))
+membership_csv = os.path.join(script_location, "group-membership.csv")
+personal_repos_csv = os.path.join(script_location, "personal-repos.csv")
+
+# perm_id of sta_project_permission and sta_repo_permission -> Bitbucket permission name
+# (Permission.getId() of the Bitbucket API; the global permissions are not stored in these tables)
+permission_names = {
+    2: 'REPO_READ',
+    3: 'REPO_WRITE',
+    4: 'REPO_ADMIN',
+    5: 'PROJECT_READ',
+    6: 'PROJECT_WRITE',
+    8: 'PROJECT_ADMIN',
+}
+
+users_query = """
+SELECT su.id, su.slug, cu.display_name, cu.email_address
+  FROM stash_user su
+ INNER JOIN cwd_user cu ON cu.lower_user_name = LOWER(su.name)
+ ORDER BY su.id, cu.directory_id
+"""
+
+membership_query = """
+SELECT u.user_name, u.display_name, g.group_name
+  FROM cwd_membership m
+ INNER JOIN cwd_user u ON m.child_id = u.id
+ INNER JOIN cwd_group g ON m.parent_id = g.id
+ INNER JOIN cwd_directory d ON g.directory_id = d.id
+ ORDER BY d.directory_name, u.user_name, g.group_name
+"""
+
+personal_repos_query = """
+SELECT LOWER(prj.project_key), rep.slug, rep.description
+  FROM repository rep
+ INNER JOIN project prj ON rep.project_id = prj.id AND prj.project_type = 1
+ ORDER BY 1, 2
+"""
+
+permissions_query = """
+SELECT prj.project_key, '' AS repo_slug, pp.user_id, su.slug, pp.group_name, pp.perm_id
+  FROM sta_project_permission pp
+ INNER JOIN project prj ON pp.project_id = prj.id
+  LEFT JOIN stash_user su ON pp.user_id = su.id
+ UNION ALL
+SELECT prj.project_key, rep.slug, rp.user_id, su.slug, rp.group_name, rp.perm_id
+  FROM sta_repo_permission rp
+ INNER JOIN repository rep ON rp.repo_id = rep.id
+ INNER JOIN project prj ON rep.project_id = prj.id
+  LEFT JOIN stash_user su ON rp.user_id = su.id
+ ORDER BY 1, 2
+"""
+
+
+def connect():
+    """Open a read-only connection to the Bitbucket database."""
+    driver = on_prem_db['driver']
+    if driver == 'sqlite':
+        return sqlite3.connect(f"file:{on_prem_db['path']}?mode=ro", uri=True)
+    if driver == 'postgresql':
+        if psycopg2 is None:
+            raise RuntimeError("The 'postgresql' driver needs psycopg2 (pip install psycopg2-binary)")
+        connection = psycopg2.connect(host=on_prem_db['host'], port=on_prem_db['port'], dbname=on_prem_db['database'],
+                                      user=on_prem_db['username'], password=on_prem_db['password'])
+        connection.set_session(readonly=True)
+        return connection
+    raise ValueError(f"Unsupported database driver: {driver}")
+
+
+def stream(query):
+    """Yield the rows of a query, fetching them in batches so the result never has to fit in memory."""
+    connection = connect()
+    try:
+        # A named cursor keeps the result on the PostgreSQL server; SQLite cursors are lazy already
+        cursor = connection.cursor('bitbucket_migration') if on_prem_db['driver'] == 'postgresql' else connection.cursor()
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(on_prem_db['batch_size'])
+            if not rows:
+                break
+            yield from rows
+        cursor.close()
+    finally:
+        connection.close()
+
+
+def iter_users():
+    """Every server user in the shape of the REST user listing (id, slug, displayName, emailAddress)."""
+    last_id = None
+    for user_id, slug, display_name, email_address in stream(users_query):
+        # A user present in several directories is listed once, from the first directory
+        if user_id == last_id:
+            continue
+        last_id = user_id
+        yield {'id': user_id, 'slug': slug, 'displayName': display_name, 'emailAddress': email_address}
+
+
+def iter_permissions():
+    """
+    Every explicit project and repository permission as snapshot rows (project_key, repo_slug, kind,
+    name, display_name, permission), ordered by project and repository, the project's own rows first.
+    """
+    display_names = {user['id']: user['displayName'] for user in iter_users()}
+    for project_key, repo_slug, user_id, user_slug, group_name, perm_id in stream(permissions_query):
+        permission = permission_names.get(perm_id)
+        if not permission:
+            continue
+        if user_id is not None:
+            kind, name, display_name = 'users', user_slug or '', display_names.get(user_id, '')
+        else:
+            kind, name, display_name = 'groups', group_name, ''
+        yield {'project_key': project_key, 'repo_slug': repo_slug or '', 'kind': kind, 'name': name,
+               'display_name': display_name, 'permission': permission}
+
+
+def export_group_membership(path=membership_csv):
+    """Write group-membership.csv (user_name, display_name, group_name) and return the number of rows."""
+    return write_csv(path, ['user_name', 'display_name', 'group_name'], stream(membership_query))
+
+
+def export_personal_repos(path=personal_repos_csv):
+    """Write personal-repos.csv (User, Repository Slug, Repository Descr) and return the number of rows."""
+    return write_csv(path, ['User', 'Repository Slug', 'Repository Descr'], stream(personal_repos_query))
+
+
+def write_csv(path, header, rows):
+    count = 0
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    os.replace(tmp_path, path)
+    logging.info(f"Wrote {count} rows to {path}")
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    export_group_membership()
+    export_personal_repos()
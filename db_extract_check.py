@@ -0,0 +1,95 @@
+"""
+Checks the queries of db_extract.py against db_fixture.sql, a small SQLite copy of the Bitbucket
+tables they read, so a change to a query or to the permission ids shows up before a migration:
+
+    python db_extract_check.py
+
+The fixture is loaded into a temporary SQLite file and read through the 'sqlite' driver. The users
+and permissions must come out in the shape of the REST listings 5-user-export.py and
+9-transfer-repo-permissions.py use, and the two CSV files must match the documented queries.
+"""
+
+import csv
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+
+import db_extract
+
+script_location = os.path.dirname(os.path.abspath(__file__))
+fixture = os.path.join(script_location, "db_fixture.sql")
+
+expected_users = [
+    {'id': 101, 'slug': 'jdoe', 'displayName': 'John Doe', 'emailAddress': 'john.doe@example.com'},
+    {'id': 102, 'slug': 'asmith', 'displayName': 'Anna Smith', 'emailAddress': 'anna.smith@example.com'},
+    {'id': 103, 'slug': 'bkhan', 'displayName': 'Bilal Khan', 'emailAddress': None},
+]
+
+# The rows /rest/api/1.0/projects/{key}[/repos/{slug}]/permissions/{users,groups} give for the fixture
+expected_permissions = [
+    {'project_key': 'CORE', 'repo_slug': '', 'kind': 'groups', 'name': 'developers', 'display_name': '', 'permission': 'PROJECT_WRITE'},
+    {'project_key': 'CORE', 'repo_slug': '', 'kind': 'users', 'name': 'jdoe', 'display_name': 'John Doe', 'permission': 'PROJECT_ADMIN'},
+    {'project_key': 'CORE', 'repo_slug': 'api', 'kind': 'groups', 'name': 'release-managers', 'display_name': '', 'permission': 'REPO_ADMIN'},
+    {'project_key': 'CORE', 'repo_slug': 'api', 'kind': 'users', 'name': 'bkhan', 'display_name': 'Bilal Khan', 'permission': 'REPO_READ'},
+    {'project_key': 'WEB', 'repo_slug': '', 'kind': 'users', 'name': 'asmith', 'display_name': 'Anna Smith', 'permission': 'PROJECT_READ'},
+    {'project_key': 'WEB', 'repo_slug': 'site', 'kind': 'users', 'name': 'jdoe', 'display_name': 'John Doe', 'permission': 'REPO_WRITE'},
+]
+
+expected_membership = [
+    ['user_name', 'display_name', 'group_name'],
+    ['asmith', 'Anna Smith', 'developers'],
+    ['jdoe', 'John Doe', 'developers'],
+    ['bkhan', 'Bilal Khan', 'release-managers'],
+]
+
+expected_personal_repos = [
+    ['User', 'Repository Slug', 'Repository Descr'],
+    ['~bkhan', 'scratch', 'Experiments'],
+]
+
+
+def load_fixture(path):
+    connection = sqlite3.connect(path)
+    with open(fixture, encoding='utf-8') as f:
+        connection.executescript(f.read())
+    connection.close()
+
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.reader(f))
+
+
+def check(name, actual, expected):
+    if actual == expected:
+        logging.info(f"{name}: ok")
+        return True
+    logging.error(f"{name}: got {actual}, expected {expected}")
+    return False
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder:
+        database = os.path.join(folder, 'bitbucket.db')
+        load_fixture(database)
+        db_extract.on_prem_db.update({'driver': 'sqlite', 'path': database, 'batch_size': 2})
+
+        permission_key = lambda row: (row['project_key'], row['repo_slug'], row['kind'], row['name'])
+        membership_csv = os.path.join(folder, 'group-membership.csv')
+        personal_repos_csv = os.path.join(folder, 'personal-repos.csv')
+        db_extract.export_group_membership(membership_csv)
+        db_extract.export_personal_repos(personal_repos_csv)
+        results = [
+            check('iter_users', list(db_extract.iter_users()), expected_users),
+            check('iter_permissions', sorted(db_extract.iter_permissions(), key=permission_key), expected_permissions),
+            check('export_group_membership', read_csv(membership_csv), expected_membership),
+            check('export_personal_repos', read_csv(personal_repos_csv), expected_personal_repos),
+        ]
+    return all(results)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,45 @@
+-- A small Bitbucket Data Center database for db_extract_check.py: the tables and columns
+-- db_extract.py reads, with a few users, groups, projects, repositories and permissions.
+-- perm_id: 2 REPO_READ, 3 REPO_WRITE, 4 REPO_ADMIN, 5 PROJECT_READ, 6 PROJECT_WRITE, 8 PROJECT_ADMIN
+
+CREATE TABLE cwd_directory (id INTEGER PRIMARY KEY, directory_name TEXT NOT NULL);
+CREATE TABLE cwd_user (id INTEGER PRIMARY KEY, directory_id INTEGER NOT NULL, user_name TEXT NOT NULL, lower_user_name TEXT NOT NULL, display_name TEXT, email_address TEXT);
+CREATE TABLE cwd_group (id INTEGER PRIMARY KEY, directory_id INTEGER NOT NULL, group_name TEXT NOT NULL);
+CREATE TABLE cwd_membership (id INTEGER PRIMARY KEY, parent_id INTEGER NOT NULL, child_id INTEGER NOT NULL);
+CREATE TABLE stash_user (id INTEGER PRIMARY KEY, name TEXT NOT NULL, slug TEXT NOT NULL);
+CREATE TABLE project (id INTEGER PRIMARY KEY, project_key TEXT NOT NULL, project_type INTEGER NOT NULL);
+CREATE TABLE repository (id INTEGER PRIMARY KEY, project_id INTEGER NOT NULL, slug TEXT NOT NULL, description TEXT);
+CREATE TABLE sta_project_permission (id INTEGER PRIMARY KEY, perm_id INTEGER NOT NULL, project_id INTEGER NOT NULL, group_name TEXT, user_id INTEGER);
+CREATE TABLE sta_repo_permission (id INTEGER PRIMARY KEY, perm_id INTEGER NOT NULL, repo_id INTEGER NOT NULL, group_name TEXT, user_id INTEGER);
+
+INSERT INTO cwd_directory VALUES (1, 'Bitbucket Internal Directory'), (2, 'Corporate LDAP');
+
+-- jdoe is in both directories and is listed once, from the first one
+INSERT INTO cwd_user VALUES
+    (11, 1, 'jdoe', 'jdoe', 'John Doe', 'john.doe@example.com'),
+    (12, 1, 'asmith', 'asmith', 'Anna Smith', 'anna.smith@example.com'),
+    (13, 2, 'JDoe', 'jdoe', 'John Doe (LDAP)', 'jdoe@corp.example.com'),
+    (14, 2, 'bkhan', 'bkhan', 'Bilal Khan', NULL);
+
+INSERT INTO cwd_group VALUES (21, 1, 'developers'), (22, 2, 'release-managers');
+INSERT INTO cwd_membership VALUES (31, 21, 11), (32, 21, 12), (33, 22, 14);
+
+INSERT INTO stash_user VALUES (101, 'jdoe', 'jdoe'), (102, 'asmith', 'asmith'), (103, 'bkhan', 'bkhan');
+
+-- project_type 1 is a personal project
+INSERT INTO project VALUES (201, 'CORE', 0), (202, 'WEB', 0), (203, '~BKHAN', 1);
+INSERT INTO repository VALUES
+    (301, 201, 'api', 'Public API'),
+    (302, 201, 'worker', NULL),
+    (303, 202, 'site', 'Marketing site'),
+    (304, 203, 'scratch', 'Experiments');
+
+INSERT INTO sta_project_permission VALUES
+    (401, 8, 201, NULL, 101),
+    (402, 6, 201, 'developers', NULL),
+    (403, 5, 202, NULL, 102);
+
+INSERT INTO sta_repo_permission VALUES
+    (501, 2, 301, NULL, 103),
+    (502, 4, 301, 'release-managers', NULL),
+    (503, 3, 303, NULL, 101);
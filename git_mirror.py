@@ -0,0 +1,60 @@
+"""
+Bare mirror handling shared by 2-clone-repos-with-lfs.py and 10-transfer-personal-repos.py.
+
+A mirror is a bare `git clone --mirror` kept in <repository_folder>/<name>.git. The first run
+clones it, later runs only fetch what changed on the server (with --prune, so deleted branches go
+away too), and all branches and tags are pushed to Cloud in a single `git push --prune`, which
+also deletes the branches and tags that are gone from the server. No working tree is ever checked out.
+"""
+
+import logging
+import os
+import subprocess
+
+# Refs pushed to Cloud. Server-only namespaces such as refs/pull-requests/* are left out.
+push_refspecs = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+
+
+def run_git(args, cwd=None):
+    """Run a git command and return its exit code, logging stderr when it fails."""
+    logging.debug(f"Executing: git {' '.join(args)}")
+    try:
+        result = subprocess.run(['git', *args], cwd=cwd, capture_output=True, text=True)
+        if result.returncode != 0 and result.stderr:
+            logging.error(result.stderr)
+        return result.returncode
+    except Exception as e:
+        logging.exception(f"Failed to execute git {args[0]}")
+        return -1
+
+
+def mirror_path(save_folder, name):
+    """Folder of the bare mirror for a repository."""
+    return os.path.join(save_folder, f"{name}.git")
+
+
+def fetch_mirror(source_url, mirror_folder, reference=None):
+    """
+    Create the mirror, or bring an existing one up to date with an incremental fetch.
+    A reference repository, when given, lends the objects it already has to the new mirror.
+    """
+    if not os.path.exists(mirror_folder):
+        logging.info(f"Creating mirror {os.path.basename(mirror_folder)}")
+        reference_args = ['--reference-if-able', reference] if reference else []
+        return run_git(['clone', '--mirror', *reference_args, source_url, mirror_folder])
+
+    logging.info(f"Updating mirror {os.path.basename(mirror_folder)}")
+    exit_code = run_git(['remote', 'set-url', 'origin', source_url], cwd=mirror_folder)
+    if exit_code != 0:
+        return exit_code
+    return run_git(['fetch', '--prune', 'origin'], cwd=mirror_folder)
+
+
+def set_cloud_remote(mirror_folder, target_url):
+    """Point the 'cloud' remote of the mirror at target_url, creating it on first use."""
+    return run_git(['config', 'remote.cloud.url', target_url], cwd=mirror_folder)
+
+
+def push_mirror(mirror_folder):
+    """Push every branch and tag of the mirror to the 'cloud' remote in one push, deleting the ones the mirror no longer has."""
+    return run_git(['push', '--prune', 'cloud', *push_refspecs], cwd=mirror_folder)
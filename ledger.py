@@ -0,0 +1,167 @@
+"""
+SQLite ledger of the units of work of every stage, so a run that died halfway resumes where it
+stopped instead of starting over (enabled with use_ledger in config.py, stored in ledger_file).
+
+Each unit (a repository clone, an LFS push, a ref update, a permission grant, a membership add) is
+one row keyed by its stage and key, with its status, start and finish times and a hash of the
+content it was done for:
+
+    units = ledger.load()
+    state = ledger.content_hash(source_refs, target_url)
+    if units.is_done('clone', name, state):
+        units.skip('clone')
+    else:
+        units.start('clone', name, state)
+        ...
+        units.finish('clone', name, state, ok)
+
+A unit is skipped only when it completed for the same content, so a repository that got new
+commits or a grant that changed is done again. A unit still 'started' is one a run died in.
+
+The database is opened once per process (3-ref-update.py runs its repositories in worker
+processes) in WAL mode, so the threads and processes of a run write to it at the same time.
+It also holds the permission snapshot of 9-transfer-repo-permissions.py, indexed by project and
+repository.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from config import ledger_file, use_ledger
+
+default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ledger_file)
+
+schema = """
+CREATE TABLE IF NOT EXISTS units (
+    stage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    content_hash TEXT,
+    started_at REAL,
+    finished_at REAL,
+    detail TEXT,
+    PRIMARY KEY (stage, key)
+);
+CREATE TABLE IF NOT EXISTS permission_snapshot (
+    project_key TEXT NOT NULL,
+    repo_slug TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    display_name TEXT,
+    permission TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS permission_snapshot_resource ON permission_snapshot (project_key, repo_slug);
+"""
+
+snapshot_fields = ['project_key', 'repo_slug', 'kind', 'name', 'display_name', 'permission']
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def content_hash(*parts):
+    """Stable hash of the JSON form of the parts."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Ledger:
+    """The units of one database; with no path the ledger is disabled and never skips anything."""
+
+    def __init__(self, path):
+        self.path = path
+        self.enabled = bool(path)
+        self.skipped = Counter()
+        self.completed = Counter()
+        self.failed = Counter()
+        self._lock = threading.Lock()
+        self.connection = None
+        if self.enabled:
+            self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript(schema)
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def is_done(self, stage, key, content_hash):
+        """True if the unit completed for the same content."""
+        if not self.enabled:
+            return False
+        return bool(self._execute(
+            "SELECT 1 FROM units WHERE stage = ? AND key = ? AND status = 'completed' AND content_hash = ?",
+            (stage, key, content_hash)))
+
+    def skip(self, stage, amount=1):
+        """Count units of a stage skipped because they are done."""
+        with self._lock:
+            self.skipped[stage] += amount
+
+    def start(self, stage, key, content_hash):
+        if not self.enabled:
+            return
+        self._execute(
+            "INSERT INTO units (stage, key, status, content_hash, started_at) VALUES (?, ?, 'started', ?, ?) "
+            "ON CONFLICT (stage, key) DO UPDATE SET status = 'started', content_hash = excluded.content_hash, "
+            "started_at = excluded.started_at, finished_at = NULL, detail = NULL",
+            (stage, key, content_hash, time.time()))
+
+    def finish(self, stage, key, content_hash, ok, detail=None):
+        """Record the unit as completed (ok) or failed for the content, with an optional detail."""
+        if not self.enabled:
+            return
+        now = time.time()
+        self._execute(
+            "INSERT INTO units (stage, key, status, content_hash, started_at, finished_at, detail) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (stage, key) DO UPDATE SET status = excluded.status, content_hash = excluded.content_hash, "
+            "started_at = COALESCE(units.started_at, excluded.started_at), finished_at = excluded.finished_at, detail = excluded.detail",
+            (stage, key, 'completed' if ok else 'failed', content_hash, now, now, detail))
+        with self._lock:
+            (self.completed if ok else self.failed)[stage] += 1
+
+    def replace_snapshot(self, project_key, repo_slug, rows):
+        """Replace the snapshot rows of a server project (repo_slug '') or repository in one transaction."""
+        with self._lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.execute("DELETE FROM permission_snapshot WHERE project_key = ? AND repo_slug = ?", (project_key, repo_slug))
+                self.connection.executemany(
+                    "INSERT INTO permission_snapshot (project_key, repo_slug, kind, name, display_name, permission) VALUES (?, ?, ?, ?, ?, ?)",
+                    [tuple(row[field] for field in snapshot_fields) for row in rows])
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def snapshot_size(self):
+        return self._execute("SELECT COUNT(*) FROM permission_snapshot")[0][0]
+
+    def snapshot_rows(self, project_key, repo_slug=''):
+        """The snapshot rows of a server project (repo_slug '') or repository, read through the resource index."""
+        rows = self._execute(
+            "SELECT project_key, repo_slug, kind, name, display_name, permission FROM permission_snapshot WHERE project_key = ? AND repo_slug = ?",
+            (project_key, repo_slug))
+        return [dict(zip(snapshot_fields, row)) for row in rows]
+
+    def log_stats(self):
+        if not self.enabled:
+            return
+        for stage in sorted(set(self.skipped) | set(self.completed) | set(self.failed)):
+            logging.info(f"Ledger {stage}: {self.skipped[stage]} units skipped as already completed, {self.completed[stage]} completed, {self.failed[stage]} failed")
+
+
+def load(path=None):
+    """The ledger of this process, opened on first use (a disabled one when use_ledger is off)."""
+    path = (path or default_path) if use_ledger else None
+    key = (os.getpid(), path)
+    with _ledgers_lock:
+        if key not in _ledgers:
+            _ledgers[key] = Ledger(path)
+        return _ledgers[key]
@@ -0,0 +1,129 @@
+"""
+Per-repository LFS object manifest, so reruns only move the LFS objects that changed.
+
+The manifest lives in the repository's git directory (lfs-manifest.json) and records:
+
+- refs: the ref tips the last successful `git lfs fetch --all` ran against
+- fetched: OID -> size of every object present in the local LFS storage after that fetch
+- pushed: OIDs confirmed on Cloud by a successful `git lfs push --object-id`
+- pushed_to: the push remote URL those OIDs were confirmed on (a different URL starts over)
+
+When no ref moved since the last fetch there is nothing new to download and the fetch is skipped,
+and only the OIDs not yet confirmed on Cloud are pushed.
+"""
+
+import json
+import logging
+import os
+import subprocess
+
+push_batch_size = 200  # OIDs per `git lfs push --object-id` call
+
+
+def _git_output(args, cwd):
+    return subprocess.run(['git', *args], cwd=cwd, capture_output=True, text=True, check=True).stdout
+
+
+class LfsManifest:
+    def __init__(self, repo_folder):
+        self.repo_folder = repo_folder
+        self.git_dir = _git_output(['rev-parse', '--absolute-git-dir'], repo_folder).strip()
+        self.path = os.path.join(self.git_dir, 'lfs-manifest.json')
+        self.refs = {}
+        self.fetched = {}
+        self.pushed = set()
+        self.pushed_to = None
+        self.fetch_skipped = 0
+        self.fetch_skipped_bytes = 0
+        self.push_skipped = 0
+        self.push_skipped_bytes = 0
+        self.objects_pushed = 0
+        self.bytes_pushed = 0
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.refs = data.get('refs', {})
+            self.fetched = data.get('fetched', {})
+            self.pushed = set(data.get('pushed', []))
+            self.pushed_to = data.get('pushed_to')
+
+    def save(self):
+        """Write the manifest atomically so an interrupted run never leaves it half written."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'refs': self.refs, 'fetched': self.fetched, 'pushed': sorted(self.pushed), 'pushed_to': self.pushed_to}, f)
+        os.replace(tmp_path, self.path)
+
+    def ref_tips(self):
+        output = _git_output(['for-each-ref', '--format=%(objectname) %(refname)'], self.repo_folder)
+        return {ref: sha for sha, ref in (line.split(' ', 1) for line in output.splitlines() if line)}
+
+    def local_objects(self):
+        """OID -> size of every object of this repository in the local LFS storage."""
+        storage = subprocess.run(['git', 'config', '--get', 'lfs.storage'], cwd=self.repo_folder, capture_output=True, text=True).stdout.strip()
+        referenced = None
+        if storage:
+            # Shared storage also holds other repositories' objects, so keep only the ones this repository references
+            output = _git_output(['lfs', 'ls-files', '--all', '--long'], self.repo_folder)
+            referenced = {line.split(' ', 1)[0] for line in output.splitlines() if line}
+        else:
+            storage = os.path.join(self.git_dir, 'lfs')
+
+        objects = {}
+        for root, _, files in os.walk(os.path.join(storage, 'objects')):
+            for name in files:
+                if len(name) == 64 and (referenced is None or name in referenced):
+                    objects[name] = os.path.getsize(os.path.join(root, name))
+        return objects
+
+    def fetch(self, remote=None):
+        """Run `git lfs fetch --all` unless no ref changed since the last successful fetch. Returns an exit code."""
+        tips = self.ref_tips()
+        if self.fetched and tips == self.refs:
+            self.fetch_skipped = len(self.fetched)
+            self.fetch_skipped_bytes = sum(self.fetched.values())
+            logging.info(f"LFS fetch skipped for {os.path.basename(self.repo_folder)}: no ref changed since the last fetch")
+            return 0
+
+        args = ['lfs', 'fetch', '--all'] + ([remote] if remote else [])
+        result = subprocess.run(['git', *args], cwd=self.repo_folder, capture_output=True, text=True)
+        if result.returncode != 0:
+            logging.error(result.stderr)
+            return result.returncode
+
+        self.refs = tips
+        self.fetched = self.local_objects()
+        self.save()
+        return 0
+
+    def push(self, remote='cloud'):
+        """Push only the fetched OIDs not yet confirmed on Cloud. Returns an exit code."""
+        result = subprocess.run(['git', 'config', '--get', f"remote.{remote}.url"], cwd=self.repo_folder, capture_output=True, text=True)
+        if result.returncode != 0:
+            logging.error(f"LFS push for {os.path.basename(self.repo_folder)}: no '{remote}' remote is configured")
+            return result.returncode
+        remote_url = result.stdout.strip()
+        if remote_url != self.pushed_to:
+            self.pushed = set()
+            self.pushed_to = remote_url
+
+        pending = sorted(oid for oid in self.fetched if oid not in self.pushed)
+        self.push_skipped = len(self.fetched) - len(pending)
+        self.push_skipped_bytes = sum(size for oid, size in self.fetched.items() if oid in self.pushed)
+
+        for start in range(0, len(pending), push_batch_size):
+            batch = pending[start:start + push_batch_size]
+            result = subprocess.run(['git', 'lfs', 'push', '--object-id', remote, *batch], cwd=self.repo_folder, capture_output=True, text=True)
+            if result.returncode != 0:
+                logging.error(result.stderr)
+                return result.returncode
+            self.pushed.update(batch)
+            self.objects_pushed += len(batch)
+            self.bytes_pushed += sum(self.fetched[oid] for oid in batch)
+            self.save()
+
+        logging.info(
+            f"LFS push for {os.path.basename(self.repo_folder)}: {self.objects_pushed} objects ({self.bytes_pushed} bytes) pushed, "
+            f"{self.push_skipped} objects ({self.push_skipped_bytes} bytes) already on Cloud"
+        )
+        return 0
@@ -0,0 +1,245 @@
+"""
+Runs the migration as one streaming pipeline (pipeline.py) instead of the numbered scripts one
+after another. Each repository is cloned, ref-updated and given its branch settings, default
+reviewers and permissions as soon as it is listed, while the users, groups and memberships are
+transferred next to it.
+
+    list (1) -> match (1) -> clone (2) -> ref update (3) -> branch settings (4)
+                          -> reviewers (6, after the user export)
+                          -> permissions (9, after the user export and the groups)
+    jobs: cloud repositories (1), user export (5), groups (7) -> memberships (8)
+    with on_prem_db enabled: database export (db_extract.py) -> groups, server permissions -> permissions
+
+The stages reuse the functions and settings of the numbered scripts, so those scripts stay the
+place to configure a stage. With pipeline['write_csvs'] on, the CSV files the scripts exchange are
+written along the way, so any script can still be run on its own afterwards. Personal
+repositories (10-transfer-personal-repos.py) are not part of the pipeline.
+"""
+
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import async_client
+import client
+import db_extract
+import ledger
+import object_store
+import pipeline
+import user_directory
+from config import cloud, dedupe_objects, on_prem, on_prem_db, pipeline as settings, workers
+
+list_repos = importlib.import_module('1-list-repos')
+clone_repos = importlib.import_module('2-clone-repos-with-lfs')
+ref_update = importlib.import_module('3-ref-update')
+branch_settings = importlib.import_module('4-sync-project-branches')
+user_export = importlib.import_module('5-user-export')
+reviewers = importlib.import_module('6-sync-reviewers')
+groups = importlib.import_module('7-transfer-groups')
+memberships = importlib.import_module('8-add-group-membership')
+permissions = importlib.import_module('9-transfer-repo-permissions')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+script_location = os.path.dirname(os.path.abspath(__file__))
+ref_update_fields = ['name', 'files_scanned', 'files_changed', 'bytes_rewritten', 'branches_changed', 'push_status']
+
+
+def csv_path(name):
+    return os.path.join(script_location, name) if settings['write_csvs'] else None
+
+
+class Migration:
+    """The state the stages share: the Cloud repositories, the user directory, the group slugs and the sinks."""
+
+    def __init__(self, sinks, engine, ref_update_pool):
+        self.sinks = sinks
+        self.engine = engine
+        self.ref_update_pool = ref_update_pool
+        self.cloud_repos = {}
+        self.repos_by_ref = {}
+        self.users = None
+        self.group_slugs = {}
+        self.branch_policy = branch_settings.branch_policy()
+        self.registry = object_store.NetworkRegistry(clone_repos.shared_root) if dedupe_objects else None
+        self.network_locks = {}
+        self.project_grants = {}
+        self.server_permissions = None
+        self.reviewer_totals = {'reviewers': 0, 'added': 0, 'skipped': 0, 'failed': 0}
+        self.permission_totals = {'grants': 0, 'recorded': 0, 'inherited': 0, 'existing': 0, 'sent': 0, 'failed': 0, 'reads': 0}
+        self._lock = threading.Lock()
+
+    # Jobs
+
+    def list_cloud_repos(self):
+        url = f"{client.cloud_api}/2.0/repositories/{cloud['workspace']}"
+        for data in client.iter_cloud_pages(url, pagelen=100, workers=workers['cloud_pages'], headers={"Accept": "application/json"}):
+            for row in list_repos.cloud_repo_rows(data):
+                self.sinks['cloud'].write(row)
+                row = dict(zip(list_repos.cloud_fields, row))
+                self.cloud_repos[row['name']] = row
+        logging.info(f"Listed {len(self.cloud_repos)} Bitbucket Cloud repositories")
+
+    def export_users(self):
+        user_export.main()
+        self.users = user_directory.load(permissions.users_file)
+
+    def create_groups(self):
+        groups.create_groups_from_csv(cloud['workspace'], groups.membership_csv)
+        self.group_slugs = permissions.get_group_slugs(cloud['workspace'])
+
+    def export_from_db(self):
+        db_extract.export_group_membership()
+        db_extract.export_personal_repos()
+
+    def read_server_permissions(self):
+        # One query for every project and repository instead of two REST listings each
+        server_permissions = defaultdict(list)
+        for row in db_extract.iter_permissions():
+            server_permissions[(row['project_key'], row['repo_slug'])].append(row)
+        self.server_permissions = server_permissions
+
+    def server_rows(self, project_key, repo_slug=''):
+        """The permissions read from the database, or None to read them over REST."""
+        if self.server_permissions is None:
+            return None
+        return self.server_permissions.get((project_key, repo_slug), [])
+
+    def add_memberships(self):
+        memberships.add_users_to_groups(cloud['workspace'], memberships.users_file, memberships.membership_csv, memberships.get_group_slugs(cloud['workspace']))
+
+    # Stages
+
+    def list_server_repos(self):
+        """Source: every server repository, one project at a time as its pages arrive."""
+        headers = {"Accept": "application/json"}
+        for project in list_repos.iter_server_projects(on_prem['base_url'], headers, 100):
+            for row in list_repos.get_server_project_repos(on_prem['base_url'], project['key'], headers, 1000):
+                self.sinks['server'].write(row)
+                yield dict(zip(list_repos.server_fields, row))
+
+    def match(self, server_repo):
+        """Pair a server repository with the Cloud repository of the same name, as merge_repos_to_csv does."""
+        # Fork chains only see the repositories listed so far; the dedupe registry still joins networks by root commit
+        self.repos_by_ref[f"{server_repo['project_key']}/{server_repo['slug']}"] = server_repo
+        cloud_repo = self.cloud_repos.get(server_repo['name'])
+        if not cloud_repo:
+            return None
+        row = list_repos.merge_repo(server_repo, cloud_repo, self.repos_by_ref)
+        self.sinks['merged'].write(row)
+        return {**dict(zip(list_repos.merged_fields, row)), 'slug': server_repo['slug'], 'project_key': server_repo['project_key']}
+
+    def clone(self, repo):
+        if self.registry:
+            # Repositories of one network take turns, so each reuses what the others downloaded
+            network = self.registry.network_of(repo['name'], repo.get('network') or repo['name'])
+            with self._lock:
+                network_lock = self.network_locks.setdefault(network, threading.Lock())
+            with network_lock:
+                outcome = clone_repos.clone_and_sync_repo(repo, self.registry)
+        else:
+            outcome = clone_repos.clone_and_sync_repo(repo)
+        self.sinks['clone'].write(outcome)
+        if outcome['status'] not in ('ok', 'skipped'):
+            # Raised so the stage counts the failure; the repository is not passed on to the later git stages
+            raise RuntimeError(f"{repo['name']} failed at {outcome['failed_step']}, its later git stages are skipped")
+        return repo
+
+    def update_refs(self, repo):
+        # The rewrite is CPU bound, so it runs in the process pool like 3-ref-update.py does. The pool
+        # spawns its workers: a fork would copy locks (logging, ledger, sqlite) held by the running threads
+        result = self.ref_update_pool.submit(ref_update.update_repository, repo['name']).result()
+        self.sinks['ref_update'].write(result)
+        if result['push_status'] == 'failed':
+            raise RuntimeError(f"References of {repo['name']} were not updated, its branch settings are skipped")
+        return repo
+
+    def sync_branch_settings(self, repo):
+        repo_slug = branch_settings.extract_repo_slug(repo['target'])
+        if repo_slug:
+            branch_settings.reconcile_repository(repo_slug, *self.branch_policy)
+        return repo
+
+    def sync_reviewers(self, repo):
+        counts = self.engine.call(lambda engine: reviewers.sync_repository(engine, repo, self.users))
+        with self._lock:
+            for key in self.reviewer_totals:
+                self.reviewer_totals[key] += counts[key]
+
+    def transfer_permissions(self, repo):
+        return self.engine.call(lambda engine: self._transfer_permissions(engine, repo))
+
+    async def _transfer_permissions(self, engine, repo):
+        # Runs on the engine's loop: the project's grants are sent once, by the first of its repositories
+        project_key = repo['project_key']
+        if project_key not in self.project_grants:
+            self.project_grants[project_key] = asyncio.ensure_future(permissions.transfer_resource(
+                engine, project_key, '', self.users, self.group_slugs, {}, self.permission_totals, self.server_rows(project_key)))
+        inherited = await self.project_grants[project_key]
+        # Without the project's grants nothing is skipped as inherited, so the repository's own grants are all sent
+        applied = await permissions.transfer_resource(engine, project_key, repo['slug'], self.users, self.group_slugs, inherited or {}, self.permission_totals,
+                                                      self.server_rows(project_key, repo['slug']))
+        if inherited is None or applied is None:
+            raise RuntimeError(f"Permissions of {project_key}/{repo['slug']} were not transferred completely, see the errors above")
+        return applied
+
+
+def main():
+    sinks = {
+        'cloud': pipeline.CsvSink(csv_path(cloud['bitbucket_cloud_repositories']), list_repos.cloud_fields),
+        'server': pipeline.CsvSink(csv_path(on_prem['bitbucket_server_repositories']), list_repos.server_fields),
+        'merged': pipeline.CsvSink(csv_path('merged_repositories.csv'), list_repos.merged_fields),
+        'clone': pipeline.CsvSink(csv_path('clone_results.csv'), clone_repos.results_fields),
+        'ref_update': pipeline.CsvSink(csv_path('ref_update_results.csv'), ref_update_fields),
+    }
+    engine = async_client.BackgroundEngine()
+    try:
+        with sinks['cloud'], sinks['server'], sinks['merged'], sinks['clone'], sinks['ref_update'], \
+                ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=multiprocessing.get_context('spawn')) as ref_update_pool:
+            migration = Migration(sinks, engine, ref_update_pool)
+
+            pipe = pipeline.Pipeline()
+            pipe.add_job('cloud_repos', migration.list_cloud_repos)
+            pipe.add_job('users', migration.export_users)
+            permission_jobs = ['users', 'groups']
+            if on_prem_db['enabled']:
+                pipe.add_job('db_export', migration.export_from_db)
+                pipe.add_job('server_permissions', migration.read_server_permissions)
+                pipe.add_job('groups', migration.create_groups, requires=['db_export'])
+                permission_jobs.append('server_permissions')
+            else:
+                pipe.add_job('groups', migration.create_groups)
+            pipe.add_job('memberships', migration.add_memberships, requires=['users', 'groups'])
+
+            pipe.add_stage('list', migration.list_server_repos, many=True)
+            pipe.add_stage('match', migration.match, inputs=['list'], requires=['cloud_repos'])
+            pipe.add_stage('clone', migration.clone, inputs=['match'], workers=workers['sync_repos'])
+            pipe.add_stage('ref_update', migration.update_refs, inputs=['clone'], workers=os.cpu_count() or 1)
+            pipe.add_stage('branch_settings', migration.sync_branch_settings, inputs=['ref_update'], workers=workers['branch_sync'])
+            pipe.add_stage('reviewers', migration.sync_reviewers, inputs=['match'], workers=settings['api_workers'], requires=['users'])
+            pipe.add_stage('permissions', migration.transfer_permissions, inputs=['match'], workers=settings['api_workers'], requires=permission_jobs)
+            ok = pipe.run()
+
+            totals = migration.reviewer_totals
+            logging.info(f"Default reviewers: {totals['added']} added, {totals['skipped']} of {totals['reviewers']} reviewer entries skipped, {totals['failed']} failures")
+            permissions.log_totals(migration.permission_totals)
+            if migration.users:
+                migration.users.log_stats()
+            ledger.load().log_stats()
+    finally:
+        engine.engine.log_stats()
+        engine.close()
+    client.log_stats()
+    if not ok:
+        logging.error("The migration finished with failures, see the errors above")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
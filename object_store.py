@@ -0,0 +1,181 @@
+"""
+Shared git object and LFS storage for repositories of the same fork network (dedupe mode).
+
+Every network gets a bare store under <repository_folder>/.shared/<network>/objects.git and an LFS
+storage directory next to it. Members clone with --reference-if-able the store, so objects the store
+already has are not downloaded again, then their objects are fetched into the store and
+`git repack -a -d -l` drops the local copies, leaving each object on disk once. Members point
+lfs.storage at the shared LFS directory, so each LFS blob is downloaded and kept once as well.
+
+Networks come from the fork lineage in merged_repositories.csv (the 'network' column). Copies that
+are not forks are found by their root commits: the registry in .shared/networks.json remembers the
+root commits of every network, and a repository whose root commit is already known joins that
+network, including on later runs.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+
+_registry_lock = threading.Lock()
+_store_locks = {}
+
+
+def _git(args, cwd=None):
+    return subprocess.run(['git', *args], cwd=cwd, capture_output=True, text=True)
+
+
+def folder_size(path):
+    """Total size in bytes of the files under path."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _store_lock(store):
+    with _registry_lock:
+        return _store_locks.setdefault(store, threading.Lock())
+
+
+def network_folder(shared_root, network):
+    return os.path.join(shared_root, network.replace('/', '__'))
+
+
+def store_path(shared_root, network):
+    """Bare object store of a network, created on first use."""
+    store = os.path.join(network_folder(shared_root, network), 'objects.git')
+    with _store_lock(store):
+        if not os.path.exists(store):
+            os.makedirs(os.path.dirname(store), exist_ok=True)
+            _git(['init', '--bare', '--quiet', '--template=', store])
+    return store
+
+
+def lfs_storage_path(shared_root, network):
+    return os.path.join(network_folder(shared_root, network), 'lfs')
+
+
+def _git_dir(repo_folder):
+    return _git(['rev-parse', '--absolute-git-dir'], cwd=repo_folder).stdout.strip()
+
+
+def local_object_bytes(repo_folder):
+    """Bytes of git objects stored in the repository itself (not via alternates)."""
+    return folder_size(os.path.join(_git_dir(repo_folder), 'objects'))
+
+
+def reachable_object_bytes(repo_folder):
+    """Bytes the repository's reachable objects would take on disk without sharing."""
+    result = _git(['rev-list', '--all', '--objects', '--disk-usage'], cwd=repo_folder)
+    return int(result.stdout.strip() or 0) if result.returncode == 0 else 0
+
+
+def root_commits(repo_folder):
+    result = _git(['rev-list', '--all', '--max-parents=0'], cwd=repo_folder)
+    return set(result.stdout.split()) if result.returncode == 0 else set()
+
+
+class NetworkRegistry:
+    """Maps repositories, root commits and merged networks to networks, persisted in <shared_root>/networks.json."""
+
+    def __init__(self, shared_root):
+        self.path = os.path.join(shared_root, 'networks.json')
+        self.members = {}
+        self.roots = {}
+        self.aliases = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.members = data.get('members', {})
+            self.roots = data.get('roots', {})
+            self.aliases = data.get('aliases', {})
+
+    def network_of(self, name, default):
+        """Network of a repository: where it was registered, else its fork network (following merges)."""
+        with _registry_lock:
+            return self.members.get(name) or self.aliases.get(default, default)
+
+    def register(self, name, network, roots):
+        """
+        Record a member and its root commits and return the network it belongs to. A new member
+        whose root commit is already known joins that earlier network, and so does the rest of
+        its fork network.
+        """
+        with _registry_lock:
+            if name not in self.members:
+                for root in sorted(roots):
+                    if root in self.roots and self.roots[root] != network:
+                        self.aliases[network] = self.roots[root]
+                        network = self.roots[root]
+                        break
+            network = self.members.setdefault(name, network)
+            for root in roots:
+                self.roots.setdefault(root, network)
+            self._save()
+            return network
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'members': self.members, 'roots': self.roots, 'aliases': self.aliases}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def attach(repo_folder, store):
+    """Make the store an alternate of the repository (idempotent)."""
+    alternates = os.path.join(_git_dir(repo_folder), 'objects', 'info', 'alternates')
+    store_objects = os.path.join(store, 'objects')
+    existing = []
+    if os.path.exists(alternates):
+        with open(alternates, encoding='utf-8') as f:
+            existing = [line.strip() for line in f if line.strip()]
+    if store_objects not in existing:
+        os.makedirs(os.path.dirname(alternates), exist_ok=True)
+        with open(alternates, 'a', encoding='utf-8') as f:
+            f.write(f"{store_objects}\n")
+
+
+def member_namespace(source_url):
+    """Ref namespace of a member in the store: a hash of its source URL, always a valid ref name and unique per repository."""
+    return hashlib.sha1(source_url.encode('utf-8')).hexdigest()
+
+
+def absorb(repo_folder, source_url, store, lfs_storage):
+    """
+    Move the repository's objects into the shared store and point it at the shared LFS storage.
+    Returns an exit code.
+    """
+    attach(repo_folder, store)
+    namespace = member_namespace(source_url)
+    with _store_lock(store):
+        # Refs under refs/networks/<namespace>/ keep the member's objects reachable in the store. The
+        # received pack is kept as is, so repack's prune-packed can drop the member's loose copies.
+        result = _git(['-c', 'fetch.unpackLimit=1', 'fetch', '--quiet', '--no-tags', repo_folder, f"+refs/*:refs/networks/{namespace}/*"], cwd=store)
+    if result.returncode != 0:
+        logging.error(result.stderr)
+        return result.returncode
+
+    result = _git(['repack', '-a', '-d', '-l', '-q'], cwd=repo_folder)
+    if result.returncode != 0:
+        logging.error(result.stderr)
+        return result.returncode
+
+    os.makedirs(lfs_storage, exist_ok=True)
+    return _git(['config', 'lfs.storage', lfs_storage], cwd=repo_folder).returncode
+
+
+def network_savings(shared_root, network, member_folders):
+    """Estimate the disk a network saves: what the members would take alone minus what is stored."""
+    folder = network_folder(shared_root, network)
+    unshared = sum(reachable_object_bytes(member) for member in member_folders)
+    stored = folder_size(os.path.join(folder, 'objects.git')) + sum(local_object_bytes(member) for member in member_folders)
+    return max(unshared - stored, 0)
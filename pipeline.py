@@ -0,0 +1,242 @@
+"""
+Streaming stage runner used by migrate.py to run the migration scripts as one DAG.
+
+A pipeline has jobs and stages:
+
+- A job runs once (the user export, the group creation, ...). Stages and other jobs can require it
+  and only start once it is done.
+- A stage processes items with its own pool of worker threads. A stage without inputs is a source:
+  its handler is called once and yields the items. Every other stage reads from a bounded queue
+  fed by the stages it is attached to, and what its handler returns goes to the queue of every
+  stage attached to it (None is not passed on). With many=True the handler returns an iterable
+  and each of its values is passed on.
+
+Queues hold at most pipeline['queue_size'] items, so a fast stage waits for a slow one instead of
+piling items up in memory, and an item moves on as soon as a stage is done with it: the total time
+gets close to the time of the slowest stage instead of the sum of all of them. The queue of a stage
+that requires jobs is the exception: it is unbounded, so the items it cannot take yet wait there
+instead of stalling the other stages fed by the same input.
+
+    pipe = pipeline.Pipeline()
+    pipe.add_job('users', export_users)
+    pipe.add_stage('list', list_repositories, many=True)
+    pipe.add_stage('clone', clone_repository, inputs=['list'], workers=4)
+    pipe.add_stage('reviewers', sync_reviewers, inputs=['list'], requires=['users'])
+    pipe.run()
+
+CsvSink writes the rows a stage produces to the same CSV files the numbered scripts write, so
+every stage can still be inspected or rerun on its own.
+"""
+
+import csv
+import logging
+import queue
+import threading
+import time
+
+from config import pipeline as settings
+
+_stop = object()
+
+
+class CsvSink:
+    """Thread-safe CSV writer that is flushed after every row; with no path every write is dropped."""
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = fields
+        self.file = None
+        self.writer = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        if self.path:
+            self.file = open(self.path, 'w', newline='', encoding='utf-8')
+            self.writer = csv.DictWriter(self.file, fieldnames=self.fields, extrasaction='ignore')
+            self.writer.writeheader()
+        return self
+
+    def __exit__(self, *exc):
+        if self.file:
+            self.file.close()
+
+    def write(self, row):
+        if not self.writer:
+            return
+        if not isinstance(row, dict):
+            row = dict(zip(self.fields, row))
+        with self._lock:
+            self.writer.writerow(row)
+            self.file.flush()
+
+
+class Job:
+    def __init__(self, name, run, requires):
+        self.name = name
+        self.run = run
+        self.requires = requires
+        self.done = threading.Event()
+        self.failed = False
+        self.duration = 0.0
+
+
+class Stage:
+    def __init__(self, name, handle, inputs, workers, requires, many):
+        self.name = name
+        self.handle = handle
+        self.inputs = inputs
+        self.workers = workers
+        self.requires = requires
+        self.many = many
+        self.outputs = []
+        # A stage that waits for jobs gets an unbounded queue: until its jobs are done it takes nothing
+        # out, and a full queue would block the stage feeding it and with it that stage's other outputs
+        self.queue = queue.Queue(maxsize=0 if requires else settings['queue_size']) if inputs else None
+        self.open_inputs = len(inputs)
+        self.running = workers
+        self.counts = {'in': 0, 'out': 0, 'failed': 0}
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def input_done(self):
+        """Called by an input stage when it is finished; the last one stops the workers."""
+        with self._lock:
+            self.open_inputs -= 1
+            last = not self.open_inputs
+        if last:
+            for _ in range(self.workers):
+                self.queue.put(_stop)
+
+    def count(self, key, amount=1, busy=0.0, blocked=0.0):
+        with self._lock:
+            self.counts[key] += amount
+            self.busy += busy
+            self.blocked += blocked
+
+
+class Pipeline:
+    def __init__(self):
+        self.jobs = {}
+        self.stages = {}
+
+    def add_job(self, name, run, requires=()):
+        """Run `run()` once, after the jobs it requires."""
+        self.jobs[name] = Job(name, run, list(requires))
+
+    def add_stage(self, name, handle, inputs=(), workers=1, requires=(), many=False):
+        """Run `handle(item)` on every item of the input stages (or `handle()` once for a source) with `workers` threads."""
+        # A source's handler is called once, so it gets a single worker
+        stage = Stage(name, handle, list(inputs), max(workers, 1) if inputs else 1, list(requires), many)
+        for input_name in stage.inputs:
+            self.stages[input_name].outputs.append(stage)
+        self.stages[name] = stage
+
+    def _wait_for(self, requires):
+        """Wait for the required jobs and return False if one of them failed."""
+        for name in requires:
+            self.jobs[name].done.wait()
+        return not any(self.jobs[name].failed for name in requires)
+
+    def _run_job(self, job):
+        try:
+            if not self._wait_for(job.requires):
+                logging.error(f"Job {job.name} skipped, a job it requires failed")
+                job.failed = True
+                return
+            started = time.monotonic()
+            try:
+                job.run()
+            except Exception:
+                logging.exception(f"Job {job.name} failed")
+                job.failed = True
+            job.duration = time.monotonic() - started
+        finally:
+            job.done.set()
+
+    def _emit(self, stage, result):
+        values = (result or ()) if stage.many else (() if result is None else (result,))
+        for value in values:
+            blocked_from = time.monotonic()
+            for output in stage.outputs:
+                output.queue.put(value)
+            stage.count('out', blocked=time.monotonic() - blocked_from)
+
+    def _work(self, stage, ready):
+        try:
+            ready.wait()
+            if stage.started is None:
+                stage.started = time.monotonic()
+            if not stage.inputs:
+                started = time.monotonic()
+                try:
+                    self._emit(stage, stage.handle())
+                except Exception:
+                    logging.exception(f"Stage {stage.name} failed")
+                    stage.count('failed')
+                stage.count('in', 0, busy=time.monotonic() - started)
+                return
+            while True:
+                item = stage.queue.get()
+                if item is _stop:
+                    return
+                started = time.monotonic()
+                try:
+                    result = stage.handle(item)
+                except Exception:
+                    logging.exception(f"Stage {stage.name} failed on {item}")
+                    stage.count('failed')
+                    result = None
+                stage.count('in', busy=time.monotonic() - started)
+                self._emit(stage, result)
+        finally:
+            with stage._lock:
+                stage.running -= 1
+                last = not stage.running
+            if last:
+                stage.finished = time.monotonic()
+                for output in stage.outputs:
+                    output.input_done()
+
+    def _start_stage(self, stage):
+        ready = threading.Event()
+
+        def release():
+            if not self._wait_for(stage.requires):
+                # Drain the inputs so the stages feeding this one are never blocked by it
+                logging.error(f"Stage {stage.name} skipped, a job it requires failed")
+                stage.handle = lambda *item: None
+            ready.set()
+
+        threading.Thread(target=release, name=f"{stage.name}-wait", daemon=True).start()
+        threads = [threading.Thread(target=self._work, args=(stage, ready), name=f"{stage.name}-{index}", daemon=True) for index in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def run(self):
+        """Run every job and stage to the end, log how long each one took, and return False if a job or an item failed."""
+        started = time.monotonic()
+        threads = [threading.Thread(target=self._run_job, args=(job,), name=job.name, daemon=True) for job in self.jobs.values()]
+        for thread in threads:
+            thread.start()
+        for stage in self.stages.values():
+            threads.extend(self._start_stage(stage))
+        for thread in threads:
+            thread.join()
+        self.log_stats(time.monotonic() - started)
+        return not any(job.failed for job in self.jobs.values()) and not any(stage.counts['failed'] for stage in self.stages.values())
+
+    def log_stats(self, duration):
+        for job in self.jobs.values():
+            logging.info(f"Job {job.name}: {'failed' if job.failed else 'done'} in {job.duration:.1f}s")
+        for stage in self.stages.values():
+            active = (stage.finished - stage.started) if stage.started and stage.finished else 0
+            logging.info(
+                f"Stage {stage.name}: {stage.counts['in']} items in, {stage.counts['out']} out, {stage.counts['failed']} failed, "
+                f"active for {active:.1f}s with {stage.busy:.1f}s of work on {stage.workers} workers, "
+                f"{stage.blocked:.1f}s waiting on full downstream queues"
+            )
+        logging.info(f"Pipeline finished in {duration:.1f}s")
@@ -0,0 +1,258 @@
+"""
+Adaptive rate limiting shared by every call of client.py.
+
+Each request is charged to a family: the first entry of config.rate_limits['families'] whose host
+and path prefix match its URL. A family has two token buckets, one refilled per second (the pace)
+and one refilled per hour (the hourly quota Bitbucket Cloud enforces per resource). A request waits
+until both buckets have a token.
+
+The pace adapts to the server: a 429 or 503 halves it and pauses the family for Retry-After (or a
+short backoff when the header is missing), an X-RateLimit-NearLimit answer slows it a little, and
+every successful answer raises it back step by step to the configured rate.
+
+The bucket state lives in a JSON file in the temporary folder, locked with fcntl, so threads and
+every script running on the same machine draw from the same budget. Where fcntl is not available
+(Windows) or rate_limits['shared'] is off, the state is kept in memory for this process only.
+
+The asyncio engine (async_client.py) must not lock or read that file on its event loop. It spends
+tokens from an in-memory lease with take_leased(), and refills the lease lease_size tokens at a time
+with lease(), which it runs on a thread.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from config import rate_limits
+
+state_file = os.path.join(tempfile.gettempdir(), 'bitbucket-migration-rate-limits.json')
+
+min_factor = 0.05  # Slowest pace, as a fraction of the configured rate
+increase_step = 0.02  # Pace regained per successful answer
+default_pause = 5  # Seconds a family pauses after a 429 or 503 without Retry-After
+lease_size = 10  # Tokens lease() moves from the shared state to this process's in-memory lease at once
+
+_lock = threading.Lock()
+_memory_state = {}
+_leases = {}
+_counters = {'throttled': 0, 'waited': 0.0}
+
+
+def family_of(url):
+    """Return the name and limits of the family a URL is charged to."""
+    parts = urlsplit(url)
+    for family in rate_limits['families']:
+        if family['host'] in ('', parts.netloc) and parts.path.startswith(family['path']):
+            return f"{family['host'] or parts.netloc}{family['path']}", family
+    return parts.netloc, {'per_second': None, 'per_hour': None}
+
+
+def _update_state(change):
+    """Run change(state) on the shared state under the process and file locks and save it."""
+    with _lock:
+        if not (rate_limits['shared'] and fcntl):
+            return change(_memory_state)
+        with open(state_file, 'a+', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    state = {}
+                result = change(state)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _refill(entry, limits, now):
+    elapsed = max(now - entry['updated'], 0)
+    if limits['per_second']:
+        rate = limits['per_second'] * entry['factor']
+        entry['tokens'] = min(entry['tokens'] + elapsed * rate, limits['per_second'])
+    if limits['per_hour']:
+        entry['hour_tokens'] = min(entry['hour_tokens'] + elapsed * limits['per_hour'] / 3600, limits['per_hour'])
+    entry['updated'] = now
+
+
+def _entry(state, name, limits, now):
+    entry = state.get(name)
+    if entry is None:
+        entry = state[name] = {
+            'tokens': limits['per_second'] or 0,
+            'hour_tokens': limits['per_hour'] or 0,
+            'factor': 1.0,
+            'pause_until': 0,
+            'updated': now,
+        }
+    _refill(entry, limits, now)
+    return entry
+
+
+def _take(entry, limits, now, wanted):
+    """Take up to `wanted` whole tokens from both buckets of an entry. Returns the tokens taken and, when none, the seconds to wait."""
+    if entry['pause_until'] > now:
+        return 0, entry['pause_until'] - now
+    available = []
+    if limits['per_second']:
+        available.append(entry['tokens'])
+    if limits['per_hour']:
+        available.append(entry['hour_tokens'])
+    count = int(min(wanted, *available))
+    if count < 1:
+        waits = []
+        if limits['per_second'] and entry['tokens'] < 1:
+            waits.append((1 - entry['tokens']) / (limits['per_second'] * entry['factor']))
+        if limits['per_hour'] and entry['hour_tokens'] < 1:
+            waits.append((1 - entry['hour_tokens']) * 3600 / limits['per_hour'])
+        return 0, max(waits)
+    if limits['per_second']:
+        entry['tokens'] -= count
+    if limits['per_hour']:
+        entry['hour_tokens'] -= count
+    return count, 0
+
+
+def _count_wait(wait):
+    if wait:
+        with _lock:
+            _counters['waited'] += min(wait, 1)
+    return min(wait, 1)
+
+
+def reserve(url):
+    """Take a token for the URL's family if one is available and return 0, else return the seconds to wait before trying again."""
+    name, limits = family_of(url)
+    if not limits['per_second'] and not limits['per_hour']:
+        return 0
+
+    def take(state):
+        now = time.time()
+        return _take(_entry(state, name, limits, now), limits, now, 1)[1]
+
+    return _count_wait(_update_state(take))
+
+
+def take_leased(url):
+    """
+    Take a token from this process's lease for the URL's family, in memory only. Returns 0 when a
+    token was taken, the seconds to wait, or None when the caller has to refill the lease with
+    lease(url) first (only one caller at a time is told so).
+    """
+    name, limits = family_of(url)
+    if not limits['per_second'] and not limits['per_hour']:
+        return 0
+    with _lock:
+        entry = _leases.setdefault(name, {'tokens': 0, 'pause_until': 0, 'leasing': False})
+        now = time.time()
+        if entry['pause_until'] > now:
+            wait = min(entry['pause_until'] - now, 1)
+            _counters['waited'] += wait
+            return wait
+        if entry['tokens'] >= 1:
+            entry['tokens'] -= 1
+            return 0
+        if entry['leasing']:
+            # Another caller is refilling the lease
+            return 0.01
+        entry['leasing'] = True
+        return None
+
+
+def lease(url):
+    """
+    Move up to lease_size tokens of the URL's family from the shared state to this process's lease,
+    or make the lease wait as long as the shared state says. Locks the state file, so the asyncio
+    engine runs it on a thread.
+    """
+    name, limits = family_of(url)
+    count, wait = 0, 0
+    try:
+        def take(state):
+            now = time.time()
+            return _take(_entry(state, name, limits, now), limits, now, lease_size)
+
+        count, wait = _update_state(take)
+    finally:
+        with _lock:
+            entry = _leases[name]
+            entry['tokens'] += count
+            entry['leasing'] = False
+            if wait:
+                entry['pause_until'] = max(entry['pause_until'], time.time() + min(wait, 1))
+
+
+def acquire(url):
+    """Block until the URL's family may send one more request."""
+    while True:
+        wait = reserve(url)
+        if not wait:
+            return
+        time.sleep(wait)
+
+
+def retry_after(response):
+    """Seconds the server asked to wait before the next request, or None."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        return None
+
+
+def is_throttled(response):
+    return response.status_code in (429, 503)
+
+
+def record(url, response):
+    """Adapt the family's pace to the answer a request got."""
+    name, limits = family_of(url)
+    if not limits['per_second'] and not limits['per_hour']:
+        return
+
+    def adapt(state):
+        now = time.time()
+        entry = _entry(state, name, limits, now)
+        if is_throttled(response):
+            entry['factor'] = max(entry['factor'] / 2, min_factor)
+            entry['pause_until'] = max(entry['pause_until'], now + (retry_after(response) or default_pause))
+            entry['tokens'] = 0
+            if response.status_code == 429 and limits['per_hour']:
+                # Cloud only answers 429 once the hourly quota is spent, so stop drawing from it
+                entry['hour_tokens'] = min(entry['hour_tokens'], 0)
+        elif response.headers.get('X-RateLimit-NearLimit', '').lower() == 'true':
+            entry['factor'] = max(entry['factor'] * 0.9, min_factor)
+        else:
+            entry['factor'] = min(entry['factor'] + increase_step, 1.0)
+
+    _update_state(adapt)
+    if is_throttled(response):
+        with _lock:
+            _counters['throttled'] += 1
+            if name in _leases:
+                # Tokens leased before the server pushed back are not spent
+                _leases[name]['tokens'] = 0
+                _leases[name]['pause_until'] = max(_leases[name]['pause_until'], time.time() + (retry_after(response) or default_pause))
+        logging.warning(f"{name} throttled ({response.status_code}), slowing down")
+
+
+def stats():
+    """Throttled answers received and seconds spent waiting for tokens in this process."""
+    with _lock:
+        return dict(_counters)
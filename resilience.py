@@ -0,0 +1,132 @@
+"""
+Retry, deadline, hedging and circuit breaker helpers used by client.request.
+
+- Deadline: every call has an overall time budget (http['deadline'] seconds, or deadline= per call)
+  covering all its attempts and waits; each attempt's read timeout is cut to what is left.
+- Retries: idempotent calls (GET, HEAD, OPTIONS, PUT, DELETE, or idempotent=True) that fail with a
+  connection error, a timeout or a 500/502/504 are sent again after a jittered exponential backoff.
+- Hedging: when http['hedge_after'] is set, a GET that has not answered after that many seconds is
+  sent a second time and the first answer wins.
+- Circuit breaker: after http['breaker_threshold'] consecutive failures a host's breaker opens and
+  every worker calling that host waits for http['breaker_cooldown'] seconds. Then one call probes
+  the host; if it succeeds the breaker closes, otherwise it opens again.
+"""
+
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from config import http
+
+idempotent_methods = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+retry_statuses = {500, 502, 504}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+_counters = {'retries': 0, 'hedges': 0, 'hedges_won': 0, 'breaker_opens': 0}
+_counters_lock = threading.Lock()
+
+
+def count(name, amount=1):
+    with _counters_lock:
+        _counters[name] += amount
+
+
+def stats():
+    """Retries, hedged requests sent and won, and circuit breaker openings in this process."""
+    with _counters_lock:
+        return dict(_counters)
+
+
+def remaining(deadline_at):
+    return deadline_at - time.monotonic()
+
+
+def check_deadline(deadline_at, url):
+    if remaining(deadline_at) <= 0:
+        raise requests.exceptions.Timeout(f"Deadline of {http['deadline']}s exceeded for {url}")
+
+
+def backoff_delay(attempt, deadline_at):
+    """Seconds to wait before retry number `attempt`: full jitter over an exponential bound, never past the deadline."""
+    delay = random.uniform(0, min(http['max_backoff'], http['backoff'] * 2 ** (attempt - 1)))
+    return max(min(delay, remaining(deadline_at)), 0)
+
+
+def backoff(attempt, deadline_at):
+    """Sleep before retry number `attempt`."""
+    time.sleep(backoff_delay(attempt, deadline_at))
+    count('retries')
+
+
+class CircuitBreaker:
+    """Consecutive failure counter of one host; while open, callers wait instead of calling it."""
+
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.open_until = 0
+        self.probing = False
+        self._lock = threading.Condition()
+
+    def try_enter(self):
+        """Return 0 if a call may go to the host now, else the seconds to wait before asking again."""
+        with self._lock:
+            now = time.monotonic()
+            if self.open_until <= now and not self.probing:
+                if self.open_until:
+                    # Half-open: this caller probes the host, the others keep waiting
+                    self.probing = True
+                return 0
+            return (self.open_until - now) if self.open_until > now else 1
+
+    def wait(self, deadline_at):
+        """Block while the breaker is open (or another worker is probing), up to the deadline."""
+        while True:
+            wait = self.try_enter()
+            if not wait:
+                return
+            left = deadline_at - time.monotonic()
+            if left <= 0:
+                raise requests.exceptions.ConnectionError(f"Circuit open for {self.host}")
+            with self._lock:
+                self._lock.wait(min(wait, left))
+
+    def record_success(self):
+        with self._lock:
+            if self.open_until:
+                logging.info(f"Circuit closed for {self.host}")
+            self.failures = 0
+            self.open_until = 0
+            self.probing = False
+            self._lock.notify_all()
+
+    def abandon(self):
+        """Give up a probe that ended without telling whether the host is healthy."""
+        with self._lock:
+            self.probing = False
+            self._lock.notify_all()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.open_until > time.monotonic() and not self.probing:
+                # Already open: a late answer from before it opened
+                return
+            if self.probing or self.failures >= http['breaker_threshold']:
+                if not self.probing:
+                    count('breaker_opens')
+                logging.warning(f"Circuit open for {self.host} after {self.failures} consecutive failures, pausing calls for {http['breaker_cooldown']}s")
+                self.open_until = time.monotonic() + http['breaker_cooldown']
+                self.probing = False
+                self._lock.notify_all()
+
+
+def breaker_for(host):
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
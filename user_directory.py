@@ -0,0 +1,103 @@
+"""
+In-memory directory of the users matched by 5-user-export.py (bitbucket_users_match.csv).
+
+The match file is read once per process into compact records, with hash indexes by Server id,
+Server slug, Server display name and Cloud display name, so every lookup is a dict access
+instead of a scan of the CSV. The directory counts hits and misses per index.
+
+    import user_directory
+    users = user_directory.load()
+    record = users.by_server_id(reviewer['id'])
+    uuid = users.cloud_uuid(cloud_display_name=display_name)
+    users.log_stats()
+"""
+
+import csv
+import logging
+import os
+import threading
+from collections import Counter, namedtuple
+
+default_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bitbucket_users_match.csv')
+
+UserRecord = namedtuple('UserRecord', [
+    'server_id', 'server_slug', 'server_displayName', 'server_emailAddress',
+    'cloud_uuid', 'cloud_account_id', 'cloud_nickname', 'cloud_display_name',
+])
+
+# Index name -> record field it is keyed on
+indexes = {
+    'server_id': 'server_id',
+    'server_slug': 'server_slug',
+    'server_display_name': 'server_displayName',
+    'cloud_display_name': 'cloud_display_name',
+}
+
+_directories = {}
+_load_lock = threading.Lock()
+
+
+class UserDirectory:
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        self.index = {name: {} for name in indexes}
+        self.hits = Counter()
+        self.misses = Counter()
+        self._counter_lock = threading.Lock()
+
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                record = UserRecord(*(row.get(field) or None for field in UserRecord._fields))
+                self.records.append(record)
+                for name, field in indexes.items():
+                    key = getattr(record, field)
+                    if key:
+                        # The first record wins for namesakes, as the former CSV scans did
+                        self.index[name].setdefault(key, record)
+        logging.info(f"Loaded {len(self.records)} users from {path}")
+
+    def lookup(self, index, key):
+        """Record whose index field equals key, or None."""
+        record = self.index[index].get(str(key)) if key is not None else None
+        with self._counter_lock:
+            (self.hits if record else self.misses)[index] += 1
+        return record
+
+    def by_server_id(self, server_id):
+        return self.lookup('server_id', server_id)
+
+    def by_server_slug(self, slug):
+        return self.lookup('server_slug', slug)
+
+    def by_server_display_name(self, display_name):
+        return self.lookup('server_display_name', display_name)
+
+    def by_cloud_display_name(self, display_name):
+        return self.lookup('cloud_display_name', display_name)
+
+    def cloud_uuid(self, **keys):
+        """
+        Cloud UUID of the first record found for the given keys, tried in order, e.g.
+        cloud_uuid(server_slug='jdoe', server_display_name='John Doe'). None if no record has one.
+        """
+        for index, key in keys.items():
+            record = self.lookup(index, key)
+            if record and record.cloud_uuid:
+                return record.cloud_uuid
+        return None
+
+    def log_stats(self):
+        """Log the lookup hit and miss counters per index."""
+        for name in indexes:
+            if self.hits[name] or self.misses[name]:
+                logging.info(f"User directory {name}: {self.hits[name]} hits, {self.misses[name]} misses")
+
+
+def load(path=default_file):
+    """Return the directory for path, reading the file on the first call only."""
+    path = os.path.abspath(path)
+    with _load_lock:
+        if path not in _directories:
+            _directories[path] = UserDirectory(path)
+        return _directories[path]
@@ -0,0 +1,200 @@
+"""
+Matching of Bitbucket Server users to Bitbucket Cloud workspace members (5-user-export.py).
+
+Cloud members are indexed once by normalized email (when the member payload carries one),
+nickname and display name, plus a blocked trigram index over display names for fuzzy candidates.
+Every Server user is then probed against those indexes, strongest key first:
+
+- email: Server email address equals a Cloud email
+- slug: Server slug equals a Cloud nickname
+- email_local_part: the part of the Server email before the @ equals a Cloud nickname
+- display_name: same display name (confidence shared between namesakes)
+- fuzzy: display names with a trigram similarity of at least fuzzy_threshold
+
+Each candidate pair gets a confidence between 0 and 1 and pairs are assigned greedily from the
+highest confidence down, so every Server user and every Cloud member is used at most once.
+Fuzzy candidates are only looked up for the users the exact keys left unmatched.
+
+The Cloud members are held in memory for the indexes. The Server users stream through them: each
+one is probed as it arrives and spooled to a temporary file, which is read back for the fuzzy pass
+and for writing the rows, so memory holds only their candidate pairs and matches.
+
+A pair tied in confidence with another free pair of the same Server user or Cloud member (two
+John Smiths on one side) cannot be told apart, so neither is matched: those Server users and Cloud
+members are held for manual review and written with match_key 'ambiguous'.
+"""
+
+import json
+import re
+import tempfile
+from collections import Counter, defaultdict
+from itertools import groupby
+
+from unidecode import unidecode
+
+fuzzy_threshold = 0.8  # Minimum trigram similarity (Dice coefficient) of a fuzzy display name match
+max_block_size = 200  # Trigrams shared by more Cloud members than this are too common to pick candidates
+fuzzy_candidates = 5  # Cloud members per Server user whose similarity is computed exactly
+
+# Confidence of a match on each key
+key_confidence = {
+    'email': 1.0,
+    'slug': 0.95,
+    'email_local_part': 0.9,
+    'display_name': 0.85,
+}
+
+match_fields = ['match_key', 'match_confidence']
+
+
+def normalize(value):
+    """Lowercase ASCII form of a value with surrounding and repeated whitespace removed."""
+    return ' '.join(unidecode(value or '').lower().split())
+
+
+def name_key(value):
+    """Normalized name with punctuation removed and its words sorted, so 'Smith, John' equals 'John Smith'."""
+    return ' '.join(sorted(re.sub(r'[^a-z0-9 ]', ' ', normalize(value)).split()))
+
+
+def trigrams(value):
+    padded = f"  {value} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def dice(a, b):
+    return 2 * len(a & b) / (len(a) + len(b)) if a and b else 0.0
+
+
+class CloudIndex:
+    """Hash indexes and a blocked trigram index over the Cloud members."""
+
+    def __init__(self, cloud_rows):
+        self.by_email = defaultdict(list)
+        self.by_nickname = defaultdict(list)
+        self.by_name = defaultdict(list)
+        self.name_grams = []
+        self.by_gram = defaultdict(list)
+        for position, row in enumerate(cloud_rows):
+            if row.get('cloud_email'):
+                self.by_email[normalize(row['cloud_email'])].append(position)
+            if row.get('cloud_nickname'):
+                self.by_nickname[normalize(row['cloud_nickname'])].append(position)
+            name = name_key(row.get('cloud_display_name'))
+            grams = trigrams(name) if name else set()
+            if name:
+                self.by_name[name].append(position)
+            self.name_grams.append(grams)
+            for gram in grams:
+                self.by_gram[gram].append(position)
+
+    def exact_candidates(self, server_row):
+        """Yield (cloud position, key, confidence) for every exact key the Server user shares with a Cloud member."""
+        email = normalize(server_row.get('server_emailAddress'))
+        probes = [
+            ('email', self.by_email, email),
+            ('slug', self.by_nickname, normalize(server_row.get('server_slug'))),
+            ('email_local_part', self.by_nickname, email.split('@', 1)[0] if '@' in email else ''),
+            ('display_name', self.by_name, name_key(server_row.get('server_displayName'))),
+        ]
+        for key, index, value in probes:
+            positions = index.get(value, []) if value else []
+            for position in positions:
+                # Namesakes (or shared nicknames) split the confidence between them
+                yield position, key, key_confidence[key] / len(positions)
+
+    def fuzzy_candidates(self, server_row, taken):
+        """Yield (cloud position, 'fuzzy', similarity) for the closest unmatched Cloud display names."""
+        grams = trigrams(name_key(server_row.get('server_displayName')))
+        shared = Counter()
+        for gram in grams:
+            postings = self.by_gram.get(gram, [])
+            if len(postings) <= max_block_size:
+                shared.update(postings)
+        closest = [position for position, _ in shared.most_common() if position not in taken][:fuzzy_candidates]
+        for position in closest:
+            similarity = dice(grams, self.name_grams[position])
+            if similarity >= fuzzy_threshold:
+                yield position, 'fuzzy', similarity
+
+
+def assign(candidates, matched_server, matched_cloud, matches, held_server, held_cloud):
+    """
+    Greedily keep the highest confidence pairs whose Server user and Cloud member are both still free.
+    Users and members with several free pairs of the same confidence are held instead.
+    """
+    ordered = sorted(candidates, key=lambda c: (-c[0], c[1], c[2]))
+    for confidence, level in groupby(ordered, key=lambda c: c[0]):
+        free = [c for c in level if c[1] not in matched_server and c[1] not in held_server
+                and c[2] not in matched_cloud and c[2] not in held_cloud]
+        per_server = Counter(c[1] for c in free)
+        per_cloud = Counter(c[2] for c in free)
+        for _, server_position, cloud_position, _ in free:
+            if per_server[server_position] > 1 or per_cloud[cloud_position] > 1:
+                held_server.add(server_position)
+                held_cloud.add(cloud_position)
+        for _, server_position, cloud_position, key in free:
+            if server_position in held_server or cloud_position in held_cloud:
+                continue
+            matched_server.add(server_position)
+            matched_cloud.add(cloud_position)
+            matches[server_position] = (cloud_position, key, confidence)
+
+
+def read_spool(spool):
+    """Yield (position, Server row) from the spool match_users wrote the Server users to."""
+    spool.seek(0)
+    for position, line in enumerate(spool):
+        yield position, json.loads(line)
+
+
+def match_users(cloud_rows, server_rows, write):
+    """
+    Match Server users to Cloud members.
+
+    Parameters:
+    - cloud_rows: Dicts with the cloud_* fields of every Cloud member, held and indexed in memory.
+    - server_rows: Iterable of dicts with the server_* fields of every Server user, read once as it
+      arrives and spooled to a temporary file, so only their candidate pairs stay in memory.
+    - write: Called with every merged row: matched pairs first, then unmatched Server users, then
+      unmatched Cloud members, with match_key and match_confidence set on the matched ones and
+      match_key 'ambiguous' on the held ones.
+
+    Returns a Counter of matches per key and a Counter with the number of 'server_users' and of
+    'ambiguous' Server users.
+    """
+    index = CloudIndex(cloud_rows)
+    matched_server, matched_cloud, matches = set(), set(), {}
+    held_server, held_cloud = set(), set()
+    totals = Counter()
+
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as spool:
+        candidates = []
+        for server_position, server_row in enumerate(server_rows):
+            spool.write(json.dumps(server_row) + '\n')
+            totals['server_users'] += 1
+            for cloud_position, key, confidence in index.exact_candidates(server_row):
+                candidates.append((confidence, server_position, cloud_position, key))
+        assign(candidates, matched_server, matched_cloud, matches, held_server, held_cloud)
+
+        candidates = []
+        for server_position, server_row in read_spool(spool):
+            if server_position not in matched_server and server_position not in held_server:
+                for cloud_position, key, confidence in index.fuzzy_candidates(server_row, matched_cloud | held_cloud):
+                    candidates.append((confidence, server_position, cloud_position, key))
+        assign(candidates, matched_server, matched_cloud, matches, held_server, held_cloud)
+
+        per_key = Counter()
+        for server_position, server_row in read_spool(spool):
+            if server_position in matches:
+                cloud_position, key, confidence = matches[server_position]
+                per_key[key] += 1
+                write({**server_row, **cloud_rows[cloud_position], 'match_key': key, 'match_confidence': round(confidence, 3)})
+        for server_position, server_row in read_spool(spool):
+            if server_position not in matched_server:
+                write({**server_row, 'match_key': 'ambiguous'} if server_position in held_server else server_row)
+    for position, row in enumerate(cloud_rows):
+        if position not in matched_cloud:
+            write({**row, 'match_key': 'ambiguous'} if position in held_cloud else row)
+    totals['ambiguous'] = len(held_server)
+    return per_key, totals